@@ -222,6 +222,17 @@ accountRoles = []
 # scanCurrentAccount=""
 #
 ################################################################################
+#
+# Variable: secretCacheTTL
+#
+# The number of seconds the credentials read from Secrets Manager are cached
+# between invocations of the Lambda function. If an FSxN rejects the cached
+# credentials, they are read from Secrets Manager again right away. If not
+# set, it defaults to 300 seconds.
+#
+# secretCacheTTL=300
+#
+################################################################################
 # END OF VARIABLE DEFINITIONS
 ################################################################################
 
@@ -299,6 +310,98 @@ def scanFsxNs(fsxClient):
             except KeyError: # Skip any that don't have their IP address assigned yet.
                 pass
 
+################################################################################
+# The ETag of the fsxnSecretARNsFile the last time it was read. Since the file
+# rarely changes, it is kept across warm invocations of the Lambda function so
+# the file is only read, and parsed, again if it has changed.
+################################################################################
+secretARNsFileETag = None
+secretARNsFileCacheHits = 0
+secretARNsFileCacheMisses = 0
+
+################################################################################
+# This function reads the fsxnSecretARNsFile from S3 and populates the
+# secretARNs dictionary with it. A conditional GET is used, so if the file
+# hasn't changed since the last time it was read, the secretARNs dictionary is
+# left as is.
+################################################################################
+def readSecretARNsFile():
+    global config, s3Client, secretARNs, secretARNsFileETag, secretARNsFileCacheHits, secretARNsFileCacheMisses
+
+    try:
+        if secretARNsFileETag is not None and 'secretARNs' in globals():
+            response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'], IfNoneMatch=secretARNsFileETag)
+        else:
+            response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'])
+    except botocore.exceptions.ClientError as err:
+        if secretARNsFileETag is not None and (err.response['Error']['Code'] in ["304", "NotModified"] or err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304):
+            secretARNsFileCacheHits += 1
+            logger.debug(f"fsxnSecretARNsFile cache hits={secretARNsFileCacheHits} misses={secretARNsFileCacheMisses}.")
+            return
+        raise Exception(f"Unable to open parameter file with secrets '{config['fsxnSecretARNsFile']}' from S3 bucket '{config['s3BucketName']}': {err}")
+
+    secretARNsFileCacheMisses += 1
+    logger.debug(f"fsxnSecretARNsFile cache hits={secretARNsFileCacheHits} misses={secretARNsFileCacheMisses}.")
+    secretARNs = {}
+    for line in response['Body'].iter_lines():
+        line = line.decode('utf-8')
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line == '':
+            continue
+        fsId, secretArn = line.split('=')
+        secretARNs[fsId.strip()] = secretArn.strip()
+    secretARNsFileETag = response.get('ETag')
+
+################################################################################
+# The secrets read from Secrets Manager, keyed by the secret ARN. Each entry is
+# a tuple of the time it expires and the secret. Since it is a module variable,
+# it survives across warm invocations of the Lambda function.
+################################################################################
+secretCache = {}
+
+################################################################################
+# This function returns the secret, as a dictionary, stored in the secret ARN
+# passed in. The secret is cached for secretCacheTTL seconds, unless
+# forceRefresh is True, which is used when the cached credentials are
+# rejected.
+################################################################################
+def getSecret(secretARN, forceRefresh=False):
+    global config, secretCache, boto3Config
+
+    curTime = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    cached = secretCache.get(secretARN)
+    if not forceRefresh and cached is not None and cached[0] > curTime:
+        return cached[1]
+
+    secretsClient = boto3.client(service_name='secretsmanager', region_name=secretARN.split(':')[3], config=boto3Config)
+    secretsInfo = secretsClient.get_secret_value(SecretId=secretARN)
+    secretsClient.close() # Since each secret could be in a different region.
+    secret = json.loads(secretsInfo['SecretString'])
+    secretCache[secretARN] = (curTime + config['secretCacheTTL'], secret)
+    return secret
+
+################################################################################
+# This function returns the basic authentication header for the FSxN, using
+# the credentials stored in the secret ARN passed in. It returns None if the
+# credentials couldn't be retrieved.
+################################################################################
+def getAuthHeader(fsId, secretARN, forceRefresh=False):
+    global logger
+
+    try:
+        secret = getSecret(secretARN, forceRefresh)
+    except botocore.exceptions.ClientError as err:
+        logger.warning(f"Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARN}'. {err}")
+        return None
+
+    if secret.get('username') is None or secret.get('password') is None:
+        logger.warning(f"The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARN}'.")
+        return None
+
+    return urllib3.make_headers(basic_auth=f"{secret['username']}:{secret['password']}")
+
 ################################################################################
 # This function checks that all the required configuration variables are set.
 # And in the process, builds the "config" dictionary that contains all the
@@ -324,6 +427,7 @@ def checkConfig():
         'stateMatch': stateMatch if 'stateMatch' in globals() else None,                          # pylint: disable=E0602
         'fsxnSecretARNsFile': fsxnSecretARNsFile if 'fsxnSecretARNsFile' in globals() else None,  # pylint: disable=E0602
         'defaultSecretARN': defaultSecretARN if 'defaultSecretARN' in globals() else None,        # pylint: disable=E0602
+        'secretCacheTTL': secretCacheTTL if 'secretCacheTTL' in globals() else None,              # pylint: disable=E0602
         'fileSystem1ID': fileSystem1ID if 'fileSystem1ID' in globals() else None,                 # pylint: disable=E0602
         'fileSystem2ID': fileSystem2ID if 'fileSystem2ID' in globals() else None,                 # pylint: disable=E0602
         'fileSystem3ID': fileSystem3ID if 'fileSystem3ID' in globals() else None,                 # pylint: disable=E0602
@@ -338,7 +442,7 @@ def checkConfig():
     optionalConfig = ['fsxnSecretARNsFile', 'inputFilter', 'inputMatch', 'applicationMatch', 'userMatch', 'stateMatch',
                       'fileSystem1ID', 'fileSystem2ID', 'fileSystem3ID', 'fileSystem4ID', 'regions', 'accountRoles',
                       'fileSystem5ID', 'fileSystem1SecretARN', 'fileSystem2SecretARN', 'defaultSecretARN', 'scanCurrentAccount',
-                      'fileSystem3SecretARN', 'fileSystem4SecretARN', 'fileSystem5SecretARN']
+                      'fileSystem3SecretARN', 'fileSystem4SecretARN', 'fileSystem5SecretARN', 'secretCacheTTL']
     #
     # Check to see if any variables are set via environment variables.
     for item in config.copy():
@@ -373,41 +477,30 @@ def checkConfig():
     for item in config:
         if item not in optionalConfig and config[item] is None:
             raise Exception(f"{item} is not set.")
+
+    config['secretCacheTTL'] = 300 if config['secretCacheTTL'] is None else int(config['secretCacheTTL'])
     #
     # Create a S3 client.
     s3Client = boto3.client('s3', region_name=config['s3BucketRegion'], config=boto3Config)
     #
-    # Define the secretsARNs dictionary if it hasn't already been defined.
-    if 'secretARNs' not in globals():
+    # If the fsxnSecretARNsFile is set, then read the file from S3 and populate the secretARNs dictionary.
+    # It is checked on every invocation, but only read again if it has changed.
+    if config['fsxnSecretARNsFile'] is not None and config['fsxnSecretARNsFile'] != '':
+        readSecretARNsFile()
+    #
+    # Otherwise, define the secretsARNs dictionary if it hasn't already been defined.
+    elif 'secretARNs' not in globals():
         secretARNs = {}
-        #
-        # If the fsxnSecretARNsFile is set, then read the file from S3 and populate the secretARNs dictionary.
-        if config['fsxnSecretARNsFile'] is not None and config['fsxnSecretARNsFile'] != '':
-            try:
-                response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'])
-            except botocore.exceptions.ClientError as err:
-                raise Exception(f"Unable to open parameter file with secrets '{config['fsxnSecretARNsFile']}' from S3 bucket '{config['s3BucketName']}': {err}")
-            else:
-                for line in response['Body'].iter_lines():
-                    line = line.decode('utf-8')
-                    line = line.strip()
-                    if line.startswith('#'):
-                        continue
-                    if line == '':
-                        continue
-                    fsId, secretArn = line.split('=')
-                    secretARNs[fsId.strip()] = secretArn.strip()
-        else:
-            if config['fileSystem1ID'] is not None and config['fileSystem1SecretARN'] is not None:
-                secretARNs[config['fileSystem1ID']] = config['fileSystem1SecretARN']
-            if config['fileSystem2ID'] is not None and config['fileSystem2SecretARN'] is not None:
-                secretARNs[config['fileSystem2ID']] = config['fileSystem2SecretARN']
-            if config['fileSystem3ID'] is not None and config['fileSystem3SecretARN'] is not None:
-                secretARNs[config['fileSystem3ID']] = config['fileSystem3SecretARN']
-            if config['fileSystem4ID'] is not None and config['fileSystem4SecretARN'] is not None:
-                secretARNs[config['fileSystem4ID']] = config['fileSystem4SecretARN']
-            if config['fileSystem5ID'] is not None and config['fileSystem5SecretARN'] is not None:
-                secretARNs[config['fileSystem5ID']] = config['fileSystem5SecretARN']
+        if config['fileSystem1ID'] is not None and config['fileSystem1SecretARN'] is not None:
+            secretARNs[config['fileSystem1ID']] = config['fileSystem1SecretARN']
+        if config['fileSystem2ID'] is not None and config['fileSystem2SecretARN'] is not None:
+            secretARNs[config['fileSystem2ID']] = config['fileSystem2SecretARN']
+        if config['fileSystem3ID'] is not None and config['fileSystem3SecretARN'] is not None:
+            secretARNs[config['fileSystem3ID']] = config['fileSystem3SecretARN']
+        if config['fileSystem4ID'] is not None and config['fileSystem4SecretARN'] is not None:
+            secretARNs[config['fileSystem4ID']] = config['fileSystem4SecretARN']
+        if config['fileSystem5ID'] is not None and config['fileSystem5SecretARN'] is not None:
+            secretARNs[config['fileSystem5ID']] = config['fileSystem5SecretARN']
 
     if len(secretARNs) == 0 and config['defaultSecretARN'] is None:
         raise Exception("No secretARNs were specified.")
@@ -530,28 +623,15 @@ def lambda_handler(event, context):     # pylint: disable=W0613
         if secretARNs.get(fsId) is None and config['defaultSecretARN'] is not None:
             secretARNs[fsId] = config['defaultSecretARN']
 
-        if secretARNs.get(fsId) is not None:
-            #
-            # Get the username and password of the ONTAP/FSxN system.
-            try:
-                secretsClient = boto3.client(service_name='secretsmanager', region_name=secretARNs[fsId].split(':')[3], config=boto3Config)
-                secretsInfo = secretsClient.get_secret_value(SecretId=secretARNs[fsId])
-                secret = json.loads(secretsInfo['SecretString'])
-                if secret.get('username') is None or secret.get('password') is None:
-                    logger.warning(f"The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARNs[fsId]}'.")
-                    continue
-                username = secret['username']
-                password = secret['password']
-                secretsClient.close() # Since each secret could be in a different region.
-            except botocore.exceptions.ClientError as err:
-                logger.warning(f"Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARNs[fsId]}'. {err}")
-                continue
-        else:
+        if secretARNs.get(fsId) is None:
             logger.warning(f'No secret ARN was found for {fsId}.')
             continue
         #
-        # Create a header with the basic authentication.
-        auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+        # Create a header with the basic authentication. The credentials are cached, so
+        # Secrets Manager isn't called for every FSxN on every run.
+        auth = getAuthHeader(fsId, secretARNs[fsId])
+        if auth is None:
+            continue
         headersQuery = { **auth }
         #
         # Get the last process event index for this FSxN.
@@ -565,6 +645,7 @@ def lambda_handler(event, context):     # pylint: disable=W0613
         #
         # Get the audit records.
         endpoint = f"/api/security/audit/messages?timestamp=>{lastProcessed['ascTimestamp']}&max_records=1000"
+        refreshedCredentials = False
         while endpoint is not None:
             auditEvents = []
             try:
@@ -576,6 +657,17 @@ def lambda_handler(event, context):     # pylint: disable=W0613
             except urllib3.exceptions.ConnectTimeoutError as err:
                 logger.warning(f"Timeout connecting to {fsIP}({fsId}) at {endpoint}. {err}")
                 break # Break out "while endpoint is not None" loop.
+            #
+            # If the credentials were rejected, they might have been changed since they were
+            # cached, so get them from Secrets Manager again, and retry once.
+            if response.status == 401 and not refreshedCredentials:
+                refreshedCredentials = True
+                logger.info(f"The credentials were rejected by {fsIP}({fsId}), reading them from '{secretARNs[fsId]}' again.")
+                auth = getAuthHeader(fsId, secretARNs[fsId], forceRefresh=True)
+                if auth is None:
+                    break # Break out "while endpoint is not None" loop.
+                headersQuery = { **auth }
+                continue # Retry the same endpoint.
             if response.status == 200:
                 data = json.loads(response.data.decode('utf-8'))
                 logger.debug(f'Received {len(data["records"])} records from {fsIP}({fsId}).')
@@ -134,6 +134,12 @@ import botocore
 # "true". It will be converted to a boolean later. Note that the timestamp
 # displayed in the event message will still be the original timestamp.
 # preserveOldEvents = "true"
+#
+# The number of seconds the credentials read from Secrets Manager are cached
+# between invocations of the Lambda function. If an FSxN rejects the cached
+# credentials, they are read from Secrets Manager again right away. If not
+# set, it defaults to 300 seconds.
+# secretCacheTTL = 300
 
 ################################################################################
 # This function returns the epoch time from the filename. It assumes the
@@ -390,6 +396,96 @@ def ingestAuditFile(auditLogPath, auditLogName):
         print(f"Info: Putting {len(cwEvents)} events")
         putEventInCloudWatch(cwEvents, auditLogName)
 
+################################################################################
+# The ETag of the fsxnSecretARNsFile the last time it was read. Since the file
+# rarely changes, it is kept across warm invocations of the Lambda function so
+# the file is only read, and parsed, again if it has changed.
+################################################################################
+secretARNsFileETag = None
+secretARNsFileCacheHits = 0
+secretARNsFileCacheMisses = 0
+
+################################################################################
+# This function reads the fsxnSecretARNsFile from S3 and populates the
+# secretARNs dictionary with it. A conditional GET is used, so if the file
+# hasn't changed since the last time it was read, the secretARNs dictionary is
+# left as is.
+################################################################################
+def readSecretARNsFile():
+    global config, s3Client, secretARNs, secretARNsFileETag, secretARNsFileCacheHits, secretARNsFileCacheMisses
+
+    try:
+        if secretARNsFileETag is not None and 'secretARNs' in globals():
+            response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'], IfNoneMatch=secretARNsFileETag)
+        else:
+            response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'])
+    except botocore.exceptions.ClientError as err:
+        if secretARNsFileETag is not None and (err.response['Error']['Code'] in ["304", "NotModified"] or err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304):
+            secretARNsFileCacheHits += 1
+            print(f"Info: fsxnSecretARNsFile cache hits={secretARNsFileCacheHits} misses={secretARNsFileCacheMisses}.")
+            return
+        raise Exception(f"Unable to open parameter file with secrets '{config['fsxnSecretARNsFile']}' from S3 bucket '{config['s3BucketName']}': {err}")
+
+    secretARNsFileCacheMisses += 1
+    print(f"Info: fsxnSecretARNsFile cache hits={secretARNsFileCacheHits} misses={secretARNsFileCacheMisses}.")
+    secretARNs = {}
+    for line in response['Body'].iter_lines():
+        line = line.decode('utf-8')
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line == '':
+            continue
+        fsId, secretArn = line.split('=')
+        secretARNs[fsId.strip()] = secretArn.strip()
+    secretARNsFileETag = response.get('ETag')
+
+################################################################################
+# The secrets read from Secrets Manager, keyed by the secret ARN. Each entry is
+# a tuple of the time it expires and the secret. Since it is a module variable,
+# it survives across warm invocations of the Lambda function.
+################################################################################
+secretCache = {}
+
+################################################################################
+# This function returns the secret, as a dictionary, stored in the secret ARN
+# passed in. The secret is cached for secretCacheTTL seconds, unless
+# forceRefresh is True, which is used when the cached credentials are
+# rejected.
+################################################################################
+def getSecret(secretARN, forceRefresh=False):
+    global config, secretCache
+
+    curTime = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    cached = secretCache.get(secretARN)
+    if not forceRefresh and cached is not None and cached[0] > curTime:
+        return cached[1]
+
+    secretsClient = boto3.client(service_name='secretsmanager', region_name=secretARN.split(':')[3])
+    secretsInfo = secretsClient.get_secret_value(SecretId=secretARN)
+    secretsClient.close()  # Since the next secret could be in a different region.
+    secret = json.loads(secretsInfo['SecretString'])
+    secretCache[secretARN] = (curTime + config['secretCacheTTL'], secret)
+    return secret
+
+################################################################################
+# This function returns the basic authentication header for the FSxN, using
+# the credentials stored in the secret ARN passed in. It returns None if the
+# credentials couldn't be retrieved.
+################################################################################
+def getAuthHeader(fsId, secretARN, forceRefresh=False):
+    try:
+        secret = getSecret(secretARN, forceRefresh)
+    except botocore.exceptions.ClientError as err:
+        print(f"Warning: Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARN}'. {err}")
+        return None
+
+    if secret.get('username') is None or secret.get('password') is None:
+        print(f"Warning: The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARN}'.")
+        return None
+
+    return urllib3.make_headers(basic_auth=f"{secret['username']}:{secret['password']}")
+
 ################################################################################
 # This function checks that all the required configuration variables are set.
 ################################################################################
@@ -406,6 +502,7 @@ def checkConfig():
         'copyToS3': copyToS3 if 'copyToS3' in globals() else None,                     # pylint: disable=E0602
         'maxRunTime': maxRunTime if 'maxRunTime' in globals() else None,               # pylint: disable=E0602
         'preserveOldEvents': preserveOldEvents if 'preserveOldEvents' in globals() else None,     # pylint: disable=E0602
+        'secretCacheTTL': secretCacheTTL if 'secretCacheTTL' in globals() else None,              # pylint: disable=E0602
         'fsxnSecretARNsFile': fsxnSecretARNsFile if 'fsxnSecretARNsFile' in globals() else None,  # pylint: disable=E0602
         'defaultSecretARN': defaultSecretARN if 'defaultSecretARN' in globals() else None,        # pylint: disable=E0602
         'fileSystem1ID': fileSystem1ID if 'fileSystem1ID' in globals() else None,      # pylint: disable=E0602
@@ -419,7 +516,7 @@ def checkConfig():
         'fileSystem4SecretARN': fileSystem4SecretARN if 'fileSystem4SecretARN' in globals() else None,  # pylint: disable=E0602
         'fileSystem5SecretARN': fileSystem5SecretARN if 'fileSystem5SecretARN' in globals() else None   # pylint: disable=E0602
     }
-    optionalConfig = ['copyToS3', 'maxRunTime', 'fsxnSecretARNsFile', 'preserveOldEvents',
+    optionalConfig = ['copyToS3', 'maxRunTime', 'fsxnSecretARNsFile', 'preserveOldEvents', 'secretCacheTTL',
                       'fileSystem1ID', 'fileSystem2ID', 'fileSystem3ID', 'fileSystem4ID',
                       'fileSystem5ID', 'fileSystem1SecretARN', 'fileSystem2SecretARN', 'defaultSecretARN',
                       'fileSystem3SecretARN', 'fileSystem4SecretARN', 'fileSystem5SecretARN']
@@ -450,6 +547,8 @@ def checkConfig():
         if int(config['maxRunTime']) < 6:
             raise Exception("maxRunTime must be more than 6 seconds.")
         config['maxRunTime'] = int(config['maxRunTime']) - 5
+
+    config['secretCacheTTL'] = 300 if config['secretCacheTTL'] is None else int(config['secretCacheTTL'])
     #
     # To be backwards compatible, load the vserverName.
     config['vserverName'] = vserverName if 'vserverName' in globals() else os.environ.get('vserverName')  # pylint: disable=E0602
@@ -467,20 +566,7 @@ def checkConfig():
     #
     # If the fsxnSecretARNsFile is set, then read the file from S3 and populate the secretARNs dictionary.
     if config['fsxnSecretARNsFile'] is not None and config['fsxnSecretARNsFile'] != '':
-        try:
-            response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['fsxnSecretARNsFile'])
-        except botocore.exceptions.ClientError as err:
-            raise Exception(f"Unable to open parameter file with secrets '{config['fsxnSecretARNsFile']}' from S3 bucket '{config['s3BucketName']}': {err}")
-        else:
-            for line in response['Body'].iter_lines():
-                line = line.decode('utf-8')
-                line = line.strip()
-                if line.startswith('#'):
-                    continue
-                if line == '':
-                    continue
-                fsId, secretArn = line.split('=')
-                secretARNs[fsId.strip()] = secretArn.strip()
+        readSecretARNsFile()
     else:
         if config['fileSystem1ID'] is not None and config['fileSystem1SecretARN'] is not None:
             secretARNs[config['fileSystem1ID']] = config['fileSystem1SecretARN']
@@ -509,9 +595,6 @@ def lambda_handler(event, context):     # pylint: disable=W0613
     # Check that we have all the configuration variables we need.
     checkConfig()
     #
-    # Create a Secrets Manager client.
-    session = boto3.session.Session()
-    #
     # Create a S3 client.
     # Created in the checkCofnig function.
     # s3Client = boto3.client('s3', config['s3BucketRegion'])
@@ -566,36 +649,36 @@ def lambda_handler(event, context):     # pylint: disable=W0613
         if secretARNs.get(fsId) is None and config['defaultSecretARN'] is not None:
             secretARNs[fsId] = config['defaultSecretARN']
 
-        if secretARNs.get(fsId) is not None:
-            #
-            # Get the username and password of the ONTAP/FSxN system.
-            try:
-                secretsClient = session.client(service_name='secretsmanager', region_name=secretARNs[fsId].split(':')[3])
-                secretsInfo = secretsClient.get_secret_value(SecretId=secretARNs[fsId])
-                secret = json.loads(secretsInfo['SecretString'])
-                if secret.get('username') is None or secret.get('password') is None:
-                    print(f"Warning: The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARNs[fsId]}'.")
-                    continue # To the next FSxN
-                username = secret['username']
-                password = secret['password']
-                secretsClient.close()  # Since the next secret could be in a different region.
-            except botocore.exceptions.ClientError as err:
-                print(f"Warning: Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARNs[fsId]}'. {err}")
-                continue # To the next FSxN
-        else:
+        if secretARNs.get(fsId) is None:
             print(f'Warning: No secret ARN was found for {fsId}.')
             continue # To the next FSxN
         #
-        # Create a header with the basic authentication.
-        auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+        # Create a header with the basic authentication. The credentials are cached, so
+        # Secrets Manager isn't called for every FSxN on every run.
+        auth = getAuthHeader(fsId, secretARNs[fsId])
+        if auth is None:
+            continue # To the next FSxN
         headersDownload = { **auth, 'Accept': 'multipart/form-data' }
         headersQuery = { **auth }
         #
         # Loop through all of SVMs on the FSxN.
         endpoint = f"/api/svm/svms?return_timeout=4"
+        refreshedCredentials = False
         while endpoint is not None:
             try:
                 response = http.request('GET', f"https://{fsxn}{endpoint}", headers=headersQuery, timeout=5.0)
+                #
+                # If the credentials were rejected, they might have been changed since they were
+                # cached, so get them from Secrets Manager again, and retry once.
+                if response.status == 401 and not refreshedCredentials:
+                    refreshedCredentials = True
+                    print(f"Info: The credentials were rejected by {fsxn}, reading them from '{secretARNs[fsId]}' again.")
+                    auth = getAuthHeader(fsId, secretARNs[fsId], forceRefresh=True)
+                    if auth is None:
+                        break # To the next FSxN
+                    headersDownload = { **auth, 'Accept': 'multipart/form-data' }
+                    headersQuery = { **auth }
+                    continue # Retry the same endpoint.
                 if response.status == 200:
                     svmsData = json.loads(response.data.decode('utf-8'))
                     for record in svmsData['records']:
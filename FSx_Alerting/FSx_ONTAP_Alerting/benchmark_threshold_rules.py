@@ -0,0 +1,323 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program benchmarks the column based evaluation of the threshold rules
+# in monitor_ontap_services.py against the per record loops they replaced.
+# It generates synthetic records, runs both against the same rules, checks
+# that they produce the same alerts, and reports how long each took. Only the
+# evaluation is timed, no API calls are made and no alerts are sent.
+#
+# Usage: python3 benchmark_threshold_rules.py [--volumes N] [--quotas N] [--repeat N]
+#
+# The results are printed and appended to bench_output.txt at the top of the
+# repository. If NumPy is installed, both the NumPy and the array.array()
+# fallback paths are measured.
+################################################################################
+
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+#
+# Keep monitor_ontap_services from running its checks when it is imported.
+os.environ.setdefault("AWS_LAMBDA_FUNCTION_NAME", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import monitor_ontap_services as monitor
+
+clusterName = "benchmark"
+monitor.clusterName = clusterName
+outputFilename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bench_output.txt")
+
+################################################################################
+# This exception is raised when the column evaluation of the rules doesn't
+# produce the same alerts as the per record loops.
+################################################################################
+class BenchmarkMismatchError(Exception):
+    """The column evaluation produced different alerts than the loops."""
+
+################################################################################
+# This function returns the synthetic aggregate and volume records. About one
+# in twenty volumes is offline, so it doesn't have the space or files fields.
+################################################################################
+def buildStorageRecords(numVolumes, seed):
+
+    rand = random.Random(seed)
+    aggrRecords = []
+    for i in range(max(1, numVolumes // 1000)):
+        aggrRecords.append({"uuid": f"aggr-{i}", "name": f"aggr{i}", "space": {"block_storage": {"used_percent": rand.randint(0, 100)}}})
+
+    volumeRecords = []
+    for i in range(numVolumes):
+        record = {"uuid": f"vol-{i}", "name": f"vol{i}", "svm": {"name": f"svm{i % 20}"}, "style": "flexvol", "flexcache_endpoint_type": "none"}
+        if rand.random() < 0.05:
+            record["state"] = "offline"
+            record["space"] = {}
+        else:
+            record["state"] = "online"
+            record["space"] = {"percent_used": rand.randint(0, 100), "snapshot": {"used": rand.randint(0, 1000), "reserve_size": rand.choice([0, 1000])}}
+            record["files"] = {"maximum": 10000, "used": rand.randint(0, 10000)}
+        volumeRecords.append(record)
+    return (aggrRecords, volumeRecords)
+
+################################################################################
+# This function evaluates the percent based storage rules the way
+# processStorageUtilization() used to, looping over every rule and every
+# record. It returns the list of alert messages.
+################################################################################
+def storageLoops(aggrRecords, volumeRecords, rules):
+
+    messages = []
+    for rule in rules:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey == "aggrwarnpercentused" or lkey == 'aggrcriticalpercentused':
+                for aggr in aggrRecords:
+                    if aggr["space"]["block_storage"]["used_percent"] >= rule[key]:
+                        alertType = 'Warning' if lkey == "aggrwarnpercentused" else 'Critical'
+                        messages.append(f'Aggregate {alertType} Alert: Aggregate {aggr["name"]} on {clusterName} is {aggr["space"]["block_storage"]["used_percent"]}% full, which is more or equal to {rule[key]}% full.')
+
+            elif lkey == "volumewarnpercentused" or lkey == "volumecriticalpercentused":
+                for record in volumeRecords:
+                    if record["space"].get("percent_used"):
+                        if record["space"]["percent_used"] >= rule[key]:
+                            alertType = 'Warning' if lkey == "volumewarnpercentused" else 'Critical'
+                            messages.append(f'Volume Usage {alertType} Alert: volume {record["svm"]["name"]}:{record["name"]} on {clusterName} is {record["space"]["percent_used"]}% full, which is more or equal to {rule[key]}% full.')
+
+            elif lkey == "volumewarnfilespercentused" or lkey == "volumecriticalfilespercentused":
+                for record in volumeRecords:
+                    if record.get("files") is not None:
+                        maxFiles = record["files"].get("maximum")
+                        usedFiles = record["files"].get("used")
+                        if maxFiles != None and usedFiles != None:
+                            percentUsed = (usedFiles / maxFiles) * 100
+                            if percentUsed >= rule[key]:
+                                alertType = 'Warning' if lkey == "volumewarnfilespercentused" else 'Critical'
+                                messages.append(f"Volume File (inode) Usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is using {percentUsed:.0f}% of its inodes, which is more or equal to {rule[key]}% utilization.")
+
+            elif lkey == "volumewarnsnapreservepercentused" or lkey == "volumecriticalsnapreservepercentused":
+                for record in volumeRecords:
+                    if record.get("space") is not None and record["space"].get("snapshot") is not None and record["space"]["snapshot"].get("used") is not None and record["space"]["snapshot"].get("reserve_size") is not None and record["space"]["snapshot"]["reserve_size"] > 0:
+                        reserveSize = record["space"]["snapshot"]["reserve_size"]
+                        reserveAvailable = reserveSize - record["space"]["snapshot"]["used"]
+                        percentUsed = ((reserveSize - reserveAvailable) / reserveSize) * 100
+                        if percentUsed >= rule[key]:
+                            alertType = 'Warning' if lkey == "volumewarnsnapreservepercentused" else 'Critical'
+                            messages.append(f"Volume snapshot reserve usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is using {percentUsed:.0f}% of its snap reserve space, which is more or equal to {rule[key]}% utilization.")
+    return messages
+
+################################################################################
+# This function evaluates the percent based storage rules the way
+# processStorageUtilization() does now, from the columns built by
+# buildStorageColumns() and the storageThresholdRules table. It returns the
+# list of alert messages.
+################################################################################
+def storageColumns(aggrRecords, volumeRecords, rules):
+
+    thresholdRules = []
+    for rule in rules:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey in monitor.storageThresholdRules:
+                thresholdRules.append((key, lkey, rule[key]))
+
+    messages = []
+    columns = monitor.buildStorageColumns(aggrRecords, volumeRecords)
+    records = {"aggr": aggrRecords, "volume": volumeRecords}
+    for recordType in columns:
+        for column in columns[recordType]:
+            columnRules = [thresholdRule for thresholdRule in thresholdRules if monitor.storageThresholdRules[thresholdRule[1]][0] == recordType and monitor.storageThresholdRules[thresholdRule[1]][1] == column]
+            if len(columnRules) == 0:
+                continue
+            breaches = monitor.findThresholdBreaches(columns[recordType][column], [rule[2] for rule in columnRules])
+            for ((_, lkey, threshold), recordIndexes) in zip(columnRules, breaches):
+                (_, _, alertType, messageFormat) = monitor.storageThresholdRules[lkey]
+                for recordIndex in recordIndexes:
+                    record = records[recordType][recordIndex]
+                    if column == "usedPercent":
+                        value = record["space"]["block_storage"]["used_percent"] if recordType == "aggr" else record["space"]["percent_used"]
+                    else:
+                        value = columns[recordType][column][recordIndex]
+                    messages.append(messageFormat.format(alertType=alertType, record=record, clusterName=clusterName, value=value, threshold=threshold))
+    return messages
+
+################################################################################
+# This function returns the synthetic quota report records. Like the real
+# report, the percent fields aren't set for quotas without the matching limit.
+################################################################################
+def buildQuotaRecords(numQuotas, seed):
+
+    rand = random.Random(seed)
+    records = []
+    for i in range(numQuotas):
+        record = {"index": i, "vserver": f"svm{i % 20}", "volume": f"vol{i % 500}", "quota_type": rand.choice(["user", "tree"]), "quota_target": ["user1", "user2"]}
+        for field in ["files_used_pct_soft_file_limit", "files_used_pct_file_limit"]:
+            if rand.random() < 0.5:
+                record[field] = rand.randint(0, 100)
+        for field in ["disk_used_pct_disk_limit", "disk_used_pct_soft_disk_limit"]:
+            if rand.random() < 0.7:
+                record[field] = rand.choice([0, rand.randint(0, 100)])
+        if rand.random() < 0.5:
+            record["tree"] = f"qtree{i % 50}"
+        records.append(record)
+    return (records,)
+
+################################################################################
+# This function returns the qtree and users part of a quota alert message, the
+# way processQuotaUtilization() used to build it.
+################################################################################
+def quotaLoopTarget(record):
+
+    userStr = ''
+    qtreeStr = ' '
+    if record["quota_type"] == "user":
+        users = None
+        for user in record["quota_target"]:
+            if users is None:
+                users = user
+            else:
+                users += f',{user}'
+        userStr=f'associated with user(s) "{users}" '
+    if record.get("tree") is not None:
+        qtreeStr=f' under qtree: {record["tree"]} '
+    return qtreeStr + userStr
+
+################################################################################
+# This function evaluates the quota rules the way processQuotaUtilization()
+# used to, looping over every record, rule and key. It returns the list of
+# alert messages.
+################################################################################
+def quotaLoops(records, rules):
+
+    messages = []
+    for record in records:
+        for rule in rules:
+            for key in rule.keys():
+                lkey = key.lower()
+                if lkey == "maxsoftquotainodespercentused":
+                    if(record.get("files_used_pct_soft_file_limit") is not None and record["files_used_pct_soft_file_limit"] >= rule[key]):
+                        messages.append(f'Quota Inode Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{quotaLoopTarget(record)}on {clusterName} is using {record["files_used_pct_soft_file_limit"]}% which is more than {rule[key]}% of its inodes.')
+                elif lkey == "maxquotainodespercentused" or lkey == "maxhardquotainodespercentused":
+                    if(record.get("files_used_pct_file_limit") is not None and record["files_used_pct_file_limit"] >= rule[key]):
+                        messages.append(f'Quota Inode Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{quotaLoopTarget(record)}on {clusterName} is using {record["files_used_pct_file_limit"]}% which is more than {rule[key]}% of its inodes.')
+                elif lkey == "maxhardquotaspacepercentused":
+                    if(record.get("disk_used_pct_disk_limit") and record["disk_used_pct_disk_limit"] >= rule[key]):
+                        messages.append(f'Quota Space Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{quotaLoopTarget(record)}on {clusterName} is using {record["disk_used_pct_disk_limit"]}% which is more than {rule[key]}% of its allocated space.')
+                elif lkey == "maxsoftquotaspacepercentused":
+                    if(record.get("disk_used_pct_soft_disk_limit") and record["disk_used_pct_soft_disk_limit"] >= rule[key]):
+                        messages.append(f'Quota Space Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{quotaLoopTarget(record)}on {clusterName} is using {record["disk_used_pct_soft_disk_limit"]}% which is more than {rule[key]}% of its allocated space.')
+    return messages
+
+################################################################################
+# This function evaluates the quota rules the way processQuotaUtilization()
+# does now, from the columns built by buildColumn() and the
+# quotaThresholdRules table. It returns the list of alert messages.
+################################################################################
+def quotaColumns(records, rules):
+
+    fieldRules = {}
+    for rule in rules:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey in monitor.quotaThresholdRules:
+                fieldRules.setdefault(monitor.quotaThresholdRules[lkey][0], []).append((key, lkey, rule[key]))
+
+    messages = []
+    for field, fieldRuleList in fieldRules.items():
+        column = monitor.buildColumn(records, field, monitor.quotaThresholdRules[fieldRuleList[0][1]][1])
+        breaches = monitor.findThresholdBreaches(column, [rule[2] for rule in fieldRuleList])
+        for ((_, lkey, threshold), recordIndexes) in zip(fieldRuleList, breaches):
+            messageFunction = monitor.quotaThresholdRules[lkey][2]
+            for recordIndex in recordIndexes:
+                record = records[recordIndex]
+                messages.append(messageFunction(record, monitor.quotaTargetStr(record), record[field], threshold))
+    return messages
+
+################################################################################
+# This function runs the function passed in 'repeat' times and returns the
+# fastest time, in milliseconds, along with the messages it returned.
+################################################################################
+def timeIt(function, repeat, *functionArgs):
+
+    best = None
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        messages = function(*functionArgs)
+        elapsed = (time.perf_counter() - startTime) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, messages)
+
+################################################################################
+# This function runs the loop and column versions, passed in as the
+# 'functions' tuple, against each set of rules, with and without NumPy, and
+# returns the lines of the report.
+################################################################################
+def runBenchmark(name, functions, records, ruleSets, repeat):
+
+    (loopFunction, columnFunction) = functions
+    report = []
+    numpyModule = monitor.numpy
+    for (ruleSetName, rules) in ruleSets:
+        (loopTime, loopMessages) = timeIt(loopFunction, repeat, *records, rules)
+        line = f'{name} {ruleSetName}: {len(loopMessages)} breaches, loops {loopTime:.0f} ms'
+        for (pathName, numpyPath) in [("array", None), ("NumPy", numpyModule)]:
+            if pathName == "NumPy" and numpyModule is None:
+                continue
+            monitor.numpy = numpyPath
+            (columnTime, columnMessages) = timeIt(columnFunction, repeat, *records, rules)
+            if sorted(columnMessages) != sorted(loopMessages):
+                raise BenchmarkMismatchError(f'The {pathName} column evaluation of {name} {ruleSetName} produced different alerts than the loops.')
+            line += f', {pathName} columns {columnTime:.0f} ms'
+        monitor.numpy = numpyModule
+        report.append(line)
+    return report
+
+################################################################################
+# This function parses the command line arguments, runs the benchmarks, then
+# prints the report and appends it to the output file.
+################################################################################
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the column based threshold rule evaluation against the per record loops.")
+    parser.add_argument("--volumes", type=int, default=50000, help="The number of synthetic volumes to evaluate the storage rules against.")
+    parser.add_argument("--quotas", type=int, default=200000, help="The number of synthetic quota report records to evaluate the quota rules against.")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of times to run each version. The fastest time is reported.")
+    args = parser.parse_args()
+
+    storageRuleSets = [
+        ("few breaches", [{"aggrWarnPercentUsed": 80, "aggrCriticalPercentUsed": 90}, {"volumeWarnPercentUsed": 99, "volumeCriticalPercentUsed": 100},
+                          {"volumeWarnFilesPercentUsed": 99, "volumeCriticalFilesPercentUsed": 100}, {"volumeWarnSnapReservePercentUsed": 99, "volumeCriticalSnapReservePercentUsed": 100}]),
+        ("many breaches", [{"aggrWarnPercentUsed": 80, "aggrCriticalPercentUsed": 90}, {"volumeWarnPercentUsed": 95, "volumeCriticalPercentUsed": 98},
+                           {"volumeWarnFilesPercentUsed": 95, "volumeCriticalFilesPercentUsed": 98}, {"volumeWarnSnapReservePercentUsed": 95, "volumeCriticalSnapReservePercentUsed": 98}])
+    ]
+
+    quotaRuleSets = [
+        ("few breaches", [{"maxHardQuotaSpacePercentUsed": 99, "maxSoftQuotaSpacePercentUsed": 100}, {"maxHardQuotaInodesPercentUsed": 99, "maxSoftQuotaInodesPercentUsed": 100}]),
+        ("many breaches", [{"maxHardQuotaSpacePercentUsed": 90, "maxSoftQuotaSpacePercentUsed": 80}, {"maxHardQuotaInodesPercentUsed": 90, "maxSoftQuotaInodesPercentUsed": 80}])
+    ]
+
+    report = [f'{datetime.datetime.now().isoformat(timespec="seconds")} Python {sys.version.split()[0]}, NumPy {"available" if monitor.numpy is not None else "not available"}']
+    report.extend(runBenchmark(f'storage ({args.volumes} volumes)', (storageLoops, storageColumns), buildStorageRecords(args.volumes, 1), storageRuleSets, args.repeat))
+    report.extend(runBenchmark(f'quota ({args.quotas} records)', (quotaLoops, quotaColumns), buildQuotaRecords(args.quotas, 2), quotaRuleSets, args.repeat))
+
+    for line in report:
+        print(line)
+    with open(outputFilename, "a", encoding="utf-8") as outputFile:
+        outputFile.write("\n".join(report) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -20,8 +20,18 @@ import boto3
 import botocore
 import os
 import logging
+#
+# The FSxN list rarely changes, so it is cached, along with its ETag, across
+# warm invocations of the Lambda function. It is only read again if it has
+# changed.
+FSxNListCacheKey = None   # The bucket and key the cached FSxN list was read from.
+FSxNListCacheETag = None  # The ETag of the cached FSxN list.
+FSxNListCache = []        # The cached FSxN list.
+FSxNListCacheHits = 0
+FSxNListCacheMisses = 0
 
 def lambda_handler(event, context):
+    global FSxNListCacheKey, FSxNListCacheETag, FSxNListCache, FSxNListCacheHits, FSxNListCacheMisses
     #
     # Maximum number of allowed consecutive failed invokes before sending an alert.
     maxAllowedFailures = 2
@@ -54,15 +64,28 @@ def lambda_handler(event, context):
     #
     # Read the FSxN list from S3.
     s3Client = boto3.client('s3', region_name=basePayload['s3BucketRegion'])
+    cacheKey = f"{basePayload['s3BucketName']}/{basePayload['FSxNList']}"
     try:
-        response = s3Client.get_object(Bucket=basePayload['s3BucketName'], Key=basePayload['FSxNList'])
+        if FSxNListCacheETag is not None and FSxNListCacheKey == cacheKey:
+            response = s3Client.get_object(Bucket=basePayload['s3BucketName'], Key=basePayload['FSxNList'], IfNoneMatch=FSxNListCacheETag)
+        else:
+            response = s3Client.get_object(Bucket=basePayload['s3BucketName'], Key=basePayload['FSxNList'])
         FSxNListContent = response['Body'].read().decode('utf-8')
         FSxNList = FSxNListContent.split('\n')
+        FSxNListCacheKey = cacheKey
+        FSxNListCacheETag = response.get('ETag')
+        FSxNListCache = FSxNList
+        FSxNListCacheMisses += 1
     except botocore.exceptions.ClientError as e:
-        err = f"Error, the Monitor ONTAP Service controller was unable to fetching FSxN list from S3: {e}"
-        logger.error(err)
-        snsClient.publish(TopicArn=snsTopicArn, Subject="MOS Controller Error", Message=err)
-        raise Exception(err)  # This is a critical error, so send up a flare.
+        if FSxNListCacheETag is not None and FSxNListCacheKey == cacheKey and (e.response['Error']['Code'] in ["304", "NotModified"] or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304):
+            FSxNList = FSxNListCache
+            FSxNListCacheHits += 1
+        else:
+            err = f"Error, the Monitor ONTAP Service controller was unable to fetching FSxN list from S3: {e}"
+            logger.error(err)
+            snsClient.publish(TopicArn=snsTopicArn, Subject="MOS Controller Error", Message=err)
+            raise Exception(err)  # This is a critical error, so send up a flare.
+    logger.debug(f"FSxN list cache hits={FSxNListCacheHits} misses={FSxNListCacheMisses}.")
     #
     # Invoke the monitoring Lambda function for each FSxN in the list.
     lambda_client = boto3.client('lambda')
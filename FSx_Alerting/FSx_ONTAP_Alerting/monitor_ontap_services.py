@@ -22,21 +22,41 @@
 # Date: %%DATE%%
 ################################################################################
 
+import time
+importStartTime = time.perf_counter()
 import json
 import re
 import ipaddress
 import os
 import datetime
-import pytz
 import logging
+import logging.handlers
 from logging.handlers import SysLogHandler
-from cronsim import CronSim
+import queue
+import socket
 import urllib3
 from urllib3.util import Retry
 import botocore
 import boto3
 import hashlib
 import base64
+import array
+import concurrent.futures
+import itertools
+import heapq
+import urllib.parse
+import zlib
+try:
+    import numpy
+except ImportError:
+    numpy = None
+#
+# Since the modules are only imported once per Lambda container, this is how
+# long a cold start spent importing them. It is reported on the first run.
+# The modules that only some rules need (e.g. pytz and cronsim) aren't
+# imported here, but in the functions that use them, to keep this short.
+importSeconds = time.perf_counter() - importStartTime
+coldStart = True
 
 emsEventResilience = 200 # Times an ems event has to be missing before it is removed
                          # from the alert history.
@@ -49,6 +69,37 @@ eventResilience = 4 # Times a non-ems event has to be missing before it is remov
 initialVersion = "Initial Run"  # The version to store if this is the first
                                 # time the program has been run against a
                                 # FSxN.
+webhookRetryBaseSeconds = 60    # Seconds to wait before retrying a failed webhook.
+                                # It is doubled after each failed attempt.
+webhookRetryMaxSeconds = 60*60  # The longest time to wait between webhook retries.
+webhookSpoolMaxAgeSeconds = 60*60*24*2 # Failed webhooks older than this are dropped.
+webhookSpoolMaxEntries = 1000   # Maximum number of failed webhooks to hold on to.
+webhookSpool = None             # The failed webhooks waiting to be retried. Loaded from
+                                # webhookSpoolFilename when first needed on each run.
+webhookSpoolChanged = False     # Set when webhookSpool has to be saved at the end of the run.
+alertRateLimits = None          # The alert rate limit token buckets, per alert category. Loaded
+                                # from alertRateLimitFilename when first needed on each run.
+alertRateLimitsChanged = False  # Set when alertRateLimits has to be saved at the end of the run.
+webhookBatch = []               # The alerts held back to be sent in batches at the end of the run.
+webhookBatchMaxBytes = 1024*1024  # Maximum size of a batched webhook POST.
+healthCheckTimeout = 30.0       # Seconds to wait on each of the system health API calls.
+smThroughputSamples = 12        # Number of samples kept for each SnapMirror transfer to
+                                # calculate its throughput from.
+capacityHistorySamples = 12     # Number of used space samples kept for each volume and
+                                # aggregate to calculate their growth rate from.
+capacityHistoryIntervalSeconds = 30*60 # Minimum time between used space samples.
+capacityHistoryMinSamples = 3   # Samples needed before a growth rate is calculated.
+historyIntervalSeconds = 15*60  # Minimum time between the rows saved to the history store.
+historyChunkSeconds = 60*60*24  # Time span covered by each history store chunk.
+historySamples = {}             # The samples to be saved to the history store at the end of the run.
+hotVolumesMinChangePercent = 10 # Percent a volume has to beat a volume already in the hot volumes
+                                # list by to replace it, unless set by the hotVolumesMinChangePercent rule.
+snapshotCacheMaxAgeSeconds = 60*60*24 # Longest time a volume's cached snapshot list is used
+                                # before the snapshots are queried again.
+recordFingerprints = None       # The fingerprints of the records evaluated on the last run. Loaded
+                                # from recordFingerprintsFilename when first needed on each run.
+recordFingerprintsChanged = False # Set when recordFingerprints has to be saved at the end of the run.
+recordsSkipped = 0              # Number of unchanged records that weren't evaluated this run.
 
 ################################################################################
 # This function is used to extract a number from the string passed in, starting
@@ -139,13 +190,82 @@ def eventExist (events, uniqueIdentifier):
 
     return -1
 
+################################################################################
+# The clients to the AWS services, other than S3, keyed by the service, region
+# and endpoint. They are only created when they are first needed, and since
+# it is a module variable, they are reused across warm invocations.
+################################################################################
+awsClients = {}
+
+################################################################################
+# This function returns a client to the AWS service passed in, for the region
+# of the ARN passed in, creating it if it hasn't been created yet.
+################################################################################
+def getAwsClient(service, arn, endpointHostname):
+    region = arn.split(":")[3]
+    key = (service, region, endpointHostname)
+    if key not in awsClients:
+        awsClients[key] = boto3.client(service, region_name=region, verify=isIpHostname(endpointHostname), endpoint_url=f'https://{endpointHostname}')
+    return awsClients[key]
+
+################################################################################
+# The secrets read from Secrets Manager, keyed by the secret ARN. Each entry is
+# a tuple of the time it expires and the secret. Since it is a module variable,
+# it survives across warm invocations of the Lambda function.
+################################################################################
+secretCache = {}
+
+################################################################################
+# This function returns the secret, as a dictionary, stored in the secret ARN
+# passed in. The secret is cached for secretCacheTTL seconds, unless
+# forceRefresh is True, which is used when the cached credentials are
+# rejected.
+################################################################################
+def getSecret(secretArn, forceRefresh=False):
+    global config
+
+    curTime = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    cached = secretCache.get(secretArn)
+    if not forceRefresh and cached is not None and cached[0] > curTime:
+        return cached[1]
+
+    client = getAwsClient('secretsmanager', secretArn, config["secretsManagerEndPointHostname"])
+    secretsInfo = client.get_secret_value(SecretId=secretArn)
+    secret = json.loads(secretsInfo['SecretString'])
+    secretCache[secretArn] = (curTime + config["secretCacheTTL"], secret)
+    return secret
+
+################################################################################
+# This function sets the headers used to make the ONTAP API calls with, from
+# the credentials stored in the secretArn secret. If forceRefresh is True, the
+# credentials are read from Secrets Manager, instead of the cache. It returns
+# False if the secret doesn't have the username or password.
+################################################################################
+def setOntapHeaders(forceRefresh=False):
+    global config, headers, logger
+
+    secrets = getSecret(config["secretArn"], forceRefresh)
+    if secrets.get(config['secretUsernameKey']) is None:
+        logger.critical(f'Error, "{config["secretUsernameKey"]}" not found in secret "{config["secretArn"]}" for cluster {config["OntapAdminServer"]}.')
+        return False
+
+    if secrets.get(config['secretPasswordKey']) is None:
+        logger.critical(f'Error, "{config["secretPasswordKey"]}" not found in secret "{config["secretArn"]}" for cluster {config["OntapAdminServer"]}.')
+        return False
+
+    username = secrets[config['secretUsernameKey']]
+    password = secrets[config['secretPasswordKey']]
+    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+    headers = { **auth }
+    return True
+
 ################################################################################
 # This function makes an API call to the FSxN to ensure it is up. If the
 # errors out, then it sends an alert, and returns 'False'. Otherwise it returns
 # 'True'.
 ################################################################################
 def checkSystem():
-    global config, s3Client, http, headers, clusterName, clusterVersion, logger, clusterTimezone
+    global config, s3Client, http, headers, clusterName, clusterVersion, logger, clusterTimezone, systemStatus
 
     alertCategory = "System Health Alert"
     changedEvents = False
@@ -180,6 +300,14 @@ def checkSystem():
     try:
         endpoint = f'https://{config["OntapAdminServer"]}/api/cluster?fields=version,name,timezone'
         response = http.request('GET', endpoint, headers=headers, timeout=5.0)
+        #
+        # If the credentials were rejected, they might have been changed since they were cached, so
+        # get them from Secrets Manager again, and retry. Since this is the first API call made, all
+        # the others will use the new credentials.
+        if response.status == 401:
+            logger.info(f'The credentials were rejected by {config["OntapAdminServer"]}, reading them from "{config["secretArn"]}" again.')
+            if setOntapHeaders(forceRefresh=True):
+                response = http.request('GET', endpoint, headers=headers, timeout=5.0)
         if response.status == 200:
             if fsxStatus["systemHealth"] != 0:
                 fsxStatus["systemHealth"] = 0
@@ -225,8 +353,12 @@ def checkSystem():
             changedEvents = True
 
     if changedEvents:
+        spoolWebHookBatch()
         s3Client.put_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"], Body=json.dumps(fsxStatus).encode('UTF-8'))
     #
+    # Hold on to the status so checkSystemHealth() doesn't have to read it back in.
+    systemStatus = fsxStatus
+    #
     # If the cluster is done, return false so the program can exit cleanly.
     return fsxStatus["systemHealth"] == 0
 
@@ -235,21 +367,46 @@ def checkSystem():
 #   o If the ONTAP version has changed.
 #   o If one of the nodes are down.
 #   o If a network interface is down.
+#   o If a FRU isn't "ok".
+#   o If a disk is broken.
+#
+# The API calls needed by the enabled checks are all issued concurrently
+# before any of the checks are done. The one only needed for an FSxN is
+# issued on its own the first time the cluster doesn't report any nodes.
 #
 # ASSUMPTIONS: That checkSystem() has been called before it.
 ################################################################################
 def checkSystemHealth(service):
-    global config, s3Client, http, headers, clusterName, clusterVersion, logger, requestFailed
+    global config, s3Client, clusterName, clusterVersion, logger, requestFailed, systemStatus
 
     alertCategory = "System Health Alert"
     changedEvents = False
     #
-    # Get the previous status.
-    # Shouldn't have to check for status of the get_object() call, to see if the object exist or not,
-    # since "checkSystem()" should already have been called and it creates the object if it doesn't
-    # already exist. So, if there is a failure, it should be something else than "non-existent".
-    data = s3Client.get_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"])
-    fsxStatus = json.loads(data["Body"].read().decode('UTF-8'))
+    # Get the previous status. checkSystem() has already read it in, or
+    # created it if it didn't exist.
+    fsxStatus = systemStatus
+    #
+    # Figure out which API calls the enabled checks need and issue them concurrently.
+    vmInstancesUrl = '/api/private/cli/system/node/virtual-machine/instance/show-settings'
+    healthRequests = {}
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower()
+            if rule[key]:
+                if lkey == "failover":
+                    healthRequests["nodes"] = ('/api/cluster/nodes?fields=state', False)
+                    #
+                    # This is only used if the cluster doesn't report any nodes (i.e. it is an FSxN), so
+                    # only issue it with the others if that was the case on the previous run.
+                    if fsxStatus.get("useVmInstances"):
+                        healthRequests["vmInstances"] = (vmInstancesUrl, True)
+                elif lkey == "networkinterfaces":
+                    healthRequests["interfaces"] = ('/api/network/ip/interfaces?fields=state,svm,scope', False)
+                elif lkey == "frus":
+                    healthRequests["frus"] = ('/api/private/cli/system/chassis/fru?fields=node,name,monitor,serial-number,state,model,fru-name,status,type,display-name', True)
+                elif lkey == "disks":
+                    healthRequests["disks"] = ('/api/storage/disks?fields=state,error,name,serial_number,outage', True)
+    results = dict(zip(healthRequests.keys(), getAllRecordsConcurrently(list(healthRequests.values()), healthCheckTimeout)))
 
     for rule in service["rules"]:
         for key in rule.keys():
@@ -264,9 +421,8 @@ def checkSystemHealth(service):
                 #
                 # Check that all nodes are available.
                 if rule[key]:
-                    endpoint = f'https://{config["OntapAdminServer"]}/api/cluster/nodes?fields=state'
-                    response = http.request('GET', endpoint, headers=headers)
-                    if response.status == 200:
+                    (records, requestFailed) = results["nodes"]
+                    if not requestFailed:
                         #
                         # For backwards compatibility with the previous version of the fsxStatus structure, if the "downNodes" key doesn't exist, add it.
                         if fsxStatus.get("downNodes") is not None:
@@ -276,14 +432,15 @@ def checkSystemHealth(service):
                             fsxStatus["downNodes"] = []
                             changedEvents = True
 
-                        data = json.loads(response.data)
-                        if data["num_records"] != 0:
+                        if len(records) != 0:
+                            if fsxStatus.pop("useVmInstances", None) is not None:
+                                changedEvents = True
                             #
                             # The numberNodes field isn't used for non-FSxN clusters, but it would be confusing if it wasn't correct, so update it if it is wrong.
-                            if fsxStatus["numberNodes"] != data["num_records"]:
-                                fsxStatus["numberNodes"] = data["num_records"]
+                            if fsxStatus["numberNodes"] != len(records):
+                                fsxStatus["numberNodes"] = len(records)
                                 changedEvents = True
-                            for node in data["records"]:
+                            for node in records:
                                 if node.get("state") != "up":
                                     uniqueIdentifier = node["name"]
                                     eventIndex = eventExist(fsxStatus["downNodes"], uniqueIdentifier)
@@ -319,22 +476,24 @@ def checkSystemHealth(service):
                         else:
                             # If the number of records from the cluster/nodes API is 0, assume we are monitoring
                             # an FSxN, so get the information from the virtual-machine instance show-settings API.
-                            endpoint = f'https://{config["OntapAdminServer"]}/api/private/cli/system/node/virtual-machine/instance/show-settings'
-                            response = http.request('GET', endpoint, headers=headers)
-                            if response.status == 200:
-                                data = json.loads(response.data)
-                                if data["num_records"] != fsxStatus["numberNodes"]:
-                                    message = f'Alert: The number of nodes in cluster {clusterName} went from {fsxStatus["numberNodes"]} to {data["num_records"]}.\nNote, this is likely a planned failover event to upgrade the O/S, or to change the throughput capacity.'
+                            # Remember that, so it is issued along with the other API calls on the next run.
+                            if not fsxStatus.get("useVmInstances"):
+                                fsxStatus["useVmInstances"] = True
+                                changedEvents = True
+                            if "vmInstances" not in results:
+                                results["vmInstances"] = fetchAllRecords(vmInstancesUrl, True, healthCheckTimeout)
+                            (vmRecords, vmRequestFailed) = results["vmInstances"]
+                            if not vmRequestFailed:
+                                if len(vmRecords) != fsxStatus["numberNodes"]:
+                                    message = f'Alert: The number of nodes in cluster {clusterName} went from {fsxStatus["numberNodes"]} to {len(vmRecords)}.\nNote, this is likely a planned failover event to upgrade the O/S, or to change the throughput capacity.'
                                     sendAlert(message, "INFO", alertCategory)
-                                    fsxStatus["numberNodes"] = data["num_records"]
+                                    fsxStatus["numberNodes"] = len(vmRecords)
                                     changedEvents = True
                             else:
-                                logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
-                    else:
-                        logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+                                logger.warning(f'API call to get the virtual machine instances from cluster {clusterName} failed.')
             elif lkey == "networkinterfaces":
                 if rule[key]:
-                    records = getAllRecords('/api/network/ip/interfaces?fields=state,svm,scope')
+                    (records, requestFailed) = results["interfaces"]
                     logger.info(f'Received {len(records)} network interface records from cluster {clusterName}. requestFailed={requestFailed}.')
                     if not requestFailed:
                         #
@@ -381,7 +540,7 @@ def checkSystemHealth(service):
                             i -= 1
             elif lkey == "frus":
                 if rule[key]:
-                    records = getAllRecords('/api/private/cli/system/chassis/fru?fields=node,name,monitor,serial-number,state,model,fru-name,status,type,display-name', True)
+                    (records, requestFailed) = results["frus"]
                     logger.info(f'Received {len(records)} FRU records from cluster {clusterName}. requestFailed={requestFailed}.')
                     if not requestFailed:
                         #
@@ -428,7 +587,7 @@ def checkSystemHealth(service):
                             i -= 1
             elif lkey == "disks":
                 if rule[key]:
-                    records = getAllRecords('/api/storage/disks?fields=state,error,name,serial_number,outage', True)
+                    (records, requestFailed) = results["disks"]
                     logger.info(f'Received {len(records)} disk records from cluster {clusterName}. requestFailed={requestFailed}.')
                     if not requestFailed:
                         #
@@ -478,10 +637,33 @@ def checkSystemHealth(service):
                 logger.warning(f'Unknown System Health alert type: "{key}" found on cluster {clusterName}.')
 
     if changedEvents:
+        spoolWebHookBatch()
         s3Client.put_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"], Body=json.dumps(fsxStatus).encode('UTF-8'))
 
 ################################################################################
-# This function processes the EMS events.
+# This function sends an EMS alert, mapping the EMS severity to the alert
+# severity.
+################################################################################
+def sendEMSAlert(message, emsSeverity, alertCategory):
+    useverity = emsSeverity.upper()
+    if useverity == "EMERGENCY":
+        sendAlert(message, "CRITICAL", alertCategory)
+    elif useverity == "ALERT":
+        sendAlert(message, "ERROR", alertCategory)
+    elif useverity == "ERROR":
+        sendAlert(message, "WARNING", alertCategory)
+    elif useverity == "NOTICE" or useverity == "INFORMATIONAL":
+        sendAlert(message, "INFO", alertCategory)
+    elif useverity == "DEBUG":
+        sendAlert(message, "DEBUG", alertCategory)
+    else:
+        sendAlert(f'Received unknown severity from ONTAP "{emsSeverity}". The message received is next.', "INFO", alertCategory)
+        sendAlert(message, "INFO", alertCategory)
+
+################################################################################
+# This function processes the EMS events. Events that match a rule with the
+# "aggregate" key set to true are grouped by name and severity, and a single
+# alert is sent for each group instead of one for each event.
 ################################################################################
 def processEMSEvents(service):
     global config, s3Client, http, headers, clusterName, logger
@@ -501,6 +683,14 @@ def processEMSEvents(service):
     else:
         events = json.loads(data["Body"].read().decode('UTF-8'))
     #
+    # The saved state is the list of events that have been alerted on. If there are any groups of
+    # aggregated events, it is a dictionary of that list and the state of each group instead.
+    if isinstance(events, dict):
+        aggregateState = events.get("aggregates", {})
+        events = events.get("events", [])
+    else:
+        aggregateState = {}
+    #
     # Decrement the refresh field to know if any records have really gone away.
     for event in events:
         event["refresh"] -= 1
@@ -526,54 +716,103 @@ def processEMSEvents(service):
     # Process the events to see if there are any new ones.
     print(f'Received {len(records)} EMS records.')
     logger.info(f'Received {len(records)} EMS records from cluster {clusterName}.')
+    aggregates = {}
     for record in records:
         if record.get("log_message") is None or record.get("index") is None or record.get("message") is None or record["message"].get("name") is None or record["message"].get("severity") is None:
-            logger.debug(f'Skipping incomplete EMS record: {json.dumps(record)}')
+            logger.debug('Skipping incomplete EMS record: %s', record)  # Let the logger format it, only if debug is enabled.
             continue
-        for rule in service["rules"]:
-            messageFilter = rule.get("filter")
-            if messageFilter == None or messageFilter == "":
-                messageFilter = "ThisShouldn'tMatchAnything"
-
-            if (not re.search(messageFilter, record["log_message"]) and
-                re.search(rule.get("name", ""), record["message"]["name"]) and
-                re.search(rule.get("severity", ""), record["message"]["severity"]) and
-                re.search(rule.get("message", ""), record["log_message"])):
-                eventIndex = eventExist (events, record["index"])
-                if eventIndex < 0:
-                    message = f'{record["time"]} : {clusterName} {record["message"]["name"]}({record["message"]["severity"]}) - {record["log_message"]}'
-                    useverity=record["message"]["severity"].upper()
-                    if useverity == "EMERGENCY":
-                        sendAlert(message, "CRITICAL", alertCategory)
-                    elif useverity == "ALERT":
-                        sendAlert(message, "ERROR", alertCategory)
-                    elif useverity == "ERROR":
-                        sendAlert(message, "WARNING", alertCategory)
-                    elif useverity == "NOTICE" or useverity == "INFORMATIONAL":
-                        sendAlert(message, "INFO", alertCategory)
-                    elif useverity == "DEBUG":
-                        sendAlert(message, "DEBUG", alertCategory)
-                    else:
-                        sendAlert(f'Received unknown severity from ONTAP "{record["message"]["severity"]}". The message received is next.', "INFO", alertCategory)
-                        sendAlert(message, "INFO", alertCategory)
+        #
+        # Find out if any of the rules match. If any of the matching rules
+        # want the events aggregated, the event isn't alerted on by itself.
+        matched = False
+        aggregate = False
+        for (nameRegex, severityRegex, messageRegex, filterRegex, aggregateRule) in service["emsRules"]:
+            if ((filterRegex is None or not filterRegex.search(record["log_message"])) and
+                nameRegex.search(record["message"]["name"]) and
+                severityRegex.search(record["message"]["severity"]) and
+                messageRegex.search(record["log_message"])):
+                matched = True
+                if aggregateRule:
+                    aggregate = True
+                    break
 
-                    changedEvents = True
-                    event = {
-                            "index": record["index"],
-                            "time": record["time"],
-                            "messageName": record["message"]["name"],
-                            "message": record["log_message"],
-                            "refresh": emsEventResilience
-                            }
-                    events.append(event)
-                else:
-                    #
-                    # If the event was found, reset the refresh count. If it is just one less
-                    # than the max, then it means it was decremented above so there wasn't
-                    # really a change in state.
-                    if events[eventIndex]["refresh"] != (emsEventResilience - 1):
-                        changedEvents = True
-                    events[eventIndex]["refresh"] = emsEventResilience
+        if not matched:
+            continue
+
+        if aggregate:
+            #
+            # Group the events by their name and severity. They are processed after all the records have been read.
+            aggregateKey = f'aggregate_{record["message"]["name"]}_{record["message"]["severity"]}'
+            if aggregates.get(aggregateKey) is None:
+                aggregates[aggregateKey] = []
+            aggregates[aggregateKey].append(record)
+            continue
+
+        eventIndex = eventExist (events, record["index"])
+        if eventIndex < 0:
+            message = f'{record["time"]} : {clusterName} {record["message"]["name"]}({record["message"]["severity"]}) - {record["log_message"]}'
+            sendEMSAlert(message, record["message"]["severity"], alertCategory)
+            changedEvents = True
+            event = {
+                    "index": record["index"],
+                    "time": record["time"],
+                    "messageName": record["message"]["name"],
+                    "message": record["log_message"],
+                    "refresh": emsEventResilience
+                    }
+            events.append(event)
+        else:
+            #
+            # If the event was found, reset the refresh count. If it is just one less
+            # than the max, then it means it was decremented above so there wasn't
+            # really a change in state.
+            if events[eventIndex]["refresh"] != (emsEventResilience - 1):
+                changedEvents = True
+            events[eventIndex]["refresh"] = emsEventResilience
+    #
+    # Process the aggregated events. Instead of keeping track of every event, only the
+    # highest EMS index that has been alerted on, and a count, is kept for each group.
+    # Since the EMS index always increases, any event with a higher index is new.
+    for aggregateKey, groupRecords in aggregates.items():
+        state = aggregateState.get(aggregateKey)
+        if state is None:
+            state = {
+                "messageName": groupRecords[0]["message"]["name"],
+                "lastIndex": -1,
+                "count": 0
+            }
+            aggregateState[aggregateKey] = state
+
+        newRecords = [record for record in groupRecords if record["index"] > state["lastIndex"]]
+        if len(newRecords) == 0:
+            continue
+
+        newRecords.sort(key=lambda record: record["index"])
+        first = newRecords[0]
+        last = newRecords[-1]
+        if len(newRecords) == 1:
+            message = f'{first["time"]} : {clusterName} {first["message"]["name"]}({first["message"]["severity"]}) - {first["log_message"]}'
+        else:
+            message = f'{clusterName} {first["message"]["name"]}({first["message"]["severity"]}) occurred {len(newRecords)} times between {first["time"]} and {last["time"]}. Some of the messages:'
+            for record in newRecords[:3]:
+                message += f'\n{record["time"]} : {record["log_message"]}'
+        sendEMSAlert(message, first["message"]["severity"], alertCategory)
+        state["lastIndex"] = last["index"]
+        state["count"] += len(newRecords)
+        state["time"] = last["time"]
+        state["message"] = last["log_message"]
+        changedEvents = True
+    #
+    # A group's state is only needed while the events it has alerted on are still being returned.
+    # Once the oldest event returned is newer than the last one alerted on, every event in the
+    # group is new anyway, so the state can be forgotten without any event being alerted on twice.
+    indexes = [record["index"] for record in records if record.get("index") is not None]
+    if len(indexes) > 0:
+        oldestIndex = min(indexes)
+        for aggregateKey in [aggregateKey for aggregateKey, state in aggregateState.items() if state["lastIndex"] < oldestIndex]:
+            logger.debug(f'Deleting aggregated event state: {aggregateKey} Cluster={clusterName}')
+            del aggregateState[aggregateKey]
+            changedEvents = True
     #
     # Now that we have processed all the events, check to see if any events should be deleted.
     i = len(events) - 1
@@ -590,19 +829,59 @@ def processEMSEvents(service):
     #
     # If the events array changed, save it.
     if changedEvents:
-        s3Client.put_object(Key=config["emsEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+        emsState = {"events": events, "aggregates": aggregateState} if len(aggregateState) > 0 else events
+        spoolWebHookBatch()
+        s3Client.put_object(Key=config["emsEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(emsState).encode('UTF-8'))
+
+################################################################################
+# This function converts the SnapMirror transfer tracking state read from S3
+# into a dictionary keyed by the transfer UUID, where each value is a
+# [time, bytesTransferred, samples] list. The time is when bytesTransferred
+# last changed, and samples is the throughput history maintained by
+# addSample(). Older versions of this program stored it as a
+# list of dictionaries, so those are converted. Entries from the original
+# format, that didn't have a UUID, are dropped. It returns the dictionary and
+# whether it had to be converted.
+################################################################################
+def loadSMTransfers(smRelationships):
+
+    if isinstance(smRelationships, dict):
+        return (smRelationships, False)
+
+    smTransfers = {}
+    for relationship in smRelationships:
+        if relationship.get("uuid") is not None:
+            smTransfers[relationship["uuid"]] = [relationship["time"], relationship["bytesTransferred"], []]
+    return (smTransfers, True)
+
+################################################################################
+# This function adds a sample to a history of samples, like the throughput of
+# a SnapMirror transfer. The samples are stored as a flat
+# [time, value, time, value, ...] list to keep the state files small. Once
+# maxSamples samples have been collected, the oldest one is dropped for each
+# new one added.
+################################################################################
+def addSample(samples, sampleTime, value, maxSamples):
+
+    if len(samples) >= 2 and samples[-2] == sampleTime:
+        samples[-1] = value
+        return
+
+    if len(samples) >= maxSamples * 2:
+        del samples[0:2]
+    samples.extend([sampleTime, value])
 
 ################################################################################
-# This function is used to find an existing SM relationship based on the source
-# and destinatino path passed in. It returns None if one isn't found
+# This function returns the throughput, in bytes per second, of a SnapMirror
+# transfer over the samples it has. It returns None if there aren't enough
+# samples to calculate it.
 ################################################################################
-def getPreviousSMRecord(relationShips, uuid):
-    for relationship in relationShips:
-        if relationship.get('uuid') == uuid:
-            relationship['refresh'] = True
-            return(relationship)
+def getTransferRate(samples):
+
+    if len(samples) < 4 or samples[-2] <= samples[0]:
+        return None
 
-    return(None)
+    return max(samples[-1] - samples[1], 0) / (samples[-2] - samples[0])
 
 ################################################################################
 # This function will convert seconds into an ascii string of number days, hours,
@@ -646,9 +925,10 @@ def convertArrayToString(array):
 
 ################################################################################
 # This function takes a schedule dictionary and returns the last time it should
-# run. It returns the time in seconds since the UNIX epoch.
+# run, or the next time it will run if nextRun is True. It returns the time in
+# seconds since the UNIX epoch.
 ################################################################################
-def getLastRunTime(scheduleUUID):
+def getLastRunTime(scheduleUUID, nextRun=False):
     global config, http, headers, logger, clusterTimezone
 
     minutes = ""
@@ -692,11 +972,15 @@ def getLastRunTime(scheduleUUID):
         cron_expression = f"{minutes} {hours} {daysOfMonth} {months} {daysOfWeek}"
         #
         # Initialize CronSim with the cron expression and current time.
+        # They are imported here, since only the maxLagTimePercent and transferEtaPastNextUpdate
+        # rules need them.
+        import pytz
+        from cronsim import CronSim
         curTime = datetime.datetime.now(pytz.timezone(clusterTimezone) if clusterTimezone != None else datetime.timezone.utc)
         curTimeSec = curTime.timestamp()
-        it = CronSim(cron_expression, curTime, reverse=True)
+        it = CronSim(cron_expression, curTime, reverse=not nextRun)
         #
-        # Get the last run time.
+        # Get the last (or next) run time.
         lastRunTime = next(it)
         lastRunTimeSec = lastRunTime.timestamp()
         return int(lastRunTimeSec)
@@ -724,24 +1008,32 @@ def getPolicySchedule(policyUUID):
 
 ################################################################################
 # This function is used to find the last time a SnapMirror relationship should
-# have been updated. It returns the time in seconds since the UNIX epoch.
+# have been updated, or the next time it will be if nextRun is True. It returns
+# the time in seconds since the UNIX epoch, or -1 if it doesn't have a schedule.
 ################################################################################
-def getLastScheduledUpdate(record):
+def getLastScheduledUpdate(record, nextRun=False):
     #
     # First check to see if there is a schedule associated with the SM relationship.
     if record.get("transfer_schedule") is not None:
-        lastRunTime = getLastRunTime(record["transfer_schedule"]["uuid"])
+        lastRunTime = getLastRunTime(record["transfer_schedule"]["uuid"], nextRun)
     else:
         #
         # If there is no schedule at the relationship level, check to see
         # if the policy has one.
         scheduleUUID = getPolicySchedule(record["policy"]["uuid"])
         if scheduleUUID is not None:
-            lastRunTime = getLastRunTime(scheduleUUID)
+            lastRunTime = getLastRunTime(scheduleUUID, nextRun)
         else:
             lastRunTime = -1
     return lastRunTime
 
+################################################################################
+# These are the fields of the SnapMirror relationship records that the
+# "healthy" rule, and its alert message, use. They make up the fingerprint of
+# each relationship used to tell if its health has changed.
+################################################################################
+smHealthFingerprintFields = ["healthy", "unhealthy_reason", "source.path", "source.cluster.name", "destination.path"]
+
 ################################################################################
 # This function is used to check SnapMirror relationships.
 ################################################################################
@@ -762,24 +1054,69 @@ def processSnapMirrorRelationships(service):
     else:
         events = json.loads(data["Body"].read().decode('UTF-8'))
     #
-    # Get the saved SM relationships.
+    # Get the saved SM transfers.
     try:
         data = s3Client.get_object(Key=config["smRelationshipsFilename"], Bucket=config["s3BucketName"])
     except botocore.exceptions.ClientError as err:
         # If the error is that the object doesn't exist, then it will get created once an alert is sent.
         if err.response['Error']['Code'] == "NoSuchKey":
-            smRelationships = []
+            smRelationships = {}
         else:
             raise Exception(err)
     else:
         smRelationships = json.loads(data["Body"].read().decode('UTF-8'))
 
     changedEvents=False
-    updateRelationships = False
+    (smTransfers, updateRelationships) = loadSMTransfers(smRelationships)
+    #
+    # Consolidate all the rules so we can decide how to process lagtime.
+    maxLagTime = None
+    maxLagTimePercent = None
+    healthy = None
+    stalledTransferSeconds = None
+    minTransferBytesPerSecond = None
+    minTransferBytesPerSecondKey = None
+    transferEtaPastNextUpdate = False
+    transferEtaPastNextUpdateKey = None
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey == "maxlagtime":
+                maxLagTime = rule[key]
+                maxLagTimeKey = key
+            elif lkey == "maxlagtimepercent":
+                maxLagTimePercent = rule[key]
+                maxLagTimePercentKey = key
+            elif lkey == "healthy":
+                healthy = rule[key]
+                healthyKey = key
+            elif lkey == "stalledtransferseconds":
+                stalledTransferSeconds = rule[key]
+                stalledTransferSecondsKey = key
+            elif lkey == "mintransferbytespersecond":
+                minTransferBytesPerSecond = rule[key]
+                minTransferBytesPerSecondKey = key
+            elif lkey == "transferetapastnextupdate":
+                transferEtaPastNextUpdate = rule[key]
+                transferEtaPastNextUpdateKey = key
+            else:
+                logger.warning(f'Unknown snapmirror alert type: "{key}" found on cluster {clusterName}.')
+    trackTransfers = stalledTransferSeconds is not None or minTransferBytesPerSecond is not None or transferEtaPastNextUpdate
     #
-    # Run the API call to get the current state of all the snapmirror relationships.
-    records = getAllRecords('/api/snapmirror/relationships?fields=*&return_timeout=15')
+    # Run the API call to get the current state of all the snapmirror relationships. To estimate
+    # when a transfer will finish, the size of the last transfer of each relationship is needed,
+    # which is only available from the CLI, so get that at the same time.
+    smRequests = [('/api/snapmirror/relationships?fields=*&return_timeout=15', False)]
+    if transferEtaPastNextUpdate:
+        smRequests.append(('/api/private/cli/snapmirror?fields=destination-path,last-transfer-size&return_timeout=15', True))
+    results = getAllRecordsConcurrently(smRequests)
+    (records, requestFailed) = results[0]
     logger.info(f'Found {len(records)} SnapMirror relationships on cluster {clusterName}. requestFailed={requestFailed}.')
+    lastTransferSizes = {}
+    if transferEtaPastNextUpdate:
+        for relationship in results[1][0]:
+            if relationship.get("destination_path") is not None and isinstance(relationship.get("last_transfer_size"), int):
+                lastTransferSizes[relationship["destination_path"]] = relationship["last_transfer_size"]
 
     if not requestFailed:
         #
@@ -787,36 +1124,21 @@ def processSnapMirrorRelationships(service):
         for event in events:
             event["refresh"] -= 1
         #
-        # Set the refresh to False to know if any of the relationships still exist.
-        for relationship in smRelationships:
-            relationship["refresh"] = False
+        # Keep track of the transfers that are still in progress.
+        activeTransfers = set()
         #
-        # Get the current time in seconds since UNIX epoch 01/01/1970.
-        curTimeSeconds = int(datetime.datetime.now(pytz.timezone(clusterTimezone) if clusterTimezone != None else datetime.timezone.utc).timestamp())
+        # Get the current time in seconds since UNIX epoch 01/01/1970. It doesn't depend on
+        # the cluster's timezone, so pytz isn't needed.
+        curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
         #
-        # Consolidate all the rules so we can decide how to process lagtime.
-        maxLagTime = None
-        maxLagTimePercent = None
-        healthy = None
-        stalledTransferSeconds = None
-        for rule in service["rules"]:
-            for key in rule.keys():
-                lkey = key.lower()
-                if lkey == "maxlagtime":
-                    maxLagTime = rule[key]
-                    maxLagTimeKey = key
-                elif lkey == "maxlagtimepercent":
-                    maxLagTimePercent = rule[key]
-                    maxLagTimePercentKey = key
-                elif lkey == "healthy":
-                    healthy = rule[key]
-                    healthyKey = key
-                elif lkey == "stalledtransferseconds":
-                    stalledTransferSeconds = rule[key]
-                    stalledTransferSecondsKey = key
-                else:
-                    logger.warning(f'Unknown snapmirror alert type: "{key}" found on cluster {clusterName}.')
-    
+        # The "healthy" rule only needs to be evaluated against the relationships whose health has
+        # changed since the last run, or that have an active alert. The lag time and transfer rules
+        # depend on the current time, so they are evaluated against all of them.
+        healthChangedUuids = set()
+        if healthy is not None:
+            activeEvents = set(event["index"] for event in events)
+            healthChangedUuids = set(record["uuid"] for record in getChangedRecords("snapmirror", {healthyKey: healthy}, records, smHealthFingerprintFields, lambda record: record["uuid"], lambda record: record["uuid"] + "_" + healthyKey in activeEvents))
+
         for record in records:
             #
             # Since there are multiple ways to process lag time, make sure to only do it one way for each relationship.
@@ -835,6 +1157,7 @@ def processSnapMirrorRelationships(service):
             # cause a false positive.
             if record.get("lag_time") is not None and record["state"].lower() != "uninitialized":
                 lagSeconds = parseLagTime(record["lag_time"])
+                recordHistorySample("snapmirror.lag", record["uuid"], lagSeconds)
                 if maxLagTimePercent is not None:
                     lastScheduledUpdate = getLastScheduledUpdate(record)
                     if lastScheduledUpdate != -1:
@@ -888,7 +1211,7 @@ def processSnapMirrorRelationships(service):
                                 changedEvents = True
                             events[eventIndex]["refresh"] = eventResilience
     
-            if healthy is not None:
+            if healthy is not None and record["uuid"] in healthChangedUuids:
                 if not healthy and not record["healthy"]: # Report on "not healthy" and the status is "not healthy"
                     uniqueIdentifier = record["uuid"] + "_" + healthyKey
                     eventIndex = eventExist(events, uniqueIdentifier)
@@ -912,19 +1235,81 @@ def processSnapMirrorRelationships(service):
                             changedEvents = True
                         events[eventIndex]["refresh"] = eventResilience
     
-            if stalledTransferSeconds is not None:
+            if trackTransfers:
                 if record.get('transfer') is not None and record['transfer']['state'].lower() == "transferring":
                     transferUuid = record['transfer']['uuid']
                     bytesTransferred = record['transfer']['bytes_transferred']
-                    prevRec =  getPreviousSMRecord(smRelationships, transferUuid) # This reset the "refresh" field if found.
-                    if prevRec != None:
-                        timeDiff=curTimeSeconds - prevRec["time"]
-                        if prevRec['bytesTransferred'] == bytesTransferred:
-                            if timeDiff > stalledTransferSeconds:
-                                uniqueIdentifier = record['uuid'] + "_" + stalledTransferSecondsKey
+                    activeTransfers.add(transferUuid)
+                    prevRec = smTransfers.get(transferUuid)
+                    if prevRec is None:
+                        prevRec = [curTimeSeconds, bytesTransferred, []]
+                        smTransfers[transferUuid] = prevRec
+                    elif len(prevRec) < 3:  # Saved by a version that didn't keep the throughput samples.
+                        prevRec.append([])
+
+                    if prevRec[1] == bytesTransferred:
+                        if stalledTransferSeconds is not None and curTimeSeconds - prevRec[0] > stalledTransferSeconds:
+                            uniqueIdentifier = record['uuid'] + "_" + stalledTransferSecondsKey
+                            eventIndex = eventExist(events, uniqueIdentifier)
+                            if eventIndex < 0:
+                                message = f"Snapmirror transfer has stalled: {sourceClusterName}::{record['source']['path']} -> {clusterName}::{record['destination']['path']}."
+                                sendAlert(message, "WARNING", alertCategory)
+                                changedEvents=True
+                                event = {
+                                    "index": uniqueIdentifier,
+                                    "message": message,
+                                    "refresh": eventResilience
+                                }
+                                events.append(event)
+                            else:
+                                # If the event was found, reset the refresh count. If it is just one less
+                                # than the max, then it means it was decremented above so there wasn't
+                                # really a change in state.
+                                if events[eventIndex]["refresh"] != (eventResilience - 1):
+                                    changedEvents = True
+                                events[eventIndex]["refresh"] = eventResilience
+                    else:
+                        prevRec[0] = curTimeSeconds
+                        prevRec[1] = bytesTransferred
+
+                    addSample(prevRec[2], curTimeSeconds, bytesTransferred, smThroughputSamples)
+                    updateRelationships = True
+                    bytesPerSecond = getTransferRate(prevRec[2])
+                    if bytesPerSecond is not None:
+                        #
+                        # A transfer that isn't moving at all is reported by the stalled transfer rule, if it is enabled.
+                        if minTransferBytesPerSecond is not None and bytesPerSecond < minTransferBytesPerSecond and (bytesPerSecond > 0 or stalledTransferSeconds is None):
+                            uniqueIdentifier = record['uuid'] + "_" + minTransferBytesPerSecondKey
+                            eventIndex = eventExist(events, uniqueIdentifier)
+                            if eventIndex < 0:
+                                message = f"Snapmirror Throughput Alert: {sourceClusterName}::{record['source']['path']} -> {clusterName}::{record['destination']['path']} is transferring at {int(bytesPerSecond)} bytes per second, which is less than {minTransferBytesPerSecond}."
+                                sendAlert(message, "WARNING", alertCategory)
+                                changedEvents=True
+                                event = {
+                                    "index": uniqueIdentifier,
+                                    "message": message,
+                                    "refresh": eventResilience
+                                }
+                                events.append(event)
+                            else:
+                                # If the event was found, reset the refresh count. If it is just one less
+                                # than the max, then it means it was decremented above so there wasn't
+                                # really a change in state.
+                                if events[eventIndex]["refresh"] != (eventResilience - 1):
+                                    changedEvents = True
+                                events[eventIndex]["refresh"] = eventResilience
+                        #
+                        # Estimate when the transfer will finish, assuming it is the same size as the last one.
+                        expectedBytes = lastTransferSizes.get(record['destination']['path'])
+                        if transferEtaPastNextUpdate and expectedBytes is not None and expectedBytes > bytesTransferred and bytesPerSecond > 0:
+                            etaSeconds = int((expectedBytes - bytesTransferred) / bytesPerSecond)
+                            nextScheduledUpdate = getLastScheduledUpdate(record, nextRun=True)
+                            if nextScheduledUpdate != -1 and curTimeSeconds + etaSeconds > nextScheduledUpdate:
+                                uniqueIdentifier = record['uuid'] + "_" + transferEtaPastNextUpdateKey
                                 eventIndex = eventExist(events, uniqueIdentifier)
                                 if eventIndex < 0:
-                                    message = f"Snapmirror transfer has stalled: {sourceClusterName}::{record['source']['path']} -> {clusterName}::{record['destination']['path']}."
+                                    asciiTime = datetime.datetime.fromtimestamp(nextScheduledUpdate).strftime('%Y-%m-%d %H:%M:%S')
+                                    message = f"Snapmirror Throughput Alert: {sourceClusterName}::{record['source']['path']} -> {clusterName}::{record['destination']['path']} is transferring at {int(bytesPerSecond)} bytes per second and is estimated to finish in {lagTimeStr(etaSeconds)}, which is after its next scheduled update at {asciiTime}."
                                     sendAlert(message, "WARNING", alertCategory)
                                     changedEvents=True
                                     event = {
@@ -940,39 +1325,16 @@ def processSnapMirrorRelationships(service):
                                     if events[eventIndex]["refresh"] != (eventResilience - 1):
                                         changedEvents = True
                                     events[eventIndex]["refresh"] = eventResilience
-                        else:
-                            prevRec['time'] = curTimeSeconds
-                            prevRec['refresh'] = True
-                            prevRec['bytesTransferred'] = bytesTransferred
-                            updateRelationships = True
-                    else:
-                        prevRec = {
-                            "time": curTimeSeconds,
-                            "refresh": True,
-                            "bytesTransferred": bytesTransferred,
-                            "uuid": transferUuid
-                        }
-                        updateRelationships = True
-                        smRelationships.append(prevRec)
         #
-        # After processing the records, see if any SM relationships need to be removed.
-        i = len(smRelationships) - 1
-        while i >= 0:
-            if not smRelationships[i]["refresh"]:
-                relationshipId = smRelationships[i].get("uuid")
-                if relationshipId is None:
-                    tmpId = "Old format"
-                else:
-                    tmpId = relationshipId
-                logger.debug(f'Deleting smRelationship: {tmpId} cluster={clusterName}')
-                del smRelationships[i]
-                updateRelationships = True
-    
-            i -= 1
+        # After processing the records, remove any transfers that are no longer in progress.
+        for transferUuid in [uuid for uuid in smTransfers if uuid not in activeTransfers]:
+            logger.debug(f'Deleting smRelationship: {transferUuid} cluster={clusterName}')
+            del smTransfers[transferUuid]
+            updateRelationships = True
         #
-        # If any of the SM relationships changed, save it.
+        # If any of the SM transfers changed, save them.
         if(updateRelationships):
-            s3Client.put_object(Key=config["smRelationshipsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(smRelationships).encode('UTF-8'))
+            s3Client.put_object(Key=config["smRelationshipsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(smTransfers, separators=(',', ':')).encode('UTF-8'))
         #
         # After processing the records, see if any events need to be removed.
         i = len(events) - 1
@@ -989,6 +1351,7 @@ def processSnapMirrorRelationships(service):
         #
         # If the events array changed, save it.
         if(changedEvents):
+            spoolWebHookBatch()
             s3Client.put_object(Key=config["smEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
 
 ################################################################################
@@ -999,13 +1362,32 @@ def processSnapMirrorRelationships(service):
 # the caller.
 ################################################################################
 def getAllRecords(url, ignoreErrors=False):
-    global config, http, headers, logger, requestFailed
+    global requestFailed
+
+    (records, requestFailed) = fetchAllRecords(url, ignoreErrors)
+    return records
+
+################################################################################
+# This function does the work for getAllRecords(). Instead of setting the
+# global requestFailed variable, it returns a tuple of the records and whether
+# the request failed, so it can safely be called from multiple threads. If a
+# timeout is given, each of the API calls is limited to it.
+################################################################################
+def fetchAllRecords(url, ignoreErrors=False, timeout=None):
+    global config, http, headers, logger
 
     records = []
-    requestFailed = False
     while url is not None:
         endpoint = f'https://{config["OntapAdminServer"]}{url}'
-        response = http.request('GET', endpoint, headers=headers)
+        if timeout is None:
+            response = http.request('GET', endpoint, headers=headers)
+        else:
+            try:
+                response = http.request('GET', endpoint, headers=headers, timeout=timeout)
+            except urllib3.exceptions.HTTPError as err:
+                logger.warning(f'API call to {endpoint} failed. Error: {err}.')
+                return ([], True)
+
         if response.status == 200:
             data = json.loads(response.data)
             records.extend(data.get("records", []))
@@ -1014,12 +1396,289 @@ def getAllRecords(url, ignoreErrors=False):
             else:
                 url = None
         else:
-            requestFailed = True
             if not ignoreErrors:
                 logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
-            return [] # Don't send an incomplete list back if we weren't able to get all the records.
+            return ([], True) # Don't send an incomplete list back if we weren't able to get all the records.
 
-    return records
+    return (records, False)
+
+################################################################################
+# This function fetches all the records from multiple API calls concurrently.
+# The requests argument is a list of (url, ignoreErrors) tuples. It returns a
+# list of (records, requestFailed) tuples, in the same order as the requests.
+# The optional timeout is applied to all the calls, and a call that times out
+# is treated as a failed request.
+################################################################################
+def getAllRecordsConcurrently(requests, timeout=None):
+
+    if len(requests) <= 1:
+        return [fetchAllRecords(url, ignoreErrors, timeout) for (url, ignoreErrors) in requests]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = [executor.submit(fetchAllRecords, url, ignoreErrors, timeout) for (url, ignoreErrors) in requests]
+        return [future.result() for future in futures]
+
+################################################################################
+# This table drives the evaluation of the percent based storage rules. For each
+# rule (the lower case version of its key) it holds the type of record it
+# applies to, the column that holds the value to compare against the rule's
+# threshold, the alert type, and the alert message format.
+################################################################################
+storageThresholdRules = {
+    "aggrwarnpercentused": ("aggr", "usedPercent", "Warning", 'Aggregate {alertType} Alert: Aggregate {record[name]} on {clusterName} is {value}% full, which is more or equal to {threshold}% full.'),
+    "aggrcriticalpercentused": ("aggr", "usedPercent", "Critical", 'Aggregate {alertType} Alert: Aggregate {record[name]} on {clusterName} is {value}% full, which is more or equal to {threshold}% full.'),
+    "volumewarnpercentused": ("volume", "usedPercent", "Warning", 'Volume Usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is {value}% full, which is more or equal to {threshold}% full.'),
+    "volumecriticalpercentused": ("volume", "usedPercent", "Critical", 'Volume Usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is {value}% full, which is more or equal to {threshold}% full.'),
+    "volumewarnfilespercentused": ("volume", "filesPercent", "Warning", 'Volume File (inode) Usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is using {value:.0f}% of its inodes, which is more or equal to {threshold}% utilization.'),
+    "volumecriticalfilespercentused": ("volume", "filesPercent", "Critical", 'Volume File (inode) Usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is using {value:.0f}% of its inodes, which is more or equal to {threshold}% utilization.'),
+    "volumewarnsnapreservepercentused": ("volume", "snapReservePercent", "Warning", 'Volume snapshot reserve usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is using {value:.0f}% of its snap reserve space, which is more or equal to {threshold}% utilization.'),
+    "volumecriticalsnapreservepercentused": ("volume", "snapReservePercent", "Critical", 'Volume snapshot reserve usage {alertType} Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is using {value:.0f}% of its snap reserve space, which is more or equal to {threshold}% utilization.')
+}
+
+################################################################################
+# This function loads the values the storage rules are evaluated against into
+# compact columns, one value per record, so they only have to be calculated
+# once. A value of NaN means the record doesn't have the information (e.g. an
+# offline volume) and will never be considered to be over a threshold. The
+# columns are NumPy arrays if NumPy is available, otherwise they are
+# array.array() of doubles.
+#
+# It returns a dictionary, keyed by record type, of dictionaries of columns.
+################################################################################
+def buildStorageColumns(aggrRecords, volumeRecords):
+
+    nan = float("nan")
+    aggrUsedPercent = array.array('d')
+    for aggr in aggrRecords:
+        usedPercent = aggr.get("space", {}).get("block_storage", {}).get("used_percent")
+        aggrUsedPercent.append(usedPercent if usedPercent is not None else nan)
+
+    volumeUsedPercent = array.array('d')
+    volumeFilesPercent = array.array('d')
+    volumeSnapReservePercent = array.array('d')
+    for record in volumeRecords:
+        space = record.get("space")
+        if space is None:
+            space = {}
+        #
+        # A percent_used of 0 is treated as not set, to match how it has always been evaluated.
+        volumeUsedPercent.append(space["percent_used"] if space.get("percent_used") else nan)
+        #
+        # If a volume is offline, the API will not report the "files" information.
+        files = record.get("files")
+        if files is not None and files.get("maximum") is not None and files.get("used") is not None:
+            volumeFilesPercent.append((files["used"] / files["maximum"]) * 100)
+        else:
+            volumeFilesPercent.append(nan)
+        #
+        # If a volume is offline, the API will not report on a lot of the snapshot fields.
+        snapshot = space.get("snapshot")
+        if snapshot is not None and snapshot.get("used") is not None and snapshot.get("reserve_size") is not None and snapshot["reserve_size"] > 0:
+            volumeSnapReservePercent.append((snapshot["used"] / snapshot["reserve_size"]) * 100)
+        else:
+            volumeSnapReservePercent.append(nan)
+
+    columns = {
+        "aggr": {"usedPercent": aggrUsedPercent},
+        "volume": {"usedPercent": volumeUsedPercent, "filesPercent": volumeFilesPercent, "snapReservePercent": volumeSnapReservePercent}
+    }
+    if numpy is not None:
+        for recordType in columns:
+            for column in columns[recordType]:
+                columns[recordType][column] = numpy.frombuffer(columns[recordType][column], dtype=numpy.float64)
+    return columns
+
+################################################################################
+# This function compares all the values in a column against all the
+# thresholds. It returns a list, with an entry for each threshold, of the
+# indexes of the values that are greater than or equal to it. Returning the
+# indexes grouped by threshold, instead of a tuple per breach, keeps the cost
+# down when a lot of values are over a threshold.
+################################################################################
+def findThresholdBreaches(column, thresholds):
+
+    if numpy is not None:
+        return [numpy.flatnonzero(column >= threshold).tolist() for threshold in thresholds]
+    #
+    # Find the values over the lowest threshold in one pass over the column, then
+    # only compare those against the other thresholds.
+    lowestThreshold = min(thresholds)
+    candidates = [recordIndex for recordIndex, value in enumerate(column) if value >= lowestThreshold]  # Always false for NaN.
+    return [candidates if threshold == lowestThreshold else [recordIndex for recordIndex in candidates if column[recordIndex] >= threshold] for threshold in thresholds]
+
+################################################################################
+# These are the fields of the aggregate and volume records that the percent
+# based and "offline" storage rules, and their alert messages, use. They make
+# up the fingerprint of each record used to tell if it has changed.
+################################################################################
+storageAggrFingerprintFields = ["name", "space.block_storage.used_percent"]
+storageVolumeFingerprintFields = ["name", "svm.name", "state", "space.percent_used", "files.used", "files.maximum", "space.snapshot.used", "space.snapshot.reserve_size"]
+
+################################################################################
+# This function returns the clear thresholds set in a rule. Any of the percent
+# based rules can have a companion "<rule key>Clear" key, in which case an
+# alert, once sent, isn't cleared until the value drops below the clear
+# threshold, instead of the rule's threshold. This keeps a value that is
+# hovering around a threshold from repeatedly sending and clearing an alert.
+# It returns a dictionary, keyed by the lower case rule key, of the clear
+# thresholds.
+################################################################################
+def getClearThresholds(rule, ruleTable):
+
+    clearThresholds = {}
+    for key in rule.keys():
+        lkey = key.lower()
+        if lkey.endswith("clear") and lkey[:-len("clear")] in ruleTable:
+            clearThresholds[lkey[:-len("clear")]] = rule[key]
+    return clearThresholds
+
+################################################################################
+# This table drives the evaluation of the storage growth rules. For each rule
+# (the lower case version of its key) it holds the type of record it applies
+# to, and the alert message format.
+################################################################################
+storageGrowthRules = {
+    "aggrhourstofull": ("aggr", 'Aggregate Growth Alert: Aggregate {record[name]} on {clusterName} is growing by {bytesPerHour:,.0f} bytes per hour, and at that rate will be full in {hoursToFull:.1f} hours, which is less than {threshold} hours.'),
+    "volumehourstofull": ("volume", 'Volume Growth Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is growing by {bytesPerHour:,.0f} bytes per hour, and at that rate will be full in {hoursToFull:.1f} hours, which is less than {threshold} hours.')
+}
+
+################################################################################
+# This function returns the used and available bytes of an aggregate or volume
+# record. Either can be None if the record doesn't have it (e.g. the volume is
+# offline).
+################################################################################
+def getUsedAndAvailable(recordType, record):
+
+    space = record.get("space")
+    if space is None:
+        return (None, None)
+    if recordType == "aggr":
+        space = space.get("block_storage", {})
+    return (space.get("used"), space.get("available"))
+
+################################################################################
+# This function groups the FlexGroup constituent volumes by the FlexGroup they
+# belong to, in one pass. Constituents are named after their FlexGroup with a
+# "__NNNN" suffix. It returns a dictionary, keyed by (svm name, FlexGroup name),
+# of lists of (percent used, record) tuples.
+################################################################################
+def groupFlexGroupConstituents(volumeRecords):
+
+    flexGroups = {}
+    for record in volumeRecords:
+        if record.get("style", "").lower() != "flexgroup_constituent":
+            continue
+        percentUsed = record.get("space", {}).get("percent_used")
+        if percentUsed is None or "__" not in record["name"]:
+            continue
+        flexGroupKey = (record["svm"]["name"], record["name"].rsplit("__", 1)[0])
+        if flexGroups.get(flexGroupKey) is None:
+            flexGroups[flexGroupKey] = []
+        flexGroups[flexGroupKey].append((percentUsed, record))
+    return flexGroups
+
+################################################################################
+# This function returns the growth rate, in units per second, of the values in
+# a history of samples maintained by addSample(). It is the slope of the least
+# squares fit of the samples. It returns None if there aren't enough samples.
+################################################################################
+def getGrowthRate(samples):
+
+    numSamples = len(samples) // 2
+    if numSamples < capacityHistoryMinSamples:
+        return None
+
+    times = samples[0::2]
+    values = samples[1::2]
+    meanTime = sum(times) / numSamples
+    meanValue = sum(values) / numSamples
+    denominator = sum((sampleTime - meanTime) ** 2 for sampleTime in times)
+    if denominator == 0:
+        return None
+    return sum((sampleTime - meanTime) * (value - meanValue) for sampleTime, value in zip(times, values)) / denominator
+
+################################################################################
+# This function returns True if the ONTAP version of the cluster is at least
+# the major.minor version passed in.
+################################################################################
+def clusterVersionAtLeast(major, minor):
+    global clusterVersion
+
+    match = re.match(r'(\d+)\.(\d+)', clusterVersion if clusterVersion is not None else "")
+    if match is None:
+        return False
+    return (int(match.group(1)), int(match.group(2))) >= (major, minor)
+
+################################################################################
+# This function returns what is used to tell if the snapshots of a volume have
+# changed since they were last queried. That is the number of snapshots, if
+# the cluster reports it, and the space the snapshots are using.
+################################################################################
+def getSnapshotChangeMarker(volume):
+
+    return [volume.get("snapshot_count"), volume.get("space", {}).get("snapshot", {}).get("used")]
+
+################################################################################
+# This function updates the cache of each volume's snapshots that is used by
+# the "oldSnapshot" rules, so the snapshots are only queried for the volumes
+# that need it. Each entry is keyed by the volume's UUID and holds the change
+# marker, the time the snapshots were queried, and a list of [uuid, name,
+# creation time] for each snapshot, oldest first. A volume's snapshots are
+# queried again if its change marker is different, if one of its snapshots
+# has become older than one of the thresholds since it was queried (to make
+# sure the snapshot still exists before alerting on it), or if the entry is
+# older than snapshotCacheMaxAgeSeconds. If a query fails, the old entry is
+# kept. It returns True if the cache was changed.
+################################################################################
+def updateSnapshotCache(snapshotCache, volumeRecords, thresholdsSeconds, curTimeSeconds):
+    global clusterName, logger, requestFailed
+
+    changedCache = False
+    seenVolumes = set()
+    numQueried = 0
+    numFailed = 0
+    for volume in volumeRecords:
+        if volume["flexcache_endpoint_type"].lower() == "cache" or volume["style"].lower() == "flexgroup_constituent":
+            continue
+        seenVolumes.add(volume["uuid"])
+        marker = getSnapshotChangeMarker(volume)
+        entry = snapshotCache.get(volume["uuid"])
+        if entry is not None and entry[0] == marker and curTimeSeconds - entry[1] < snapshotCacheMaxAgeSeconds:
+            queriedTime = entry[1]
+            crossed = False
+            for (_, _, creationTimeSec) in entry[2]:
+                for thresholdSeconds in thresholdsSeconds:
+                    if queriedTime < creationTimeSec + thresholdSeconds <= curTimeSeconds:
+                        crossed = True
+                        break
+                if crossed:
+                    break
+            if not crossed:
+                continue
+
+        records = getAllRecords(f'/api/storage/volumes/{volume["uuid"]}/snapshots?fields=create_time&return_timeout=15')
+        numQueried += 1
+        if requestFailed:
+            numFailed += 1
+            continue
+        snapshots = []
+        for snapshot in records:
+            if snapshot.get("create_time") is not None:
+                #
+                # Format should be: 2025-11-07T10:05:00-06:00
+                creationTime = datetime.datetime.strptime(snapshot["create_time"], '%Y-%m-%dT%H:%M:%S%z')
+                snapshots.append([snapshot["uuid"], snapshot["name"], int(creationTime.timestamp())])
+        snapshots.sort(key=lambda snapshot: snapshot[2])
+        snapshotCache[volume["uuid"]] = [marker, curTimeSeconds, snapshots]
+        changedCache = True
+    #
+    # Forget about the volumes that no longer exist.
+    for uuid in [uuid for uuid in snapshotCache if uuid not in seenVolumes]:
+        del snapshotCache[uuid]
+        changedCache = True
+
+    logger.info(f'Queried the snapshots of {numQueried} of {len(seenVolumes)} volumes on cluster {clusterName}. Failed requests={numFailed}.')
+    return changedCache
 
 ################################################################################
 # This function is used to check all the volume and aggregate utilization.
@@ -1051,7 +1710,10 @@ def processStorageUtilization(service):
     anyRequestFailed = requestFailed
     #
     # Run the API call to get the volume information.
-    volumeRecords = getAllRecords('/api/storage/volumes?fields=style,flexcache_endpoint_type,space,files,svm,state,space.snapshot&return_timeout=15')
+    # The snapshot count is used to tell which volumes' snapshots need to be queried for
+    # the "oldSnapshot" rules, but it isn't available before ONTAP 9.10.
+    snapshotCountField = ",snapshot_count" if "oldsnapshot" in service["ruleKeys"] and clusterVersionAtLeast(9, 10) else ""
+    volumeRecords = getAllRecords(f'/api/storage/volumes?fields=style,flexcache_endpoint_type,space,files,svm,state,space.snapshot{snapshotCountField}&return_timeout=15')
     anyRequestFailed = requestFailed or anyRequestFailed
     #
     # Now get the constituent volumes.
@@ -1063,25 +1725,61 @@ def processStorageUtilization(service):
     # If any of the requests failed, bail.
     if anyRequestFailed:
         return
+    #
+    # Save the space information to the history store.
+    if config["historyRetentionDays"] is not None:
+        for aggr in aggrRecords:
+            blockStorage = aggr.get("space", {}).get("block_storage", {})
+            recordHistorySample("aggr.used", aggr["uuid"], blockStorage.get("used"))
+            recordHistorySample("aggr.size", aggr["uuid"], blockStorage.get("size"))
+        for volume in volumeRecords:
+            space = volume.get("space") if volume.get("space") is not None else {}
+            recordHistorySample("volume.used", volume["uuid"], space.get("used"))
+            recordHistorySample("volume.size", volume["uuid"], space.get("size"))
+            recordHistorySample("volume.filesUsed", volume["uuid"], volume.get("files", {}).get("used"))
 
+    #
+    # The percent based and "offline" rules only need to be evaluated against the volumes and
+    # aggregates that have changed since the last run, or that have an active alert. The events'
+    # unique identifiers all start with the UUID of the record.
+    activeUuids = set(event["index"].split("_")[0] for event in events)
+    changedAggrRecords = getChangedRecords("storage.aggr", service["rules"], aggrRecords, storageAggrFingerprintFields, lambda record: record["uuid"], lambda record: record["uuid"] in activeUuids)
+    changedVolumeRecords = getChangedRecords("storage.volume", service["rules"], volumeRecords, storageVolumeFingerprintFields, lambda record: record["uuid"], lambda record: record["uuid"] in activeUuids)
+
+    thresholdRules = []
+    growthRules = []
+    oldSnapshotRules = []
     for rule in service["rules"]:
+        clearThresholds = getClearThresholds(rule, storageThresholdRules)
         for key in rule.keys():
             lkey=key.lower()
-            if lkey == "aggrwarnpercentused" or lkey == 'aggrcriticalpercentused':
-                for aggr in aggrRecords:
-                    if aggr["space"]["block_storage"]["used_percent"] >= rule[key]:
-                        uniqueIdentifier = aggr["uuid"] + "_" + key
+            if lkey in storageThresholdRules:
+                #
+                # The percent based rules are all evaluated together below. An alert isn't cleared
+                # until the value drops below the clear threshold, which defaults to the threshold.
+                thresholdRules.append((key, lkey, rule[key], min(rule[key], clearThresholds.get(lkey, rule[key]))))
+            elif lkey.endswith("clear") and lkey[:-len("clear")] in storageThresholdRules:
+                #
+                # The clear thresholds are handled with the rule they belong to above.
+                continue
+            elif lkey in storageGrowthRules:
+                #
+                # As are the growth rules.
+                growthRules.append((key, lkey, rule[key]))
+            elif lkey == "offline":
+                for record in changedVolumeRecords:
+                    if rule[key] and record["state"].lower() == "offline":
+                        uniqueIdentifier = f'{record["uuid"]}_{key}_{rule[key]}'
                         eventIndex = eventExist(events, uniqueIdentifier)
                         if eventIndex < 0:
-                            alertType = 'Warning' if lkey == "aggrwarnpercentused" else 'Critical'
-                            message = f'Aggregate {alertType} Alert: Aggregate {aggr["name"]} on {clusterName} is {aggr["space"]["block_storage"]["used_percent"]}% full, which is more or equal to {rule[key]}% full.'
+                            message = f"Volume Offline Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is offline."
                             sendAlert(message, "WARNING", alertCategory)
-                            changedEvents = True
+                            changedEvents=True
                             event = {
-                                    "index": uniqueIdentifier,
-                                    "message": message,
-                                    "refresh": eventResilience
-                                }
+                                "index": uniqueIdentifier,
+                                "message": message,
+                                "refresh": eventResilience
+                            }
                             events.append(event)
                         else:
                             # If the event was found, reset the refresh count. If it is just one less
@@ -1090,99 +1788,19 @@ def processStorageUtilization(service):
                             if events[eventIndex]["refresh"] != (eventResilience - 1):
                                 changedEvents = True
                             events[eventIndex]["refresh"] = eventResilience
-
-            elif lkey == "volumewarnpercentused" or lkey == "volumecriticalpercentused":
-                for record in volumeRecords:
-                    if record["space"].get("percent_used"):
-                        if record["space"]["percent_used"] >= rule[key]:
-                            uniqueIdentifier = record["uuid"] + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                alertType = 'Warning' if lkey == "volumewarnpercentused" else 'Critical'
-                                message = f'Volume Usage {alertType} Alert: volume {record["svm"]["name"]}:{record["name"]} on {clusterName} is {record["space"]["percent_used"]}% full, which is more or equal to {rule[key]}% full.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents = True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                    }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-
-            elif lkey == "volumewarnfilespercentused" or lkey == "volumecriticalfilespercentused":
-                for record in volumeRecords:
-                    #
-                    # If a volume is offline, the API will not report the "files" information.
-                    if record.get("files") is not None:
-                        maxFiles = record["files"].get("maximum")
-                        usedFiles = record["files"].get("used")
-                        if maxFiles != None and usedFiles != None:
-                            percentUsed = (usedFiles / maxFiles) * 100
-                            if percentUsed >= rule[key]:
-                                uniqueIdentifier = record["uuid"] + "_" + key
-                                eventIndex = eventExist(events, uniqueIdentifier)
-                                if eventIndex < 0:
-                                    alertType = 'Warning' if lkey == "volumewarnfilespercentused" else 'Critical'
-                                    message = f"Volume File (inode) Usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is using {percentUsed:.0f}% of its inodes, which is more or equal to {rule[key]}% utilization."
-                                    sendAlert(message, "WARNING", alertCategory)
-                                    changedEvents = True
-                                    event = {
-                                            "index": uniqueIdentifier,
-                                            "message": message,
-                                            "refresh": eventResilience
-                                        }
-                                    events.append(event)
-                                else:
-                                    # If the event was found, reset the refresh count. If it is just one less
-                                    # than the max, then it means it was decremented above so there wasn't
-                                    # really a change in state.
-                                    if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                        changedEvents = True
-                                    events[eventIndex]["refresh"] = eventResilience
-
-            elif lkey == "volumewarnsnapreservepercentused" or lkey == "volumecriticalsnapreservepercentused":
-                for record in volumeRecords:
-                    #
-                    # If a volume is offline, the API will not report on a lot of the snapshot fields.
-                    if record.get("space") is not None and record["space"].get("snapshot") is not None and record["space"]["snapshot"].get("used") is not None and record["space"]["snapshot"].get("reserve_size") is not None and record["space"]["snapshot"]["reserve_size"] > 0:
-                        reserveSize = record["space"]["snapshot"]["reserve_size"]
-                        reserveAvailable = reserveSize - record["space"]["snapshot"]["used"]
-                        percentUsed = ((reserveSize - reserveAvailable) / reserveSize) * 100
-                        if percentUsed >= rule[key]:
-                            uniqueIdentifier = record["uuid"] + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                alertType = 'Warning' if lkey == "volumewarnsnapreservepercentused" else 'Critical'
-                                message = f"Volume snapshot reserve usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is using {percentUsed:.0f}% of its snap reserve space, which is more or equal to {rule[key]}% utilization."
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents = True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                    }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-            elif lkey == "offline":
-                for record in volumeRecords:
-                    if rule[key] and record["state"].lower() == "offline":
-                        uniqueIdentifier = f'{record["uuid"]}_{key}_{rule[key]}'
+            elif lkey == "flexgroupimbalancepercent":
+                #
+                # Compare the fullest constituent of each FlexGroup against the average of all of them.
+                for ((svmName, flexGroupName), constituents) in groupFlexGroupConstituents(volumeRecords).items():
+                    if len(constituents) < 2:
+                        continue
+                    meanPercentUsed = sum(percentUsed for (percentUsed, record) in constituents) / len(constituents)
+                    (maxPercentUsed, fullestRecord) = max(constituents, key=lambda constituent: constituent[0])
+                    if maxPercentUsed - meanPercentUsed >= rule[key]:
+                        uniqueIdentifier = f'{svmName}:{flexGroupName}_{key}'
                         eventIndex = eventExist(events, uniqueIdentifier)
                         if eventIndex < 0:
-                            message = f"Volume Offline Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is offline."
+                            message = f'FlexGroup Imbalance Alert: FlexGroup {svmName}:{flexGroupName} on {clusterName} has constituent {fullestRecord["name"]} at {maxPercentUsed}% full, {maxPercentUsed - meanPercentUsed:.1f}% above the {meanPercentUsed:.1f}% average of its {len(constituents)} constituents, which is more or equal to {rule[key]}%.'
                             sendAlert(message, "WARNING", alertCategory)
                             changedEvents=True
                             event = {
@@ -1199,53 +1817,177 @@ def processStorageUtilization(service):
                                 changedEvents = True
                             events[eventIndex]["refresh"] = eventResilience
             elif lkey == "oldsnapshot":
-                curTime = datetime.datetime.now(pytz.timezone(clusterTimezone) if clusterTimezone != None else datetime.timezone.utc)
-                curTimeSec = curTime.timestamp()
                 #
-                # Run the API call to get the snapshot information.
-                snapshotRecords = []
-                anyRequestFailed = False
-                for volume in volumeRecords:
-                    if volume["flexcache_endpoint_type"].lower() != "cache" and volume["style"].lower() != "flexgroup_constituent":
-                        snapshotRecords.extend(getAllRecords(f'/api/storage/volumes/{volume["uuid"]}/snapshots?fields=create_time,volume,svm&return_timeout=15'))
-                        anyRequestFailed = requestFailed or anyRequestFailed
-                logger.info(f'Found {len(snapshotRecords)} snapshots on cluster {clusterName}. anyRequestFailed={anyRequestFailed}.')
-                for snapshot in snapshotRecords:
-                    if snapshot.get("create_time") is not None:
-                        #
-                        # Format should be: 2025-11-07T10:05:00-06:00
-                        creationTime = datetime.datetime.strptime(snapshot["create_time"], '%Y-%m-%dT%H:%M:%S%z')
-                        creationTimeSec = creationTime.timestamp()
-                        ageSeconds = int(curTimeSec - creationTimeSec)
-                        if ageSeconds >= (rule[key] * 60 * 60 * 24):
-                            uniqueIdentifier = f'{snapshot["uuid"]}_{key}'
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                timeStr = lagTimeStr(int(ageSeconds))
-                                message = f'Old Snapshot Alert: snapshot {snapshot["name"]} on volume {snapshot["volume"]["name"]} in SVM {snapshot["svm"]["name"]} is {int(ageSeconds)} seconds old ({timeStr}), which is more than {rule[key]} days.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents=True
-                                event = {
+                # The snapshots are checked against all the "oldSnapshot" rules together below.
+                oldSnapshotRules.append((key, rule[key]))
+            else:
+                message = f'Unknown storage alert type: "{key}" found for cluster {clusterName}.'
+                logger.warning(message)
+    #
+    # Evaluate all the percent based rules. The values are loaded into columns once, and each
+    # column is compared against all the thresholds that apply to it in a single pass.
+    if len(thresholdRules) > 0:
+        columns = buildStorageColumns(changedAggrRecords, changedVolumeRecords)
+        records = {"aggr": changedAggrRecords, "volume": changedVolumeRecords}
+        for recordType in columns:
+            for column in columns[recordType]:
+                rules = [thresholdRule for thresholdRule in thresholdRules if storageThresholdRules[thresholdRule[1]][0] == recordType and storageThresholdRules[thresholdRule[1]][1] == column]
+                if len(rules) == 0:
+                    continue
+                #
+                # Compare against the clear thresholds, so the alerts that have already been sent are
+                # kept until the value drops below them, but only send new alerts over the threshold.
+                breaches = findThresholdBreaches(columns[recordType][column], [rule[3] for rule in rules])
+                for ((key, lkey, threshold, _), recordIndexes) in zip(rules, breaches):
+                    (_, _, alertType, messageFormat) = storageThresholdRules[lkey]
+                    for recordIndex in recordIndexes:
+                        record = records[recordType][recordIndex]
+                        uniqueIdentifier = record["uuid"] + "_" + key
+                        eventIndex = eventExist(events, uniqueIdentifier)
+                        if eventIndex < 0:
+                            if columns[recordType][column][recordIndex] < threshold:
+                                continue
+                            #
+                            # Report the percent used as ONTAP reported it, the others are calculated.
+                            if column == "usedPercent":
+                                value = record["space"]["block_storage"]["used_percent"] if recordType == "aggr" else record["space"]["percent_used"]
+                            else:
+                                value = columns[recordType][column][recordIndex]
+                            message = messageFormat.format(alertType=alertType, record=record, clusterName=clusterName, value=value, threshold=threshold)
+                            sendAlert(message, "WARNING", alertCategory)
+                            changedEvents = True
+                            event = {
                                     "index": uniqueIdentifier,
                                     "message": message,
                                     "refresh": eventResilience
                                 }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
+                            events.append(event)
+                        else:
+                            # If the event was found, reset the refresh count. If it is just one less
+                            # than the max, then it means it was decremented above so there wasn't
+                            # really a change in state.
+                            if events[eventIndex]["refresh"] != (eventResilience - 1):
+                                changedEvents = True
+                            events[eventIndex]["refresh"] = eventResilience
+    #
+    # The growth and "oldSnapshot" rules need the state saved from the previous runs.
+    if len(growthRules) > 0 or len(oldSnapshotRules) > 0:
+        try:
+            data = s3Client.get_object(Key=config["storageHistoryFilename"], Bucket=config["s3BucketName"])
+        except botocore.exceptions.ClientError as err:
+            # If the error is that the object doesn't exist, then it will get created below.
+            if err.response['Error']['Code'] == "NoSuchKey":
+                storageState = {}
             else:
-                message = f'Unknown storage alert type: "{key}" found for cluster {clusterName}.'
-                logger.warning(message)
+                raise Exception(err)
+        else:
+            storageState = json.loads(data["Body"].read().decode('UTF-8'))
+        changedState = False
+        curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    #
+    # Evaluate the growth rules. A history of the used space of each volume and aggregate is kept,
+    # and the rate they are growing at is used to estimate how long before they are full.
+    if len(growthRules) > 0:
+        records = {"aggr": aggrRecords, "volume": volumeRecords}
+        for recordType in records:
+            rules = [growthRule for growthRule in growthRules if storageGrowthRules[growthRule[1]][0] == recordType]
+            typeHistory = storageState.setdefault(recordType, {})
+            seenRecords = set()
+            storedHistory = None
+            for record in records[recordType]:
+                seenRecords.add(record["uuid"])
+                (used, available) = getUsedAndAvailable(recordType, record)
+                if used is None or available is None:
+                    continue
+
+                samples = typeHistory.setdefault(record["uuid"], [])
+                #
+                # If the history store is enabled, use it to start off the samples of the volumes
+                # and aggregates that don't have any yet, so they don't have to wait for them to be
+                # collected. It is only read once, and only if it is needed.
+                if len(samples) == 0 and len(rules) > 0 and config["historyRetentionDays"] is not None:
+                    if storedHistory is None:
+                        storedHistory = queryHistory(f'{recordType}.used', startTime=curTimeSeconds - capacityHistorySamples * capacityHistoryIntervalSeconds, endTime=curTimeSeconds - 1)
+                    for (sampleTime, value) in storedHistory.get(record["uuid"], []):
+                        if len(samples) == 0 or sampleTime - samples[-2] >= capacityHistoryIntervalSeconds:
+                            addSample(samples, sampleTime, value, capacityHistorySamples)
+
+                if len(samples) == 0 or curTimeSeconds - samples[-2] >= capacityHistoryIntervalSeconds:
+                    addSample(samples, curTimeSeconds, used, capacityHistorySamples)
+                    changedState = True
+
+                if len(rules) == 0:
+                    continue
+                bytesPerSecond = getGrowthRate(samples)
+                if bytesPerSecond is None or bytesPerSecond <= 0:
+                    continue
+                hoursToFull = available / bytesPerSecond / (60 * 60)
+                for (key, lkey, threshold) in rules:
+                    if hoursToFull < threshold:
+                        uniqueIdentifier = record["uuid"] + "_" + key
+                        eventIndex = eventExist(events, uniqueIdentifier)
+                        if eventIndex < 0:
+                            message = storageGrowthRules[lkey][1].format(record=record, clusterName=clusterName, bytesPerHour=bytesPerSecond * 60 * 60, hoursToFull=hoursToFull, threshold=threshold)
+                            sendAlert(message, "WARNING", alertCategory)
+                            changedEvents = True
+                            event = {
+                                    "index": uniqueIdentifier,
+                                    "message": message,
+                                    "refresh": eventResilience
+                                }
+                            events.append(event)
+                        else:
+                            # If the event was found, reset the refresh count. If it is just one less
+                            # than the max, then it means it was decremented above so there wasn't
+                            # really a change in state.
+                            if events[eventIndex]["refresh"] != (eventResilience - 1):
+                                changedEvents = True
+                            events[eventIndex]["refresh"] = eventResilience
+            #
+            # Forget about the volumes and aggregates that no longer exist.
+            for uuid in [uuid for uuid in typeHistory if uuid not in seenRecords]:
+                del typeHistory[uuid]
+                changedState = True
+    #
+    # Evaluate the "oldSnapshot" rules. Each volume's snapshots are cached, so they only have to be
+    # queried for the volumes whose snapshots have changed. See updateSnapshotCache() for the details.
+    if len(oldSnapshotRules) > 0:
+        snapshotCache = storageState.setdefault("snapshots", {})
+        if updateSnapshotCache(snapshotCache, volumeRecords, [days * 60 * 60 * 24 for (_, days) in oldSnapshotRules], curTimeSeconds):
+            changedState = True
+        for volume in volumeRecords:
+            entry = snapshotCache.get(volume["uuid"])
+            if entry is None:
+                continue
+            for (snapshotUuid, snapshotName, creationTimeSec) in entry[2]:
+                ageSeconds = curTimeSeconds - creationTimeSec
+                for (key, days) in oldSnapshotRules:
+                    if ageSeconds >= (days * 60 * 60 * 24):
+                        uniqueIdentifier = f'{snapshotUuid}_{key}'
+                        eventIndex = eventExist(events, uniqueIdentifier)
+                        if eventIndex < 0:
+                            timeStr = lagTimeStr(int(ageSeconds))
+                            message = f'Old Snapshot Alert: snapshot {snapshotName} on volume {volume["name"]} in SVM {volume["svm"]["name"]} is {int(ageSeconds)} seconds old ({timeStr}), which is more than {days} days.'
+                            sendAlert(message, "WARNING", alertCategory)
+                            changedEvents=True
+                            event = {
+                                "index": uniqueIdentifier,
+                                "message": message,
+                                "refresh": eventResilience
+                            }
+                            events.append(event)
+                        else:
+                            # If the event was found, reset the refresh count. If it is just one less
+                            # than the max, then it means it was decremented above so there wasn't
+                            # really a change in state.
+                            if events[eventIndex]["refresh"] != (eventResilience - 1):
+                                changedEvents = True
+                            events[eventIndex]["refresh"] = eventResilience
+
+    if (len(growthRules) > 0 or len(oldSnapshotRules) > 0) and changedState:
+        s3Client.put_object(Key=config["storageHistoryFilename"], Bucket=config["s3BucketName"], Body=json.dumps(storageState, separators=(',', ':')).encode('UTF-8'))
     #
     # After processing the records, see if any events need to be removed.
-    # It is possible that an "oldSnapshot" event being erroneously cleared if for some reason the
-    # request failed to get all the snapshots. But, potentially erroneously clearing that is better
-    # than not clearing a volume or aggregate utilization event that should be cleared.
     i = len(events) - 1
     while i >= 0:
         if events[i]["refresh"] <= 0:
@@ -1260,8 +2002,162 @@ def processStorageUtilization(service):
     #
     # If the events array changed, save it.
     if(changedEvents):
+        spoolWebHookBatch()
         s3Client.put_object(Key=config["storageEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
 
+################################################################################
+# This function records a sample to be saved to the history store at the end
+# of the run. The metric is what was measured (e.g. "volume.used") and the
+# seriesId is what it was measured on (e.g. the volume's UUID). Only integer
+# values are stored. It does nothing if the history store isn't enabled.
+################################################################################
+def recordHistorySample(metric, seriesId, value):
+    global config, historySamples
+
+    if config["historyRetentionDays"] is None or value is None:
+        return
+
+    if historySamples.get(metric) is None:
+        historySamples[metric] = {}
+    historySamples[metric][seriesId] = int(value)
+
+################################################################################
+# The history store keeps one chunk (S3 object) per historyChunkSeconds. The
+# chunks are stored in historyRetentionDays slots that are reused in a round
+# robin fashion, so the store never holds more than that many chunks. This
+# function returns the S3 key of the slot for the chunk starting at chunkStart.
+################################################################################
+def getHistoryChunkKey(chunkStart):
+    global config
+
+    return f'{config["historyFilename"]}-{(chunkStart // historyChunkSeconds) % config["historyRetentionDays"]}'
+
+################################################################################
+# This function reads a history store chunk from S3. A chunk is zlib compressed
+# JSON that looks like:
+#   {"version": 1, "start": <time the chunk starts>, "lastTime": <time of the last row>,
+#    "times": [<time deltas>],
+#    "columns": {<metric>: {<seriesId>: [<value deltas>]}},
+#    "last": {<metric>: {<seriesId>: <last value>}}}
+# The first time is absolute and each one after it is the difference from the
+# previous one. Each column has an entry for every time, which is either null,
+# if there wasn't a sample at that time, or the difference from the previous
+# value in the column (the first value is the difference from 0). It returns
+# None if the chunk doesn't exist.
+################################################################################
+def readHistoryChunk(key):
+    global config, s3Client
+
+    try:
+        data = s3Client.get_object(Key=key, Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        if err.response['Error']['Code'] == "NoSuchKey":
+            return None
+        else:
+            raise Exception(err)
+
+    return json.loads(zlib.decompress(data["Body"].read()).decode('UTF-8'))
+
+################################################################################
+# This function appends a row of samples to a history store chunk. The samples
+# are a dictionary of metrics, each a dictionary of seriesId and value.
+################################################################################
+def appendHistoryRow(chunk, sampleTime, samples):
+
+    rowIndex = len(chunk["times"])
+    chunk["times"].append(sampleTime - chunk["lastTime"] if rowIndex > 0 else sampleTime)
+    chunk["lastTime"] = sampleTime
+    for metric in set(chunk["columns"]) | set(samples):
+        if chunk["columns"].get(metric) is None:
+            chunk["columns"][metric] = {}
+            chunk["last"][metric] = {}
+        columns = chunk["columns"][metric]
+        lastValues = chunk["last"][metric]
+        metricSamples = samples.get(metric, {})
+        for seriesId in set(columns) | set(metricSamples):
+            if columns.get(seriesId) is None:
+                columns[seriesId] = [None] * rowIndex
+            value = metricSamples.get(seriesId)
+            if value is None:
+                columns[seriesId].append(None)
+            else:
+                columns[seriesId].append(value - lastValues.get(seriesId, 0))
+                lastValues[seriesId] = value
+
+################################################################################
+# This function saves the samples recorded during the run to the history
+# store. A row is only added if it has been at least historyIntervalSeconds
+# since the last one, to keep the size of the chunks predictable.
+################################################################################
+def saveHistory():
+    global config, s3Client, logger, clusterName, historySamples
+
+    if config["historyRetentionDays"] is None or len(historySamples) == 0:
+        return
+
+    curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    chunkStart = curTimeSeconds - (curTimeSeconds % historyChunkSeconds)
+    key = getHistoryChunkKey(chunkStart)
+    chunk = readHistoryChunk(key)
+    #
+    # If the slot holds an older chunk, it is replaced by a new one.
+    if chunk is None or chunk["start"] != chunkStart:
+        chunk = {"version": 1, "start": chunkStart, "lastTime": chunkStart, "times": [], "columns": {}, "last": {}}
+    elif curTimeSeconds - chunk["lastTime"] < historyIntervalSeconds:
+        return
+
+    appendHistoryRow(chunk, curTimeSeconds, historySamples)
+    body = zlib.compress(json.dumps(chunk, separators=(',', ':')).encode('UTF-8'))
+    logger.debug('Saving %d history rows (%d bytes) to %s for cluster %s.', len(chunk["times"]), len(body), key, clusterName)
+    s3Client.put_object(Key=key, Bucket=config["s3BucketName"], Body=body)
+
+################################################################################
+# This function queries the history store. It returns a dictionary, keyed by
+# seriesId, of lists of (time, value) tuples, sorted by time, for the metric
+# passed in. The results can be limited to a list of seriesIds, and to a time
+# range (in seconds since the UNIX epoch).
+################################################################################
+def queryHistory(metric, seriesIds=None, startTime=None, endTime=None):
+    global config
+
+    results = {}
+    if config["historyRetentionDays"] is None:
+        return results
+
+    curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    newestChunkStart = curTimeSeconds - (curTimeSeconds % historyChunkSeconds)
+    oldestChunkStart = newestChunkStart - (config["historyRetentionDays"] - 1) * historyChunkSeconds
+    #
+    # Only read the chunks that overlap the time range.
+    if startTime is not None:
+        oldestChunkStart = max(oldestChunkStart, startTime - (startTime % historyChunkSeconds))
+    if endTime is not None:
+        newestChunkStart = min(newestChunkStart, endTime - (endTime % historyChunkSeconds))
+    for chunkStart in range(oldestChunkStart, newestChunkStart + 1, historyChunkSeconds):
+        chunk = readHistoryChunk(getHistoryChunkKey(chunkStart))
+        #
+        # The slot might still hold an older chunk.
+        if chunk is None or chunk["start"] != chunkStart:
+            continue
+
+        times = list(itertools.accumulate(chunk["times"]))
+        for seriesId, column in chunk["columns"].get(metric, {}).items():
+            if seriesIds is not None and seriesId not in seriesIds:
+                continue
+            if results.get(seriesId) is None:
+                results[seriesId] = []
+            value = 0
+            for sampleTime, delta in zip(times, column):
+                if delta is None:
+                    continue
+                value += delta
+                if (startTime is None or sampleTime >= startTime) and (endTime is None or sampleTime <= endTime):
+                    results[seriesId].append((sampleTime, value))
+
+    for series in results.values():
+        series.sort()
+    return results
+
 ################################################################################
 # This function sends the alert to a webhook defined by the
 # config['webhookEndpoint'] variable. It is currently designed to work with a
@@ -1269,7 +2165,7 @@ def processStorageUtilization(service):
 # modify it to work with the destination you want to send the alert to.
 ################################################################################
 def sendWebHook(message, severity, alert_category):
-    global config, clusterName, http, snsClient, logger
+    global config, clusterName, logger, webhookDownEndpoints, webhookBatch
 
     if config.get('webhookEndpoint') is None:
         return
@@ -1287,16 +2183,14 @@ def sendWebHook(message, severity, alert_category):
     #
     # If the webhookConfigFilename is defined, load the file from the S3 bucket.
     if config.get('webhookConfigFilename') is not None:
+        # Read in the payload template. It is cached since it is read for every alert.
         try:
-            rawData = s3Client.get_object(Key=config["webhookConfigFilename"], Bucket=config["s3BucketName"])
+            payload = getCachedS3Object(config["webhookConfigFilename"], lambda body: body.decode('UTF-8'))
         except botocore.exceptions.ClientError as err:
             message = f'Error: Exception occurred when loading webhook config file "{config["webhookConfigFilename"]}" from S3 bucket {config["s3BucketName"]} for cluster {clusterName}. Exception: {err}.'
             logger.critical(message)
             return
         #
-        # Read in the payload template.
-        payload = rawData["Body"].read().decode('UTF-8')
-        #
         # Make the account_id a local variable so it can be used in the payload replacement.
         account_id = config.get("awsAccountId", "not_set")   # pylint: disable=W0641
         #
@@ -1316,6 +2210,122 @@ def sendWebHook(message, severity, alert_category):
         }
 
     data = json.dumps(payload).encode('UTF-8')
+    #
+    # If batching is enabled, hold on to the alert so it can be sent with the
+    # others at the end of the run.
+    if config["webhookBatchSize"] is not None:
+        webhookBatch.append({"data": data, "severity": severity, "alertCategory": alert_category})
+        return
+
+    webhookHeaders = getWebhookHeaders()
+    if webhookHeaders is None:
+        return
+    #
+    # Send to each of the configured endpoints. If the delivery fails, or the
+    # endpoint has already failed during this run, queue the alert in the spool
+    # so it can be retried on a later run instead of being lost.
+    for endpointKey in ["webhookEndpoint", "webhookEndpoint2"]:
+        if config.get(endpointKey) is None:
+            continue
+        if endpointKey in webhookDownEndpoints or webhookRetryable(postWebHook(endpointKey, webhookHeaders, data)):
+            spoolWebHook(endpointKey, data, severity, alert_category)
+
+################################################################################
+# This function sends the alerts that were held back by sendWebHook() when
+# the webhookBatchSize parameter is set. The alerts are sent as JSON arrays of
+# up to webhookBatchSize alerts, and no more than webhookBatchMaxBytes bytes.
+# If an endpoint rejects a batch with a 4xx HTTP status code, the alerts in
+# that batch are sent one at a time instead. Alerts that fail to be delivered
+# are queued in the webhook spool.
+################################################################################
+def flushWebHookBatch():
+    global config, logger, clusterName, webhookBatch, webhookDownEndpoints, webhookSpoolChanged
+
+    if len(webhookBatch) == 0:
+        return
+
+    alerts = webhookBatch
+    webhookBatch = []
+    webhookHeaders = getWebhookHeaders()
+    if webhookHeaders is None:
+        logger.error(f'Unable to create the webhook headers, so {len(alerts)} batched alerts were not sent for cluster {clusterName}.')
+        return
+    #
+    # Take the alerts that spoolWebHookBatch() saved in the spool back out of
+    # it. The ones that fail to be delivered below are put back in.
+    spooledEntries = {id(entry) for alert in alerts for entry in alert.get("spoolEntries", [])}
+    if len(spooledEntries) > 0:
+        spool = loadWebhookSpool()
+        spool[:] = [entry for entry in spool if id(entry) not in spooledEntries]
+        webhookSpoolChanged = True
+    #
+    # Split the alerts into batches.
+    batches = [[]]
+    batchBytes = 0
+    for alert in alerts:
+        if len(batches[-1]) > 0 and (len(batches[-1]) >= config["webhookBatchSize"] or batchBytes + len(alert["data"]) + 1 > webhookBatchMaxBytes):
+            batches.append([])
+            batchBytes = 0
+        batches[-1].append(alert)
+        batchBytes += len(alert["data"]) + 1
+
+    for endpointKey in ["webhookEndpoint", "webhookEndpoint2"]:
+        if config.get(endpointKey) is None:
+            continue
+        for batch in batches:
+            if endpointKey not in webhookDownEndpoints:
+                data = b"[" + b",".join(alert["data"] for alert in batch) + b"]"
+                status = postWebHook(endpointKey, webhookHeaders, data)
+                if status is not None and 200 <= status < 300:
+                    continue
+                #
+                # A 4xx status most likely means the endpoint doesn't accept arrays, so send the alerts one at a time.
+                if status is not None and 400 <= status < 500 and status != 429:
+                    logger.warning(f'Webhook {config[endpointKey]} rejected a batch of {len(batch)} alerts, sending them one at a time for cluster {clusterName}.')
+                    for alert in batch:
+                        if endpointKey in webhookDownEndpoints or webhookRetryable(postWebHook(endpointKey, webhookHeaders, alert["data"])):
+                            spoolWebHook(endpointKey, alert["data"], alert["severity"], alert["alertCategory"])
+                    continue
+
+                if not webhookRetryable(status):
+                    logger.error(f'Webhook {config[endpointKey]} returned HTTP status code {status} for a batch of {len(batch)} alerts, they were not sent for cluster {clusterName}.')
+                    continue
+
+            for alert in batch:
+                spoolWebHook(endpointKey, alert["data"], alert["severity"], alert["alertCategory"])
+
+################################################################################
+# This function saves the alerts that are held back by sendWebHook() to the
+# webhook spool. It is called before a service saves its events, so if the run
+# doesn't get to flushWebHookBatch() (e.g. the Lambda function times out), the
+# alerts, which are now recorded as having been sent, are retried on a later
+# run instead of being lost.
+################################################################################
+def spoolWebHookBatch():
+    global config, webhookBatch
+
+    spooled = False
+    for alert in webhookBatch:
+        if "spoolEntries" in alert:
+            continue
+        alert["spoolEntries"] = []
+        for endpointKey in ["webhookEndpoint", "webhookEndpoint2"]:
+            if config.get(endpointKey) is not None:
+                alert["spoolEntries"].append(spoolWebHook(endpointKey, alert["data"], alert["severity"], alert["alertCategory"]))
+                spooled = True
+
+    if spooled:
+        saveWebhookSpool()
+
+################################################################################
+# This function returns the headers to send with a webhook. If the
+# webhookSecretARN is defined, it will include a "basic" authorization header
+# based on the credentials stored in the secret. It returns None if the
+# credentials couldn't be found in the secret.
+################################################################################
+def getWebhookHeaders():
+    global config, logger
+
     webhookHeaders = {
         "Content-Type": "application/json",
         "Accept": "application/json"
@@ -1323,85 +2333,390 @@ def sendWebHook(message, severity, alert_category):
     #
     # Add authorization header if a secret ARN is defined.
     if config.get("webhookSecretARN") is not None:
-        #
-        # Create a Secrets Manager client.
-        secretRegion = config["webhookSecretARN"].split(":")[3]
-        client = boto3.client(service_name='secretsmanager', region_name=secretRegion, verify=isIpHostname(config["secretsManagerEndPointHostname"]), endpoint_url=f'https://{config["secretsManagerEndPointHostname"]}')
         #
         # Get the username and password from the secret.
-        secretsInfo = client.get_secret_value(SecretId=config["webhookSecretARN"])
-        client.close()
-        secrets = json.loads(secretsInfo['SecretString'])
+        secrets = getSecret(config["webhookSecretARN"])
         if secrets.get(config['webhookSecretUsernameKey']) is None:
             logger.critical(f'Error, "{config["webhookSecretUsernameKey"]}" not found in secret "{config["webhookSecretARN"]}" for webhook {config["webhookEndpoint"]} for cluster {config["OntapAdminServer"]}.')
-            return
+            return None
 
         if secrets.get(config['webhookSecretPasswordKey']) is None:
             logger.critical(f'Error, "{config["webhookSecretPasswordKey"]}" not found in secret "{config["webhookSecretARN"]}" for webhook {config["webhookEndpoint"]} for cluster {config["OntapAdminServer"]}.')
-            return
+            return None
 
         username = secrets[config['webhookSecretUsernameKey']]
         password = secrets[config['webhookSecretPasswordKey']]
         webhookHeaders["Authorization"] = "Basic " + base64.b64encode(f'{username}:{password}'.encode('UTF-8')).decode('UTF-8')
+
+    return webhookHeaders
+
+################################################################################
+# This function returns True if the status returned by postWebHook() means the
+# delivery failed in a way that is worth retrying later. That is, the endpoint
+# couldn't be reached, or it returned a 5xx or 429 HTTP status code.
+################################################################################
+def webhookRetryable(status):
+    return status is None or status >= 500 or status == 429
+
+################################################################################
+# This function POSTs the data to the webhook endpoint defined by the
+# config[endpointKey] variable. It returns the HTTP status code, or None if the
+# endpoint couldn't be reached. On a retryable failure the endpoint is added
+# to the webhookDownEndpoints set so no more time is spent trying to reach it
+# during this run.
+################################################################################
+def postWebHook(endpointKey, webhookHeaders, data):
+    global config, clusterName, http, logger, webhookDownEndpoints
     #
     # Note that the urllib3 library that AWS natively provides for their Lambda functions
     # is of the 1.* version, so we have to use the syntax for that version.
     try:
-        logger.debug(f'Sending webhook to {config["webhookEndpoint"]} with these headers {webhookHeaders} and the following data: {data}')
-        response = http.request('POST', config['webhookEndpoint'], headers=webhookHeaders, body=data, timeout=5)
-        if response.status == 200:
+        logger.debug('Sending webhook to %s with these headers %s and the following data: %s', config[endpointKey], webhookHeaders, data)
+        response = http.request('POST', config[endpointKey], headers=webhookHeaders, body=data, timeout=5)
+        status = response.status
+        if 200 <= status < 300:
             logger.info(f"Webhook sent successfully for {clusterName}.")
         else:
-            logger.error(f"Error: Received a non-200 HTTP status code when sending the webhook. HTTP response code received: {response.status}. The data in the response: {response.data}. This was on the behalf of cluster {clusterName}.")
+            logger.error(f"Error: Received a non-2xx HTTP status code when sending the webhook. HTTP response code received: {status}. The data in the response: {response.data}. This was on the behalf of cluster {clusterName}.")
     except (urllib3.exceptions.ConnectTimeoutError, urllib3.exceptions.MaxRetryError):
-        message = f"Error: Exception occurred when sending to webhook {config['webhookEndpoint']} for cluster {clusterName}."
+        message = f"Error: Exception occurred when sending to webhook {config[endpointKey]} for cluster {clusterName}. The alert has been queued and will be retried on a later run."
         logger.critical(message)
         subject = f'CRITICAL: Monitor ONTAP Services failed to send the webhook for cluster {clusterName}'
+        snsClient = getAwsClient('sns', config["snsTopicArn"], config["snsEndPointHostname"])
         snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=subject[:100])
+        status = None
 
-    if config.get("webhookEndpoint2") is not None:
-        try:
-            logger.debug(f'Sending webhook to {config["webhookEndpoint2"]} with these headers {webhookHeaders} and the following data: {data}')
-            response = http.request('POST', config['webhookEndpoint2'], headers=webhookHeaders, body=data, timeout=5)
-            if response.status == 200:
-                logger.info(f"Webhook sent successfully for {clusterName}.")
-            else:
-                logger.error(f"Error: Received a non-200 HTTP status code when sending the webhook. HTTP response code received: {response.status}. The data in the response: {response.data}. This was on the behalf of cluster {clusterName}.")
-        except (urllib3.exceptions.ConnectTimeoutError, urllib3.exceptions.MaxRetryError):
-            message = f"Error: Exception occurred when sending to webhook {config['webhookEndpoint2']} for cluster {clusterName}."
-            logger.critical(message)
-            subject = f'CRITICAL: Monitor ONTAP Services failed to send the webhook for cluster {clusterName}'
-            snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=subject[:100])
+    if webhookRetryable(status):
+        webhookDownEndpoints.add(endpointKey)
+    return status
 
 ################################################################################
-# This function converts a severity string to a number value.
+# This function reads in the webhook spool. The spool holds the webhooks that
+# failed to be delivered so they can be retried on subsequent runs. It is
+# stored in the S3 bucket, or a local file if running standalone. It is only
+# read once per run.
 ################################################################################
-def severityToNumber(severity):
-    lseverity = severity.lower()
-    if lseverity == "critical":
-        return 1
-    elif lseverity == "error":
-        return 2
-    elif lseverity == "warning":
-        return 3
-    elif lseverity == "info":
-        return 4
-    elif lseverity == "debug":
-        return 5
-    else:
-        return 4
+def loadWebhookSpool():
+    global config, s3Client, webhookSpool, lambdaFunction
 
-################################################################################
-# This function sends the message to the various alerting systems.
-################################################################################
-def sendAlert(message, severity, alertCategory):
-    global config, snsClient, logger, cloudWatchClient, clusterName, lambdaFunction
+    if webhookSpool is not None:
+        return webhookSpool
 
-    #
-    # Log to syslog, or the console if syslog isn't configured.
-    if severity == "CRITICAL":
-        logger.critical(message)
-    elif severity == "ERROR":
+    if lambdaFunction:
+        try:
+            data = s3Client.get_object(Key=config["webhookSpoolFilename"], Bucket=config["s3BucketName"])
+        except botocore.exceptions.ClientError as err:
+            # If the error is that the object doesn't exist, then it will get created once a webhook fails.
+            if err.response['Error']['Code'] == "NoSuchKey":
+                webhookSpool = []
+            else:
+                raise Exception(err)
+        else:
+            webhookSpool = json.loads(data["Body"].read().decode('UTF-8'))
+    else:
+        try:
+            with open(config["webhookSpoolFilename"], "r") as spoolFile:
+                webhookSpool = json.load(spoolFile)
+        except FileNotFoundError:
+            webhookSpool = []
+
+    return webhookSpool
+
+################################################################################
+# This function saves the webhook spool if it has changed during this run.
+################################################################################
+def saveWebhookSpool():
+    global config, s3Client, webhookSpool, webhookSpoolChanged, lambdaFunction
+
+    if webhookSpool is None or not webhookSpoolChanged:
+        return
+
+    if lambdaFunction:
+        s3Client.put_object(Key=config["webhookSpoolFilename"], Bucket=config["s3BucketName"], Body=json.dumps(webhookSpool).encode('UTF-8'))
+    else:
+        with open(config["webhookSpoolFilename"], "w") as spoolFile:
+            json.dump(webhookSpool, spoolFile)
+    webhookSpoolChanged = False
+
+################################################################################
+# This function adds a webhook that failed to be delivered to the spool so it
+# can be retried on a later run. It returns the spool entry.
+################################################################################
+def spoolWebHook(endpointKey, data, severity, alertCategory):
+    global clusterName, logger, webhookSpoolChanged
+
+    spool = loadWebhookSpool()
+    curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    #
+    # Don't let the spool grow without bounds if the endpoint is down for a long time.
+    if len(spool) >= webhookSpoolMaxEntries:
+        logger.error(f'Webhook spool is full, dropping the oldest queued webhook for {spool[0]["endpoint"]} on cluster {clusterName}: {spool[0]["data"]}')
+        del spool[0]
+
+    entry = {
+        "endpoint": endpointKey,
+        "data": data.decode('UTF-8'),
+        "severity": severity,
+        "alertCategory": alertCategory,
+        "queued": curTimeSeconds,
+        "attempts": 1,
+        "nextAttempt": curTimeSeconds + webhookRetryBaseSeconds
+    }
+    spool.append(entry)
+    webhookSpoolChanged = True
+    return entry
+
+################################################################################
+# This function attempts to deliver the webhooks that are queued in the spool
+# and are due to be retried. Webhooks that are delivered are removed from the
+# spool. Ones that fail again have their next attempt backed off exponentially,
+# and as soon as an endpoint fails, no more attempts are made against it during
+# this run. Webhooks that have been queued for longer than
+# webhookSpoolMaxAgeSeconds are dropped.
+################################################################################
+def processWebhookSpool():
+    global config, clusterName, logger, webhookDownEndpoints, webhookSpoolChanged
+
+    spool = loadWebhookSpool()
+    if len(spool) == 0:
+        return
+
+    curTimeSeconds = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    webhookHeaders = None
+    sent = 0
+    i = 0
+    while i < len(spool):
+        entry = spool[i]
+        if config.get(entry["endpoint"]) is None or curTimeSeconds - entry["queued"] > webhookSpoolMaxAgeSeconds:
+            logger.error(f'Dropping queued webhook for {entry["endpoint"]} on cluster {clusterName} after {entry["attempts"]} attempts: {entry["data"]}')
+            del spool[i]
+            webhookSpoolChanged = True
+            continue
+
+        if entry["nextAttempt"] <= curTimeSeconds and entry["endpoint"] not in webhookDownEndpoints:
+            if webhookHeaders is None:
+                webhookHeaders = getWebhookHeaders()
+                if webhookHeaders is None:
+                    return
+            if not webhookRetryable(postWebHook(entry["endpoint"], webhookHeaders, entry["data"].encode('UTF-8'))):
+                del spool[i]
+                webhookSpoolChanged = True
+                sent += 1
+                continue
+            entry["attempts"] += 1
+            entry["nextAttempt"] = curTimeSeconds + min(webhookRetryBaseSeconds * 2 ** (entry["attempts"] - 1), webhookRetryMaxSeconds)
+            webhookSpoolChanged = True
+        i += 1
+
+    logger.info(f'Delivered {sent} queued webhooks, {len(spool)} remain queued for cluster {clusterName}.')
+
+################################################################################
+# This function converts a severity string to a number value.
+################################################################################
+def severityToNumber(severity):
+    lseverity = severity.lower()
+    if lseverity == "critical":
+        return 1
+    elif lseverity == "error":
+        return 2
+    elif lseverity == "warning":
+        return 3
+    elif lseverity == "info":
+        return 4
+    elif lseverity == "debug":
+        return 5
+    else:
+        return 4
+
+################################################################################
+# This function reads in the state of the alert rate limiter token buckets.
+# There is one bucket per alert category. It is only read once per run.
+################################################################################
+def loadAlertRateLimits():
+    global config, s3Client, alertRateLimits
+
+    if alertRateLimits is not None:
+        return alertRateLimits
+
+    try:
+        data = s3Client.get_object(Key=config["alertRateLimitFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created once an alert is sent.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            alertRateLimits = {}
+        else:
+            raise Exception(err)
+    else:
+        alertRateLimits = json.loads(data["Body"].read().decode('UTF-8'))
+
+    return alertRateLimits
+
+################################################################################
+# This function saves the state of the alert rate limiter token buckets if any
+# of them have changed during this run.
+################################################################################
+def saveAlertRateLimits():
+    global config, s3Client, alertRateLimits, alertRateLimitsChanged
+
+    if alertRateLimits is None or not alertRateLimitsChanged:
+        return
+
+    s3Client.put_object(Key=config["alertRateLimitFilename"], Bucket=config["s3BucketName"], Body=json.dumps(alertRateLimits).encode('UTF-8'))
+    alertRateLimitsChanged = False
+
+################################################################################
+# This function reads in the fingerprints of the records that were evaluated
+# on the previous run. It is only read once per run.
+################################################################################
+def loadRecordFingerprints():
+    global config, s3Client, recordFingerprints
+
+    if recordFingerprints is not None:
+        return recordFingerprints
+
+    try:
+        data = s3Client.get_object(Key=config["recordFingerprintsFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created at the end of the run.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            recordFingerprints = {}
+        else:
+            raise Exception(err)
+    else:
+        recordFingerprints = json.loads(data["Body"].read().decode('UTF-8'))
+
+    return recordFingerprints
+
+################################################################################
+# This function saves the record fingerprints if any of them have changed
+# during this run.
+################################################################################
+def saveRecordFingerprints():
+    global config, s3Client, recordFingerprints, recordFingerprintsChanged
+
+    if recordFingerprints is None or not recordFingerprintsChanged:
+        return
+
+    s3Client.put_object(Key=config["recordFingerprintsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(recordFingerprints, separators=(',', ':')).encode('UTF-8'))
+    recordFingerprintsChanged = False
+
+################################################################################
+# This function returns a compact fingerprint of the fields of a record. The
+# fields are given as dotted paths (e.g. "space.percent_used").
+################################################################################
+def getRecordFingerprint(record, fields):
+
+    values = []
+    for field in fields:
+        value = record
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        values.append(value)
+    return zlib.crc32(json.dumps(values, separators=(',', ':')).encode('UTF-8'))
+
+################################################################################
+# This function returns the records that the rules need to be evaluated
+# against. Which are the ones whose fingerprint, of the fields the rules use,
+# has changed since the previous run, and the ones that have an active alert,
+# so it gets refreshed. A record that hasn't changed, and doesn't have an
+# alert, would just not have an alert again. All the records are returned if
+# the rules themselves have changed. The fingerprints are kept under the name
+# passed in, and the number of records skipped is added to recordsSkipped.
+################################################################################
+def getChangedRecords(name, rules, records, fields, getRecordId, hasActiveAlert):
+    global recordFingerprintsChanged, recordsSkipped
+
+    fingerprints = loadRecordFingerprints()
+    rulesFingerprint = zlib.crc32(json.dumps(rules, sort_keys=True).encode('UTF-8'))
+    previous = fingerprints.get(name, {})
+    previousRecords = previous.get("records", {}) if previous.get("rules") == rulesFingerprint else {}
+
+    currentRecords = {}
+    changedRecords = []
+    for record in records:
+        recordId = getRecordId(record)
+        fingerprint = getRecordFingerprint(record, fields)
+        currentRecords[recordId] = fingerprint
+        if previousRecords.get(recordId) != fingerprint or hasActiveAlert(record):
+            changedRecords.append(record)
+
+    recordsSkipped += len(records) - len(changedRecords)
+    if previous.get("rules") != rulesFingerprint or previous.get("records") != currentRecords:
+        fingerprints[name] = {"rules": rulesFingerprint, "records": currentRecords}
+        recordFingerprintsChanged = True
+    return changedRecords
+
+################################################################################
+# This function takes a token from the alert category's token bucket. The
+# bucket holds up to alertRateLimit tokens and is refilled at a rate of
+# alertRateLimit tokens every alertRateLimitPeriod seconds. If there isn't a
+# token available, the alert is counted as suppressed, so it can be reported in
+# a summary at the end of the run, and False is returned. Otherwise it returns
+# True.
+################################################################################
+def takeAlertToken(message, severity, alertCategory):
+    global config, alertRateLimitsChanged
+
+    buckets = loadAlertRateLimits()
+    curTimeSeconds = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    capacity = config["alertRateLimit"]
+    bucket = buckets.get(alertCategory)
+    if bucket is None:
+        bucket = {"tokens": capacity, "time": curTimeSeconds, "suppressed": 0, "severity": "DEBUG", "samples": []}
+        buckets[alertCategory] = bucket
+    #
+    # Refill the bucket based on the time since it was last updated.
+    refill = (curTimeSeconds - bucket["time"]) * capacity / config["alertRateLimitPeriod"]
+    bucket["tokens"] = min(capacity, bucket["tokens"] + refill)
+    bucket["time"] = curTimeSeconds
+    alertRateLimitsChanged = True
+
+    if bucket["tokens"] >= 1:
+        bucket["tokens"] -= 1
+        return True
+
+    bucket["suppressed"] += 1
+    if severityToNumber(severity) < severityToNumber(bucket["severity"]):
+        bucket["severity"] = severity
+    if len(bucket["samples"]) < 3:
+        bucket["samples"].append(message)
+    return False
+
+################################################################################
+# This function sends one summary alert for each alert category that had alerts
+# suppressed by the rate limiter during this run. The summary is sent with the
+# highest severity of the alerts it is summarizing.
+################################################################################
+def sendSuppressedAlertSummaries():
+    global config, clusterName, alertRateLimits, alertRateLimitsChanged
+
+    if alertRateLimits is None:
+        return
+
+    for alertCategory, bucket in alertRateLimits.items():
+        if bucket["suppressed"] > 0:
+            message = f'{bucket["suppressed"]} more {alertCategory} alerts for cluster {clusterName} were suppressed because more than {config["alertRateLimit"]} alerts were generated within {config["alertRateLimitPeriod"]} seconds. Some of the suppressed alerts:'
+            for sample in bucket["samples"]:
+                message += "\n" + sample
+            sendAlert(message, bucket["severity"], alertCategory, rateLimit=False)
+            bucket["suppressed"] = 0
+            bucket["severity"] = "DEBUG"
+            bucket["samples"] = []
+            alertRateLimitsChanged = True
+
+################################################################################
+# This function sends the message to the various alerting systems. If the
+# alertRateLimit parameter is set, and rateLimit is True, the alert will only be
+# sent if the alert category's token bucket isn't empty.
+################################################################################
+def sendAlert(message, severity, alertCategory, rateLimit=True):
+    global config, logger, clusterName, lambdaFunction
+
+    #
+    # Log to syslog, or the console if syslog isn't configured.
+    if severity == "CRITICAL":
+        logger.critical(message)
+    elif severity == "ERROR":
         logger.error(message)
     elif severity == "WARNING":
         logger.warning(message)
@@ -1412,6 +2727,11 @@ def sendAlert(message, severity, alertCategory):
     else:
         logger.info(message)
     #
+    # If rate limiting is enabled, don't flood the alerting systems.
+    if rateLimit and config["alertRateLimit"] is not None and not takeAlertToken(message, severity, alertCategory):
+        logger.debug('Suppressed alert due to rate limiting for %s on cluster %s.', alertCategory, clusterName)
+        return
+    #
     # Publish to SNS.
     if lambdaFunction:
         source = " Lambda "
@@ -1420,10 +2740,12 @@ def sendAlert(message, severity, alertCategory):
     #
     # Ensure the subject is less than 100 characters.
     subject = f'{severity}:{source}Monitor ONTAP Services {alertCategory} for cluster {clusterName}'
+    snsClient = getAwsClient('sns', config["snsTopicArn"], config["snsEndPointHostname"])
     snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=subject[:100])
     #
     # Send to CloudWatch if defined.
-    if cloudWatchClient is not None:
+    if config["cloudWatchLogGroupArn"] is not None:
+        cloudWatchClient = getAwsClient('logs', config["cloudWatchLogGroupArn"], config["cloudWatchLogsEndPointHostname"])
         #
         # Create a new log stream for the current day if it doesn't exist.
         dateStr = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -1456,6 +2778,66 @@ def sendAlert(message, severity, alertCategory):
     if config.get('webhookEndpoint') is not None and severityToNumber(config['webhookSeverity']) >= severityToNumber(severity):
         sendWebHook(message, severity, alertCategory)
 
+################################################################################
+# This table drives the evaluation of the quota rules. For each rule (the
+# lower case version of its key) it holds the quota report field the
+# threshold is compared against, whether a value of 0 should be treated as
+# not set, and a function that returns the alert message. Functions are used,
+# instead of str.format() templates, since they are several times faster when
+# a lot of quotas are over their threshold.
+################################################################################
+quotaThresholdRules = {
+    "maxsoftquotainodespercentused": ("files_used_pct_soft_file_limit", False, lambda record, target, value, threshold: f'Quota Inode Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{target}on {clusterName} is using {value}% which is more than {threshold}% of its inodes.'),
+    "maxquotainodespercentused": ("files_used_pct_file_limit", False, lambda record, target, value, threshold: f'Quota Inode Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{target}on {clusterName} is using {value}% which is more than {threshold}% of its inodes.'),
+    "maxhardquotainodespercentused": ("files_used_pct_file_limit", False, lambda record, target, value, threshold: f'Quota Inode Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{target}on {clusterName} is using {value}% which is more than {threshold}% of its inodes.'),
+    "maxhardquotaspacepercentused": ("disk_used_pct_disk_limit", True, lambda record, target, value, threshold: f'Quota Space Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{target}on {clusterName} is using {value}% which is more than {threshold}% of its allocated space.'),
+    "maxsoftquotaspacepercentused": ("disk_used_pct_soft_disk_limit", True, lambda record, target, value, threshold: f'Quota Space Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{target}on {clusterName} is using {value}% which is more than {threshold}% of its allocated space.')
+}
+
+################################################################################
+# This function loads a numeric field from all the records into a column.
+# Records that don't have the field, or have it set to 0 when zeroIsUnset is
+# True, get a NaN so they will never be considered to be over a threshold.
+# The column is a NumPy array if NumPy is available, otherwise it is a list,
+# since a list is faster than an array.array() to build and scan in Python.
+################################################################################
+def buildColumn(records, field, zeroIsUnset=False):
+
+    nan = float("nan")
+    if zeroIsUnset:
+        column = [record.get(field) or nan for record in records]
+    else:
+        column = [record.get(field, nan) for record in records]
+        #
+        # A field that is set to null is rare, so only pay for replacing them when there are any.
+        if None in column:
+            column = [nan if value is None else value for value in column]
+
+    if numpy is not None:
+        return numpy.array(column, dtype=numpy.float64)
+    return column
+
+################################################################################
+# This function returns the part of a quota alert message that describes what
+# the quota applies to (the qtree and the users).
+################################################################################
+def quotaTargetStr(record):
+
+    userStr = ''
+    qtreeStr = ' '
+    if record["quota_type"] == "user":
+        userStr=f'associated with user(s) "{",".join(record["quota_target"])}" '
+    if record.get("tree") is not None:
+        qtreeStr=f' under qtree: {record["tree"]} '
+    return qtreeStr + userStr
+
+################################################################################
+# These are the fields of the quota report records that the quota rules, and
+# their alert messages, use. They make up the fingerprint of each record used
+# to tell if it has changed.
+################################################################################
+quotaFingerprintFields = ["vserver", "volume", "tree", "quota_type", "quota_target", "disk_used_pct_soft_disk_limit", "disk_used_pct_disk_limit", "files_used_pct_soft_file_limit", "files_used_pct_file_limit"]
+
 ################################################################################
 # This function is used to check utilization of quota limits.
 ################################################################################
@@ -1477,162 +2859,101 @@ def processQuotaUtilization(service):
     else:
         events = json.loads(data["Body"].read().decode('UTF-8'))
     #
-    # Run the API call to get the quota report.
+    # Consolidate the rules by the quota report field they are compared against.
+    fieldRules = {}
+    for rule in service["rules"]:
+        clearThresholds = getClearThresholds(rule, quotaThresholdRules)
+        for key in rule.keys():
+            lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
+            if lkey in quotaThresholdRules:
+                field = quotaThresholdRules[lkey][0]
+                if fieldRules.get(field) is None:
+                    fieldRules[field] = []
+                fieldRules[field].append((key, lkey, rule[key], min(rule[key], clearThresholds.get(lkey, rule[key]))))
+            elif lkey.endswith("clear") and lkey[:-len("clear")] in quotaThresholdRules:
+                #
+                # The clear thresholds are handled with the rule they belong to above.
+                continue
+            else:
+                message = f'Unknown quota matching condition type "{key}" found for cluster {clusterName}.'
+                logger.warning(message)
+    #
+    # Run the API calls to get the quota report.
     # For some reason the API version of the quota report became unreliable (i.e. returning 0 records)
     # so using the private CLI version of the API.
     #url = '/api/storage/quota/reports?fields=*&return_timeout=15'
-    records = getAllRecords('/api/private/cli/volume/quota/report?fields=vserver,volume,index,tree,quota-type,quota-target,disk-used,disk-limit,files-used,file-limit,soft-disk-limit,soft-file-limit,quota-specifier,disk-used-pct-soft-disk-limit,disk-used-pct-disk-limit,files-used-pct-soft-file-limit,files-used-pct-file-limit&return_timeout=15')
+    #
+    # Since only the quotas that are over a threshold are of interest, have ONTAP filter the report,
+    # using the lowest clear threshold for each field, so the quotas that already have an alert
+    # are returned until they drop below it. There is one request per field, since the
+    # query parameters are ANDed together, and the results are merged.
+    records = []
+    recordKeys = set()
+    anyRequestFailed = False
+    for field, rules in fieldRules.items():
+        lowestThreshold = min(rule[3] for rule in rules)
+        fieldRecords = getAllRecords(f'/api/private/cli/volume/quota/report?{field.replace("_", "-")}=%3E%3D{lowestThreshold}&fields=vserver,volume,index,tree,quota-type,quota-target,disk-used-pct-soft-disk-limit,disk-used-pct-disk-limit,files-used-pct-soft-file-limit,files-used-pct-file-limit&return_timeout=15')
+        anyRequestFailed = anyRequestFailed or requestFailed
+        for record in fieldRecords:
+            recordKey = (record.get("vserver"), record.get("volume"), record.get("index"))
+            if recordKey not in recordKeys:
+                recordKeys.add(recordKey)
+                records.append(record)
 
-    logger.info(f'Found {len(records)} quota report records cluster={clusterName} requestFailed={requestFailed}.')
-    if not requestFailed:
+    logger.info(f'Found {len(records)} quota report records over a threshold cluster={clusterName} anyRequestFailed={anyRequestFailed}.')
+    #
+    # Only age out the events if all the requests succeeded, since the quotas that are no longer
+    # over a threshold are simply no longer returned.
+    if not anyRequestFailed:
         #
         # Decrement the refresh field to know if any records have really gone away.
         for event in events:
             event["refresh"] -= 1
+        #
+        # Save the utilization of the quotas that were returned to the history store.
+        if config["historyRetentionDays"] is not None:
+            for record in records:
+                for field in fieldRules:
+                    recordHistorySample(f'quota.{field}', f'{record.get("vserver")}:{record.get("volume")}:{record.get("index")}', record.get(field))
 
-        for record in records:
-            for rule in service["rules"]:
-                for key in rule.keys():
-                    lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
-                    if lkey == "maxsoftquotainodespercentused":
-                        if(record.get("files_used_pct_soft_file_limit") is not None and record["files_used_pct_soft_file_limit"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                userStr = ''
-                                qtreeStr = ' '
-                                if record["quota_type"] == "user":
-                                    users = None
-                                    for user in record["quota_target"]:
-                                        if users is None:
-                                            users = user
-                                        else:
-                                            users += f',{user}'
-                                    userStr=f'associated with user(s) "{users}" '
-                                if record.get("tree") is not None:
-                                    qtreeStr=f' under qtree: {record["tree"]} '
-                                message = f'Quota Inode Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{qtreeStr}{userStr}on {clusterName} is using {record["files_used_pct_soft_file_limit"]}% which is more than {rule[key]}% of its inodes.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents=True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                        }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-    
-                    elif lkey == "maxquotainodespercentused" or lkey == "maxhardquotainodespercentused":
-                        if(record.get("files_used_pct_file_limit") is not None and record["files_used_pct_file_limit"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                userStr = ''
-                                qtreeStr = ' '
-                                if record["quota_type"] == "user":
-                                    users = None
-                                    for user in record["quota_target"]:
-                                        if users is None:
-                                            users = user
-                                        else:
-                                            users += f',{user}'
-                                    userStr=f'associated with user(s) "{users}" '
-                                if record.get("tree") is not None:
-                                    qtreeStr=f' under qtree: {record["tree"]} '
-                                message = f'Quota Inode Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{qtreeStr}{userStr}on {clusterName} is using {record["files_used_pct_file_limit"]}% which is more than {rule[key]}% of its inodes.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents=True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                        }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-    
-                    elif lkey == "maxhardquotaspacepercentused":
-                        if(record.get("disk_used_pct_disk_limit") and record["disk_used_pct_disk_limit"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                userStr = ''
-                                qtreeStr = ' '
-                                if record["quota_type"] == "user":
-                                    users = None
-                                    for user in record["quota_target"]:
-                                        if users is None:
-                                            users = user
-                                        else:
-                                            users += f',{user}'
-                                    userStr=f'associated with user(s) "{users}" '
-                                if record.get("tree") is not None:
-                                    qtreeStr=f' under qtree: {record["tree"]} '
-                                message = f'Quota Space Usage Alert: Hard quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{qtreeStr}{userStr}on {clusterName} is using {record["disk_used_pct_disk_limit"]}% which is more than {rule[key]}% of its allocated space.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents=True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                        }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-    
-                    elif lkey == "maxsoftquotaspacepercentused":
-                        if(record.get("disk_used_pct_soft_disk_limit") and record["disk_used_pct_soft_disk_limit"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            eventIndex = eventExist(events, uniqueIdentifier)
-                            if eventIndex < 0:
-                                userStr = ''
-                                qtreeStr = ' '
-                                if record["quota_type"] == "user":
-                                    users = None
-                                    for user in record["quota_target"]:
-                                        if users is None:
-                                            users = user
-                                        else:
-                                            users += f',{user}'
-                                    userStr=f'associated with user(s) "{users}" '
-                                if record.get("tree") is not None:
-                                    qtreeStr=f' under qtree: {record["tree"]} '
-                                message = f'Quota Space Usage Alert: Soft quota of type "{record["quota_type"]}" on {record["vserver"]}:/{record["volume"]}{qtreeStr}{userStr}on {clusterName} is using {record["disk_used_pct_soft_disk_limit"]}% which is more than {rule[key]}% of its allocated space.'
-                                sendAlert(message, "WARNING", alertCategory)
-                                changedEvents=True
-                                event = {
-                                    "index": uniqueIdentifier,
-                                    "message": message,
-                                    "refresh": eventResilience
+        #
+        # Only the quotas that have changed since the last run, or that have an active alert,
+        # need to be evaluated. The events' unique identifiers start with the quota's index.
+        activeIndexes = set(event["index"].split("_")[0] for event in events)
+        records = getChangedRecords("quota", service["rules"], records, quotaFingerprintFields, lambda record: f'{record.get("vserver")}:{record.get("volume")}:{record.get("index")}', lambda record: str(record.get("index")) in activeIndexes)
+        #
+        # Load each field into a column once, and compare it against all its thresholds in one pass.
+        # The alert message is only built for the records that are over a threshold.
+        for field, rules in fieldRules.items():
+            column = buildColumn(records, field, quotaThresholdRules[rules[0][1]][1])
+            breaches = findThresholdBreaches(column, [rule[3] for rule in rules])
+            for ((key, lkey, threshold, _), recordIndexes) in zip(rules, breaches):
+                messageFunction = quotaThresholdRules[lkey][2]
+                for recordIndex in recordIndexes:
+                    record = records[recordIndex]
+                    uniqueIdentifier = str(record["index"]) + "_" + key
+                    eventIndex = eventExist(events, uniqueIdentifier)
+                    if eventIndex < 0:
+                        #
+                        # Only send a new alert if it is over the threshold, not just the clear threshold.
+                        if column[recordIndex] < threshold:
+                            continue
+                        message = messageFunction(record, quotaTargetStr(record), record[field], threshold)
+                        sendAlert(message, "WARNING", alertCategory)
+                        changedEvents=True
+                        event = {
+                                "index": uniqueIdentifier,
+                                "message": message,
+                                "refresh": eventResilience
                                 }
-                                events.append(event)
-                            else:
-                                # If the event was found, reset the refresh count. If it is just one less
-                                # than the max, then it means it was decremented above so there wasn't
-                                # really a change in state.
-                                if events[eventIndex]["refresh"] != (eventResilience - 1):
-                                    changedEvents = True
-                                events[eventIndex]["refresh"] = eventResilience
-    
+                        events.append(event)
                     else:
-                        message = f'Unknown quota matching condition type "{key}" found for cluster {clusterName}.'
-                        logger.warning(message)
+                        # If the event was found, reset the refresh count. If it is just one less
+                        # than the max, then it means it was decremented above so there wasn't
+                        # really a change in state.
+                        if events[eventIndex]["refresh"] != (eventResilience - 1):
+                            changedEvents = True
+                        events[eventIndex]["refresh"] = eventResilience
         #
         # After processing the records, see if any events need to be removed.
         i = len(events) - 1
@@ -1641,28 +2962,488 @@ def processQuotaUtilization(service):
                 logger.debug(f'Deleting event: {events[i]["message"]} Cluster={clusterName}')
                 del events[i]
                 changedEvents = True
-            else:
-                # If an event wasn't refreshed, then we need to save the new refresh count.
-                if events[i]["refresh"] != eventResilience:
-                    changedEvents = True
-            i -= 1
+            else:
+                # If an event wasn't refreshed, then we need to save the new refresh count.
+                if events[i]["refresh"] != eventResilience:
+                    changedEvents = True
+            i -= 1
+    #
+    # If the events array changed, save it.
+    if(changedEvents):
+        spoolWebHookBatch()
+        s3Client.put_object(Key=config["quotaEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+
+################################################################################
+################################################################################
+def processVserver(service):
+    global config, s3Client, clusterName, logger
+
+    alertCategory = "Vserver health Alert"
+    changedEvents=False
+    anyRequestFailed = False
+    #
+    # Get the saved events so we can ensure we are only reporting on new ones.
+    try:
+        data = s3Client.get_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            events = []
+        else:
+            raise Exception(err)
+    else:
+        events = json.loads(data["Body"].read().decode('UTF-8'))
+    #
+    # Decrement the refresh field to know if any records have really gone away.
+    for event in events:
+        event["refresh"] -= 1
+    #
+    # Consolidate the rules
+    vserverState = None
+    nfsProtocolState = None
+    cifsProtocolState = None
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
+            if lkey == "vserverstate":
+                vserverState = rule[key]
+                vserverStateKey = key
+            elif lkey == "nfsprotocolstate":
+                nfsProtocolState = rule[key]
+                nfsProtocolStateKey = key
+            elif lkey == "cifsprotocolstate":
+                cifsProtocolState = rule[key]
+                cifsProtocolStateKey = key
+    #
+    # Fetch the vserver state, and the NFS and CIFS protocol state, concurrently,
+    # depending on which rules are enabled.
+    requests = []
+    if vserverState:
+        requests.append(('/api/svm/svms?fields=state&return_timeout=15', False))
+    if nfsProtocolState:
+        requests.append(('/api/protocols/nfs/services?fields=state&return_timeout=15', False))
+    if cifsProtocolState:
+        requests.append(('/api/protocols/cifs/services?fields=enabled&return_timeout=15', False))
+    results = getAllRecordsConcurrently(requests)
+    #
+    # Index the results by SVM so all the checks can be done in a single pass.
+    svms = {}
+    for i in range(len(requests)):
+        (records, failed) = results[i]
+        anyRequestFailed = anyRequestFailed or failed
+        url = requests[i][0]
+        logger.info(f'Found {len(records)} records from {url.split("?")[0]} to check on cluster {clusterName} requestFailed={failed}.')
+        for record in records:
+            if url.startswith('/api/svm/svms'):
+                svm = svms.setdefault(record["uuid"], {"name": record["name"]})
+                svm["state"] = record["state"]
+            else:
+                svm = svms.setdefault(record["svm"]["uuid"], {"name": record["svm"]["name"]})
+                if url.startswith('/api/protocols/nfs'):
+                    svm["nfsState"] = record["state"]
+                else:
+                    svm["cifsEnabled"] = record["enabled"]
+
+    for svmUUID, svm in svms.items():
+        alerts = []
+        if svm.get("state") is not None and svm["state"].lower() != "running":
+            alerts.append((str(svmUUID) + "_" + vserverStateKey, f'SVM State Alert: SVM {svm["name"]} on {clusterName} is not online.'))
+        if svm.get("nfsState") is not None and svm["nfsState"].lower() != "online":
+            alerts.append((str(svmUUID) + "_" + nfsProtocolStateKey, f'NFS Protocol State Alert: NFS protocol on {svm["name"]} on {clusterName} is not online.'))
+        if svm.get("cifsEnabled") is not None and not svm["cifsEnabled"]:
+            alerts.append((str(svmUUID) + "_" + cifsProtocolStateKey, f'CIFS Protocol State Alert: CIFS protocol on {svm["name"]} on {clusterName} is not online.'))
+
+        for (uniqueIdentifier, message) in alerts:
+            eventIndex = eventExist(events, uniqueIdentifier)
+            if eventIndex < 0:
+                sendAlert(message, "WARNING", alertCategory)
+                changedEvents=True
+                event = {
+                        "index": uniqueIdentifier,
+                        "message": message,
+                        "refresh": eventResilience
+                        }
+                events.append(event)
+            else:
+                # If the event was found, reset the refresh count. If it is just one less
+                # than the max, then it means it was decremented above so there wasn't
+                # really a change in state.
+                if events[eventIndex]["refresh"] != (eventResilience - 1):
+                    changedEvents = True
+                events[eventIndex]["refresh"] = eventResilience
+
+    #
+    # After processing the records, see if any events need to be removed.
+    # However, if any of the requests failed, and no new events were detected, then we should
+    # hold off on removing any events since we can't be sure if they are resolved or not.
+    # This does leave for a corner case of just some of the requests failing and some events
+    # being resolved, but it is better than the alternative of erroneously clearing events
+    # and causing duplicated alerts when the API starts working again.
+    if not anyRequestFailed or changedEvents:
+        i = len(events) - 1
+        while i >= 0:
+            if events[i]["refresh"] <= 0:
+                logger.debug(f'Deleting event: {events[i]["message"]} for cluster {clusterName}')
+                del events[i]
+                changedEvents = True
+            else:
+                # If an event wasn't refreshed, then we need to save the new refresh count.
+                if events[i]["refresh"] != eventResilience:
+                    changedEvents = True
+            i -= 1
+    #
+    # If the events array changed, save it.
+    if(changedEvents):
+        spoolWebHookBatch()
+        s3Client.put_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+
+################################################################################
+# This table drives the evaluation of the performance rules. For each rule
+# (the lower case version of its key) it holds the volume metric type and
+# counter to compare against the rule's threshold, whether the rule is
+# subject to the minIops rule, and the alert message format.
+################################################################################
+performanceThresholdRules = {
+    "volumelatencymicroseconds": ("latency", "total", True, 'Volume Latency Alert: volume {record[svm][name]}:{record[name]} on {clusterName} has an average latency of {value:.0f} microseconds, which is more or equal to {threshold} microseconds.'),
+    "volumereadlatencymicroseconds": ("latency", "read", True, 'Volume Latency Alert: volume {record[svm][name]}:{record[name]} on {clusterName} has an average read latency of {value:.0f} microseconds, which is more or equal to {threshold} microseconds.'),
+    "volumewritelatencymicroseconds": ("latency", "write", True, 'Volume Latency Alert: volume {record[svm][name]}:{record[name]} on {clusterName} has an average write latency of {value:.0f} microseconds, which is more or equal to {threshold} microseconds.'),
+    "volumeiopsmax": ("iops", "total", False, 'Volume IOPS Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is doing {value:.0f} IOPS, which is more or equal to {threshold} IOPS.'),
+    "volumethroughputmax": ("throughput", "total", False, 'Volume Throughput Alert: volume {record[svm][name]}:{record[name]} on {clusterName} is doing {value:.0f} bytes per second, which is more or equal to {threshold} bytes per second.')
+}
+
+################################################################################
+# This function loads a volume performance counter into a column, like
+# buildColumn() does for a field. Volumes that don't have a valid metric, or
+# that are doing less than minIops (if given), get NaN so they never match.
+################################################################################
+def buildMetricColumn(records, metricType, counter, minIops=None):
+
+    nan = float("nan")
+    column = array.array('d')
+    for record in records:
+        value = None
+        metric = record.get("metric")
+        if metric is not None and metric.get("status", "ok") == "ok":
+            if minIops is None or metric.get("iops", {}).get("total", 0) >= minIops:
+                value = metric.get(metricType, {}).get(counter)
+        column.append(nan if value is None else value)
+
+    if numpy is not None:
+        return numpy.frombuffer(column, dtype=numpy.float64)
+    return column
+
+################################################################################
+# This function finds the topK volumes with the highest total value of the
+# metric type (e.g. "iops") passed in. It keeps a heap of at most topK entries
+# while going through the records, so it doesn't have to sort all of them.
+# Volumes that don't have a valid metric, or are idle, are skipped. It returns
+# a list of (value, record) tuples, sorted from the highest to the lowest.
+################################################################################
+def findTopVolumes(records, metricType, topK):
+
+    heap = []
+    for recordIndex, record in enumerate(records):
+        value = getVolumeMetric(record, metricType)
+        if value is None:
+            continue
+        if len(heap) < topK:
+            heapq.heappush(heap, (value, recordIndex))
+        elif value > heap[0][0]:
+            heapq.heapreplace(heap, (value, recordIndex))
+
+    return [(value, records[recordIndex]) for (value, recordIndex) in sorted(heap, reverse=True)]
+
+################################################################################
+# This function returns the total value of the metric type (e.g. "iops") of
+# the volume record passed in, or None if it doesn't have a valid metric, or
+# the volume is idle.
+################################################################################
+def getVolumeMetric(record, metricType):
+
+    metric = record.get("metric")
+    if metric is None or metric.get("status", "ok") != "ok":
+        return None
+    value = metric.get(metricType, {}).get("total")
+    return value if value else None
+
+################################################################################
+# This function returns the hot volumes list, as (value, record) tuples sorted
+# from the highest to the lowest. To keep the list from changing every time
+# two volumes near the bottom of it swap places, it starts from the members of
+# the list from the previous run. A previous member stays in the list, as long
+# as it still has a valid metric, unless one of the topK volumes found by
+# findTopVolumes() beats it by more than minChangePercent. New volumes fill
+# any places left by the members that went idle or away.
+################################################################################
+def findHotVolumes(records, metricType, topK, previousMembers, minChangePercent):
+
+    previous = set(previousMembers)
+    retained = []
+    if len(previous) > 0:
+        for record in records:
+            if record["uuid"] in previous:
+                value = getVolumeMetric(record, metricType)
+                if value is not None:
+                    retained.append((value, record))
+    retained.sort(key=lambda entry: entry[0], reverse=True)
+    retained = retained[:topK]
+    challengers = [entry for entry in findTopVolumes(records, metricType, topK) if entry[1]["uuid"] not in previous]
+    #
+    # Fill the empty places first, then have the challengers, hottest first, take on
+    # the coolest of the previous members until one isn't hot enough to replace it.
+    members = retained
+    while len(members) < topK and len(challengers) > 0:
+        members.append(challengers.pop(0))
+    for (value, record) in challengers:
+        coolest = min(range(len(members)), key=lambda i: members[i][0])
+        if value <= members[coolest][0] * (1 + minChangePercent/100):
+            break
+        members[coolest] = (value, record)
+
+    return sorted(members, key=lambda entry: entry[0], reverse=True)
+
+################################################################################
+# This function is used to check the performance of the volumes. ONTAP keeps
+# the average latency, IOPS and throughput of each volume, over a short
+# interval, in the volume's "metric" field.
+################################################################################
+def processPerformance(service):
+    global config, s3Client, clusterName, logger, requestFailed
+
+    alertCategory = "Performance Alert"
+    changedEvents = False
+    #
+    # Consolidate the rules by the counter they are compared against.
+    minIops = None
+    hotVolumesTopK = None
+    hotVolumesTopKKey = None
+    hotVolumesRankBy = "iops"
+    hotVolumesMinChange = hotVolumesMinChangePercent
+    counterRules = {}
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey in performanceThresholdRules:
+                counter = performanceThresholdRules[lkey][0:2]
+                if counterRules.get(counter) is None:
+                    counterRules[counter] = []
+                counterRules[counter].append((key, lkey, rule[key]))
+            elif lkey == "miniops":
+                minIops = rule[key]
+            elif lkey == "hotvolumestopk":
+                hotVolumesTopK = rule[key]
+                hotVolumesTopKKey = key
+            elif lkey == "hotvolumesrankby":
+                if rule[key].lower() in ["iops", "latency", "throughput"]:
+                    hotVolumesRankBy = rule[key].lower()
+                else:
+                    logger.warning(f'Unknown hotVolumesRankBy value: "{rule[key]}" found on cluster {clusterName}.')
+            elif lkey == "hotvolumesminchangepercent":
+                hotVolumesMinChange = rule[key]
+            else:
+                logger.warning(f'Unknown performance alert type: "{key}" found on cluster {clusterName}.')
+    #
+    # Get the saved events so we can ensure we are only reporting on new ones.
+    try:
+        data = s3Client.get_object(Key=config["performanceEventsFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            events = []
+        else:
+            raise Exception(err)
+    else:
+        events = json.loads(data["Body"].read().decode('UTF-8'))
+    #
+    # Get the performance metrics of all the volumes in one pass. If there aren't any rules left,
+    # there is no need to, but the events from the rules that were removed still have to be aged out.
+    if len(counterRules) > 0 or hotVolumesTopK:
+        records = getAllRecords('/api/storage/volumes?fields=svm,metric&return_timeout=15')
+        logger.info(f'Found {len(records)} volumes to check the performance of on cluster {clusterName}. requestFailed={requestFailed}.')
+        #
+        # If the request failed, bail, so the events aren't aged out.
+        if requestFailed:
+            return
+    else:
+        records = []
+    #
+    # Save the performance information to the history store.
+    if config["historyRetentionDays"] is not None:
+        for record in records:
+            metric = record.get("metric")
+            if metric is not None and metric.get("status", "ok") == "ok":
+                recordHistorySample("volume.latency", record["uuid"], metric.get("latency", {}).get("total"))
+                recordHistorySample("volume.iops", record["uuid"], metric.get("iops", {}).get("total"))
+    #
+    # Decrement the refresh field to know if any records have really gone away.
+    for event in events:
+        event["refresh"] -= 1
+    #
+    # Load each counter into a column once, and compare it against all its thresholds in one pass.
+    for (metricType, counter), rules in counterRules.items():
+        column = buildMetricColumn(records, metricType, counter, minIops if performanceThresholdRules[rules[0][1]][2] else None)
+        breaches = findThresholdBreaches(column, [rule[2] for rule in rules])
+        for ((key, lkey, threshold), recordIndexes) in zip(rules, breaches):
+            for recordIndex in recordIndexes:
+                record = records[recordIndex]
+                uniqueIdentifier = record["uuid"] + "_" + key
+                eventIndex = eventExist(events, uniqueIdentifier)
+                if eventIndex < 0:
+                    message = performanceThresholdRules[lkey][3].format(record=record, clusterName=clusterName, value=column[recordIndex], threshold=threshold)
+                    sendAlert(message, "WARNING", alertCategory)
+                    changedEvents = True
+                    event = {
+                        "index": uniqueIdentifier,
+                        "message": message,
+                        "refresh": eventResilience
+                        }
+                    events.append(event)
+                else:
+                    # If the event was found, reset the refresh count. If it is just one less
+                    # than the max, then it means it was decremented above so there wasn't
+                    # really a change in state.
+                    if events[eventIndex]["refresh"] != (eventResilience - 1):
+                        changedEvents = True
+                    events[eventIndex]["refresh"] = eventResilience
+    #
+    # Report on the hottest volumes, but only when the set of volumes changes from the previous run.
+    # The previous set is kept in an event, along with the last report sent.
+    if hotVolumesTopK:
+        uniqueIdentifier = f'{hotVolumesTopKKey}_{hotVolumesRankBy}_{hotVolumesTopK}'
+        eventIndex = eventExist(events, uniqueIdentifier)
+        previousMembers = events[eventIndex]["members"] if eventIndex >= 0 else []
+        topVolumes = findHotVolumes(records, hotVolumesRankBy, hotVolumesTopK, previousMembers, hotVolumesMinChange)
+        members = [record["uuid"] for (value, record) in topVolumes]
+        if set(members) != set(previousMembers) and len(members) > 0:
+            units = {"iops": "IOPS", "latency": "microseconds", "throughput": "bytes per second"}[hotVolumesRankBy]
+            message = f'Hot Volumes Report: The top {len(members)} volumes by {hotVolumesRankBy} on {clusterName} have changed:'
+            for rank, (value, record) in enumerate(topVolumes, start=1):
+                newStr = " (new)" if record["uuid"] not in previousMembers else ""
+                message += f'\n{rank}. {record["svm"]["name"]}:{record["name"]} {value:.0f} {units}{newStr}'
+            sendAlert(message, "INFO", alertCategory)
+            event = {
+                "index": uniqueIdentifier,
+                "message": message,
+                "refresh": eventResilience,
+                "members": members
+                }
+            if eventIndex < 0:
+                events.append(event)
+            else:
+                events[eventIndex] = event
+            changedEvents = True
+        elif eventIndex >= 0:
+            if events[eventIndex]["refresh"] != (eventResilience - 1):
+                changedEvents = True
+            events[eventIndex]["refresh"] = eventResilience
+    #
+    # After processing the records, see if any events need to be removed.
+    i = len(events) - 1
+    while i >= 0:
+        if events[i]["refresh"] <= 0:
+            logger.debug(f'Deleting event: {events[i]["message"]} for cluster {clusterName}')
+            del events[i]
+            changedEvents = True
+        else:
+            # If an event wasn't refreshed, then we need to save the new refresh count.
+            if events[i]["refresh"] != eventResilience:
+                changedEvents = True
+        i -= 1
     #
     # If the events array changed, save it.
     if(changedEvents):
-        s3Client.put_object(Key=config["quotaEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+        spoolWebHookBatch()
+        s3Client.put_object(Key=config["performanceEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
 
 ################################################################################
+# This function gets the schema of a counter table. It returns a dictionary,
+# keyed by counter name, of [type, denominator] lists, or None if the API call
+# failed.
 ################################################################################
-def processVserver(service):
-    global config, s3Client, clusterName, logger, requestFailed
+def getCounterSchema(table):
+    global config, http, headers, logger
 
-    alertCategory = "Vserver health Alert"
-    changedEvents=False
-    anyRequestFailed = False
+    endpoint = f'https://{config["OntapAdminServer"]}/api/cluster/counter/tables/{urllib.parse.quote(table, safe="")}?fields=counter_schemas&return_timeout=15'
+    response = http.request('GET', endpoint, headers=headers)
+    if response.status == 200:
+        data = json.loads(response.data)
+        schema = {}
+        for counter in data.get("counter_schemas", []):
+            schema[counter["name"]] = [counter.get("type", "raw"), counter.get("denominator", {}).get("name")]
+        return schema
+    else:
+        logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+        return None
+
+################################################################################
+# This function calculates the value of a counter from its current and previous
+# raw values, the same way ONTAP does, based on the counter's type:
+#   raw     - The current value.
+#   delta   - The change since the previous sample.
+#   rate    - The change per second.
+#   average - The change divided by the change of its denominator.
+#   percent - The average as a percentage.
+# The current and previous values are dictionaries of raw counter values, and
+# elapsedSeconds is the time between them. It returns None if the value can't
+# be calculated (e.g. there isn't a previous sample, or the counter wrapped).
+################################################################################
+def calculateCounterValue(counter, schema, current, previous, elapsedSeconds):
+
+    (counterType, denominator) = schema.get(counter, ["raw", None])
+    if current.get(counter) is None:
+        return None
+    if counterType == "raw":
+        return current[counter]
+
+    if previous is None or previous.get(counter) is None or current[counter] < previous[counter]:
+        return None
+    delta = current[counter] - previous[counter]
+    if counterType == "delta":
+        return delta
+    if counterType == "rate":
+        return delta / elapsedSeconds if elapsedSeconds > 0 else None
+
+    if current.get(denominator) is None or previous.get(denominator) is None:
+        return None
+    denominatorDelta = current[denominator] - previous[denominator]
+    if denominatorDelta <= 0:
+        return None
+    if counterType == "percent":
+        return delta / denominatorDelta * 100
+    return delta / denominatorDelta
+
+################################################################################
+# This function is used to check ONTAP performance counters. Most counters are
+# cumulative, so the raw values from the previous run are kept in the
+# counterSamplesFilename S3 object to calculate the current values from.
+################################################################################
+def processCounters(service):
+    global config, s3Client, clusterName, logger
+
+    alertCategory = "Performance Alert"
+    changedEvents = False
+    #
+    # Validate the rules and consolidate them by table.
+    tableRules = {}
+    for rule in service["rules"]:
+        unknownKeys = [key for key in rule.keys() if key.lower() not in ["table", "counter", "maxvalue", "headroomcounter", "minheadroom"]]
+        if len(unknownKeys) > 0:
+            logger.warning(f'Unknown counters rule key(s): {unknownKeys} found on cluster {clusterName}.')
+        lrule = {key.lower(): value for key, value in rule.items()}
+        if lrule.get("table") is None or lrule.get("counter") is None or (lrule.get("maxvalue") is None and lrule.get("minheadroom") is None) or \
+                (lrule.get("minheadroom") is not None and lrule.get("headroomcounter") is None):
+            logger.warning(f'Incomplete counters rule: {rule} found on cluster {clusterName}.')
+            continue
+        if tableRules.get(lrule["table"]) is None:
+            tableRules[lrule["table"]] = []
+        tableRules[lrule["table"]].append(lrule)
+
+    if len(tableRules) == 0:
+        return
     #
     # Get the saved events so we can ensure we are only reporting on new ones.
     try:
-        data = s3Client.get_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"])
+        data = s3Client.get_object(Key=config["counterEventsFilename"], Bucket=config["s3BucketName"])
     except botocore.exceptions.ClientError as err:
         # If the error is that the object doesn't exist, then it will get created once an alert it sent.
         if err.response['Error']['Code'] == "NoSuchKey":
@@ -1672,120 +3453,110 @@ def processVserver(service):
     else:
         events = json.loads(data["Body"].read().decode('UTF-8'))
     #
+    # Get the counter schemas and the raw values from the previous run.
+    try:
+        data = s3Client.get_object(Key=config["counterSamplesFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created below.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            counterState = {"schemas": {}, "samples": {}}
+        else:
+            raise Exception(err)
+    else:
+        counterState = json.loads(data["Body"].read().decode('UTF-8'))
+    #
+    # The schema of a table is only retrieved the first time it is used. If it can't be retrieved,
+    # the table is skipped this run, but its events and saved samples are kept.
+    ruleTables = set(tableRules.keys())
+    anyRequestFailed = False
+    for table in list(tableRules.keys()):
+        if counterState["schemas"].get(table) is None:
+            schema = getCounterSchema(table)
+            if schema is None:
+                anyRequestFailed = True
+                del tableRules[table]
+                continue
+            counterState["schemas"][table] = schema
+    #
+    # Get the rows of all the tables concurrently, asking for just the counters that are needed.
+    tables = list(tableRules.keys())
+    requests = []
+    for table in tables:
+        schema = counterState["schemas"][table]
+        counters = set()
+        for rule in tableRules[table]:
+            for counter in [rule["counter"], rule.get("headroomcounter")]:
+                if counter is not None:
+                    counters.add(counter)
+                    if schema.get(counter, ["raw", None])[1] is not None:
+                        counters.add(schema[counter][1])
+        requests.append((f'/api/cluster/counter/tables/{urllib.parse.quote(table, safe="")}/rows?fields=id,counters&counters.name={"|".join(sorted(counters))}&return_timeout=15', False))
+    results = getAllRecordsConcurrently(requests)
+    curTimeSeconds = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    #
     # Decrement the refresh field to know if any records have really gone away.
     for event in events:
         event["refresh"] -= 1
-    #
-    # Consolidate the rules
-    vserverState = None
-    nfsProtocolState = None
-    cifsProtocolState = None
-    for rule in service["rules"]:
-        for key in rule.keys():
-            lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
-            if lkey == "vserverstate":
-                vserverState = rule[key]
-                vserverStateKey = key
-            elif lkey == "nfsprotocolstate":
-                nfsProtocolState = rule[key]
-                nfsProtocolStateKey = key
-            elif lkey == "cifsprotocolstate":
-                cifsProtocolState = rule[key]
-                cifsProtocolStateKey = key
-    #
-    # Check for any vservers that are down.
-    if vserverState is not None and vserverState:
-        #
-        # Run the API call to get the vserver state for each vserver.
-        records = getAllRecords('/api/svm/svms?fields=state&return_timeout=15')
-        anyRequestFailed = anyRequestFailed or requestFailed
-        logger.info(f'Found {len(records)} vservers to check on cluster {clusterName} requestFailed={requestFailed}.')
-        for record in records:
-            if record["state"].lower() != "running":
-                uniqueIdentifier = str(record["uuid"]) + "_" + vserverStateKey
-                eventIndex = eventExist(events, uniqueIdentifier)
-                if eventIndex < 0:
-                    message = f'SVM State Alert: SVM {record["name"]} on {clusterName} is not online.'
-                    sendAlert(message, "WARNING", alertCategory)
-                    changedEvents=True
-                    event = {
-                            "index": uniqueIdentifier,
-                            "message": message,
-                            "refresh": eventResilience
-                            }
-                    events.append(event)
-                else:
-                    # If the event was found, reset the refresh count. If it is just one less
-                    # than the max, then it means it was decremented above so there wasn't
-                    # really a change in state.
-                    if events[eventIndex]["refresh"] != (eventResilience - 1):
-                        changedEvents = True
-                    events[eventIndex]["refresh"] = eventResilience
 
-    if nfsProtocolState is not None and nfsProtocolState:
-        #
-        # Run the API call to get the NFS protocol state for each vserver.
-        records = getAllRecords('/api/protocols/nfs/services?fields=state&return_timeout=15')
-        anyRequestFailed = anyRequestFailed or requestFailed
-        logger.info(f'Found {len(records)} nfs vservers to check on cluster {clusterName} requestFailed={requestFailed}.')
-        for record in records:
-            if record["state"].lower() != "online":
-                uniqueIdentifier = str(record["svm"]["uuid"]) + "_" + nfsProtocolStateKey
-                eventIndex = eventExist(events, uniqueIdentifier)
-                if eventIndex < 0:
-                    message = f'NFS Protocol State Alert: NFS protocol on {record["svm"]["name"]} on {clusterName} is not online.'
-                    sendAlert(message, "WARNING", alertCategory)
-                    changedEvents=True
-                    event = {
-                            "index": uniqueIdentifier,
-                            "message": message,
-                            "refresh": eventResilience
-                            }
-                    events.append(event)
-                else:
-                    # If the event was found, reset the refresh count. If it is just one less
-                    # than the max, then it means it was decremented above so there wasn't
-                    # really a change in state.
-                    if events[eventIndex]["refresh"] != (eventResilience - 1):
-                        changedEvents = True
-                    events[eventIndex]["refresh"] = eventResilience
+    for table, (rows, requestFailed) in zip(tables, results):
+        logger.info(f'Found {len(rows)} rows in counter table {table} on cluster {clusterName}. requestFailed={requestFailed}.')
+        if requestFailed:
+            anyRequestFailed = True
+            continue
 
-    if cifsProtocolState is not None and cifsProtocolState:
-        #
-        # Run the API call to get the CIFS protocol state for each vserver.
-        records = getAllRecords('/api/protocols/cifs/services?fields=enabled&return_timeout=15')
-        anyRequestFailed = anyRequestFailed or requestFailed
-        logger.info(f'Found {len(records)} cifs vservers to check on cluster {clusterName} requestFailed={requestFailed}.')
-        for record in records:
-            if not record["enabled"]:
-                uniqueIdentifier = str(record["svm"]["uuid"]) + "_" + cifsProtocolStateKey
-                eventIndex = eventExist(events, uniqueIdentifier)
-                if eventIndex < 0:
-                    message = f'CIFS Protocol State Alert: CIFS protocol on {record["svm"]["name"]} on {clusterName} is not online.'
-                    sendAlert(message, "WARNING", alertCategory)
-                    changedEvents=True
-                    event = {
+        schema = counterState["schemas"][table]
+        previousSamples = counterState["samples"].get(table, {"time": curTimeSeconds, "rows": {}})
+        elapsedSeconds = curTimeSeconds - previousSamples["time"]
+        currentRows = {}
+        for row in rows:
+            current = {counter["name"]: counter["value"] for counter in row.get("counters", []) if counter.get("value") is not None}
+            currentRows[row["id"]] = current
+            previous = previousSamples["rows"].get(row["id"])
+            for rule in tableRules[table]:
+                value = calculateCounterValue(rule["counter"], schema, current, previous, elapsedSeconds)
+                if value is None:
+                    continue
+
+                alerts = []
+                if rule.get("maxvalue") is not None and value >= rule["maxvalue"]:
+                    alerts.append((f'{table}_{row["id"]}_{rule["counter"]}_max_{rule["maxvalue"]}',
+                        f'Performance Counter Alert: counter {rule["counter"]} of {table} instance {row["id"]} on {clusterName} is {value:.2f}, which is more or equal to {rule["maxvalue"]}.'))
+                if rule.get("minheadroom") is not None:
+                    limit = calculateCounterValue(rule["headroomcounter"], schema, current, previous, elapsedSeconds)
+                    if limit is not None and limit - value < rule["minheadroom"]:
+                        alerts.append((f'{table}_{row["id"]}_{rule["counter"]}_headroom_{rule["minheadroom"]}',
+                            f'Performance Headroom Alert: {table} instance {row["id"]} on {clusterName} has a headroom of {limit - value:.2f} ({rule["headroomcounter"]} {limit:.2f} - {rule["counter"]} {value:.2f}), which is less than {rule["minheadroom"]}.'))
+
+                for (uniqueIdentifier, message) in alerts:
+                    eventIndex = eventExist(events, uniqueIdentifier)
+                    if eventIndex < 0:
+                        sendAlert(message, "WARNING", alertCategory)
+                        changedEvents = True
+                        event = {
                             "index": uniqueIdentifier,
                             "message": message,
                             "refresh": eventResilience
                             }
-                    events.append(event)
-                else:
-                    # If the event was found, reset the refresh count. If it is just one less
-                    # than the max, then it means it was decremented above so there wasn't
-                    # really a change in state.
-                    if events[eventIndex]["refresh"] != (eventResilience - 1):
-                        changedEvents = True
-                    events[eventIndex]["refresh"] = eventResilience
-
+                        events.append(event)
+                    else:
+                        # If the event was found, reset the refresh count. If it is just one less
+                        # than the max, then it means it was decremented above so there wasn't
+                        # really a change in state.
+                        if events[eventIndex]["refresh"] != (eventResilience - 1):
+                            changedEvents = True
+                        events[eventIndex]["refresh"] = eventResilience
+        #
+        # Only the counters of the rows that still exist are kept for the next run.
+        counterState["samples"][table] = {"time": curTimeSeconds, "rows": currentRows}
     #
-    # After processing the records, see if any events need to be removed.
-    # However, if any of the requests failed, and no new events were detected, then we should
-    # hold off on removing any events since we can't be sure if they are resolved or not.
-    # This does leave for a corner case of just some of the requests failing and some events
-    # being resolved, but it is better than the alternative of erroneously clearing events
-    # and causing duplicated alerts when the API starts working again.
-    if not anyRequestFailed or changedEvents:
+    # Forget about the tables that are no longer referenced by a rule.
+    for table in [table for table in counterState["samples"] if table not in ruleTables]:
+        del counterState["samples"][table]
+    s3Client.put_object(Key=config["counterSamplesFilename"], Bucket=config["s3BucketName"], Body=json.dumps(counterState, separators=(',', ':')).encode('UTF-8'))
+    #
+    # After processing the records, see if any events need to be removed. If any of the requests
+    # failed, hold off, since we can't be sure if the events are resolved or not.
+    if not anyRequestFailed:
         i = len(events) - 1
         while i >= 0:
             if events[i]["refresh"] <= 0:
@@ -1800,7 +3571,8 @@ def processVserver(service):
     #
     # If the events array changed, save it.
     if(changedEvents):
-        s3Client.put_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+        spoolWebHookBatch()
+        s3Client.put_object(Key=config["counterEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
 
 ################################################################################
 # This function returns the index of the service in the conditions dictionary.
@@ -1815,6 +3587,129 @@ def getServiceIndex(targetService, conditions):
 
     return None
 
+################################################################################
+# This table holds, for each service, the type of value each of its rule keys
+# (the lower case version) takes. It is used to validate the matching
+# conditions when they are compiled.
+################################################################################
+conditionRuleTypes = {
+    "systemhealth": {"versionchange": "boolean", "failover": "boolean", "networkinterfaces": "boolean", "frus": "boolean", "disks": "boolean"},
+    "ems": {"name": "regex", "severity": "regex", "message": "regex", "filter": "regex", "aggregate": "boolean"},
+    "snapmirror": {"maxlagtime": "integer", "maxlagtimepercent": "number", "healthy": "boolean", "stalledtransferseconds": "integer",
+                   "mintransferbytespersecond": "number", "transferetapastnextupdate": "boolean"},
+    "storage": {**{lkey: "number" for lkey in storageThresholdRules}, **{lkey + "clear": "number" for lkey in storageThresholdRules},
+                **{lkey: "number" for lkey in storageGrowthRules}, "offline": "boolean", "flexgroupimbalancepercent": "number", "oldsnapshot": "number"},
+    "quota": {**{lkey: "number" for lkey in quotaThresholdRules}, **{lkey + "clear": "number" for lkey in quotaThresholdRules}},
+    "vserver": {"vserverstate": "boolean", "nfsprotocolstate": "boolean", "cifsprotocolstate": "boolean"},
+    "performance": {**{lkey: "number" for lkey in performanceThresholdRules}, "miniops": "number", "hotvolumestopk": "integer", "hotvolumesrankby": "string", "hotvolumesminchangepercent": "number"},
+    "counters": {"table": "string", "counter": "string", "maxvalue": "number", "headroomcounter": "string", "minheadroom": "number"}
+}
+
+################################################################################
+# This function converts a rule's value to the type passed in. It returns a
+# tuple of the converted value and an error message, which is None if the
+# value could be converted.
+################################################################################
+def convertRuleValue(value, valueType):
+
+    if valueType == "boolean":
+        if isinstance(value, bool):
+            return (value, None)
+        if isinstance(value, str) and value.lower() in ["true", "false"]:
+            return (value.lower() == "true", None)
+        return (None, f'"{value}" is not a boolean')
+
+    if valueType in ["integer", "number"]:
+        if isinstance(value, str):
+            try:
+                value = float(value) if valueType == "number" and not value.strip().lstrip("-").isdigit() else int(value)
+            except ValueError:
+                return (None, f'"{value}" is not a number')
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return (None, f'"{value}" is not a number')
+        if valueType == "integer":
+            if value != int(value):
+                return (None, f'"{value}" is not an integer')
+            value = int(value)
+        return (value, None)
+
+    if not isinstance(value, str):
+        return (None, f'"{value}" is not a string')
+    if valueType == "regex":
+        try:
+            re.compile(value)
+        except re.error as err:
+            return (None, f'"{value}" is not a valid regular expression: {err}')
+    return (value, None)
+
+################################################################################
+# This function validates the matching conditions and compiles them into the
+# plan the services are run from. For each service it holds:
+#   name     - The name of the service.
+#   rules    - The rules, with their values converted to the type the rule
+#              takes. Unknown keys are removed, after a warning is logged.
+#   ruleKeys - The set of the lower case keys used by the rules.
+# The "ems" service also has "emsRules", a list of tuples of the precompiled
+# name, severity, message and filter regular expressions, and the aggregate
+# flag, of each rule. Unknown services are removed, after a warning is logged.
+# If any of the values are invalid, an exception listing all of them is raised.
+################################################################################
+def compileMatchingConditions(matchingConditions, conditionsFilename):
+    global logger, clusterName
+
+    if not isinstance(matchingConditions, dict) or not isinstance(matchingConditions.get("services"), list):
+        raise Exception(f'Error, the matching conditions file "{conditionsFilename}" does not have a "services" list.')
+
+    errors = []
+    services = []
+    for service in matchingConditions["services"]:
+        lname = service.get("name", "").lower() if isinstance(service, dict) else ""
+        if lname not in conditionRuleTypes:
+            logger.warning(f'Unknown service "{service.get("name") if isinstance(service, dict) else service}" found in {conditionsFilename} for cluster {clusterName}.')
+            continue
+
+        ruleTypes = conditionRuleTypes[lname]
+        compiledRules = []
+        ruleKeys = set()
+        for rule in service.get("rules", []):
+            if not isinstance(rule, dict):
+                errors.append(f'{service["name"]}: rule {rule} is not an object.')
+                continue
+            compiledRule = {}
+            for key, value in rule.items():
+                lkey = key.lower()
+                if lkey not in ruleTypes:
+                    logger.warning(f'Unknown {service["name"]} rule key "{key}" found in {conditionsFilename} for cluster {clusterName}.')
+                    continue
+                #
+                # A null string or regular expression is treated as if the key wasn't set, the
+                # way a null EMS "filter" has always been.
+                if value is None and ruleTypes[lkey] in ["string", "regex"]:
+                    continue
+                (compiledValue, error) = convertRuleValue(value, ruleTypes[lkey])
+                if error is not None:
+                    errors.append(f'{service["name"]}: the value of "{key}" {error}.')
+                    continue
+                compiledRule[key] = compiledValue
+                ruleKeys.add(lkey)
+            compiledRules.append(compiledRule)
+
+        compiledService = {"name": service["name"], "rules": compiledRules, "ruleKeys": ruleKeys}
+        if lname == "ems":
+            compiledService["emsRules"] = []
+            for rule in compiledRules:
+                lrule = {key.lower(): value for key, value in rule.items()}
+                compiledService["emsRules"].append((re.compile(lrule.get("name", "")), re.compile(lrule.get("severity", "")), re.compile(lrule.get("message", "")),
+                    re.compile(lrule["filter"]) if lrule.get("filter") else None, bool(lrule.get("aggregate"))))
+        services.append(compiledService)
+
+    if len(errors) > 0:
+        message = f'Error, invalid matching conditions found in {conditionsFilename} for cluster {clusterName}:\n' + "\n".join(errors)
+        logger.error(message)
+        raise Exception(message)
+
+    return {"services": services}
+
 ################################################################################
 # This function builds a default matching conditions dictionary based on the
 # environment variables passed in.
@@ -1831,7 +3726,9 @@ def buildDefaultMatchingConditions(event):
         {"name": "snapmirror", "rules": []},
         {"name": "storage", "rules": []},
         {"name": "quota", "rules": []},
-        {"name": "vserver", "rules": []}
+        {"name": "vserver", "rules": []},
+        {"name": "performance", "rules": []},
+        {"name": "counters", "rules": []}
     ]}
     #
     # Now, add rules based on the environment variables.
@@ -1956,6 +3853,65 @@ def buildDefaultMatchingConditions(event):
 
     return conditions
 
+################################################################################
+# This holds the parsed contents of the S3 objects read with
+# getCachedS3Object(), keyed by the S3 bucket and object, along with the ETag of
+# the object. Since they are module variables, they survive across warm
+# invocations of the Lambda function.
+################################################################################
+s3ObjectCache = {}
+s3ObjectCacheHits = 0
+s3ObjectCacheMisses = 0
+
+################################################################################
+# This function returns the contents of an S3 object, after passing them
+# through the parse function passed in. If the object has been read before, a
+# conditional GET is used, so if it hasn't changed, the cached parsed contents
+# are returned without the object being transferred or parsed again. Any
+# errors, like the object not existing, are raised as a ClientError, just like
+# get_object().
+################################################################################
+def getCachedS3Object(key, parse):
+    global config, s3Client, s3ObjectCacheHits, s3ObjectCacheMisses
+
+    cacheKey = f'{config["s3BucketName"]}/{key}'
+    cached = s3ObjectCache.get(cacheKey)
+    try:
+        if cached is not None:
+            data = s3Client.get_object(Key=key, Bucket=config["s3BucketName"], IfNoneMatch=cached[0])
+        else:
+            data = s3Client.get_object(Key=key, Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        if cached is not None and (err.response['Error']['Code'] in ["304", "NotModified"] or err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304):
+            s3ObjectCacheHits += 1
+            return cached[1]
+        s3ObjectCache.pop(cacheKey, None)
+        raise
+
+    s3ObjectCacheMisses += 1
+    contents = parse(data["Body"].read())
+    if data.get("ETag") is not None:
+        s3ObjectCache[cacheKey] = (data["ETag"], contents)
+    return contents
+
+################################################################################
+# This function parses a configuration file into a list of (key, value)
+# tuples. It gets rid of any "export ", comments, blank lines, or anything else
+# that isn't key=value.
+################################################################################
+def parseConfigFile(body):
+
+    assignments = []
+    for line in body.decode('utf-8').splitlines():
+        if line[0:7] == "export ":
+            line = line[7:]
+        comment = line.split("#")
+        line=comment[0].strip().replace('"', '')
+        x = line.split("=")
+        if len(x) == 2:
+            assignments.append((x[0].strip(), x[1].strip()))
+    return assignments
+
 ################################################################################
 # This function is used to read in all the configuration parameters from the
 # various places:
@@ -1992,9 +3948,18 @@ def readInConfig(event):
         "webhookSecretUsernameKey": "username",
         "webhookSecretPasswordKey": "password",
         "secretUsernameKey": "username",
-        "secretPasswordKey": "password"
+        "secretPasswordKey": "password",
+        "alertRateLimit": None,
+        "alertRateLimitPeriod": 3600,
+        "webhookBatchSize": None,
+        "syslogProtocol": "udp",
+        "syslogPort": 514,
+        "historyRetentionDays": None,
+        "secretCacheTTL": 300
         }
 
+    integerVariables = ["alertRateLimit", "alertRateLimitPeriod", "webhookBatchSize", "syslogPort", "historyRetentionDays", "secretCacheTTL"]
+
     filenameVariables = {
         "emsEventsFilename": None,
         "smEventsFilename": None,
@@ -2003,7 +3968,15 @@ def readInConfig(event):
         "storageEventsFilename": None,
         "quotaEventsFilename": None,
         "systemStatusFilename": None,
-        "vserverEventsFilename": None
+        "vserverEventsFilename": None,
+        "webhookSpoolFilename": None,
+        "alertRateLimitFilename": None,
+        "storageHistoryFilename": None,
+        "historyFilename": None,
+        "performanceEventsFilename": None,
+        "counterEventsFilename": None,
+        "counterSamplesFilename": None,
+        "recordFingerprintsFilename": None
         }
 
     config = {
@@ -2055,7 +4028,7 @@ def readInConfig(event):
     #
     # Process the config file if it exist.
     try:
-        lines = s3Client.get_object(Key=config["configFilename"], Bucket=config["s3BucketName"])['Body'].iter_lines()
+        assignments = getCachedS3Object(config["configFilename"], parseConfigFile)
     except botocore.exceptions.ClientError as err:
         if err.response['Error']['Code'] != "NoSuchKey":
             raise Exception(err)
@@ -2063,19 +4036,7 @@ def readInConfig(event):
             if config["configFilename"] != defaultConfigFilename:
                 logger.warning(f"Warning, did not find file '{config['configFilename']}' in s3 bucket '{config['s3BucketName']}' in region '{config['s3BucketRegion']}' for cluster {clusterName}.")
     else:
-        #
-        # While iterating through the file, get rid of any "export ", comments, blank lines, or anything else that isn't key=value.
-        for line in lines:
-            line = line.decode('utf-8')
-            if line[0:7] == "export ":
-                line = line[7:]
-            comment = line.split("#")
-            line=comment[0].strip().replace('"', '')
-            x = line.split("=")
-            if len(x) == 2:
-                (key, value) = line.split("=")
-            key = key.strip()
-            value = value.strip()
+        for (key, value) in assignments:
             if len(value) == 0:
                 logger.warning(f"Warning, empty value for key '{key}' on cluster {clusterName} .")
             else:
@@ -2105,6 +4066,18 @@ def readInConfig(event):
         cloudWatchRegion = config["cloudWatchLogGroupArn"].split(":")[3]
         config["cloudWatchLogsEndPointHostname"] = f'logs.{cloudWatchRegion}.amazonaws.com'
     #
+    # Convert the numeric parameters, since they are read in as strings.
+    for key in integerVariables:
+        if config[key] is not None:
+            try:
+                config[key] = int(config[key])
+            except ValueError:
+                raise Exception(f'\n\nConfiguration parameter "{key}" must be an integer, got "{config[key]}".\n\n')
+    #
+    # The token buckets are refilled over the alertRateLimitPeriod, so it can't be zero or negative.
+    if config["alertRateLimitPeriod"] is not None and config["alertRateLimitPeriod"] <= 0:
+        raise Exception(f'\n\nConfiguration parameter "alertRateLimitPeriod" must be more than 0, got "{config["alertRateLimitPeriod"]}".\n\n')
+    #
     # Now, check that all the configuration parameters have been set.
     for key in config:
         if config[key] is None and key not in optionalVariables:
@@ -2123,105 +4096,155 @@ def isIpHostname(string):
         return True
 
 ################################################################################
-# Main logic
+# This class is a SysLogHandler that frames each message with its length, as
+# described in RFC 6587 "octet counting", when sending it over TCP. The
+# standard SysLogHandler terminates each message with a NUL, which most syslog
+# servers don't recognize as a frame delimiter without additional
+# configuration. If the connection is lost, it will reconnect once and try to
+# resend the message.
 ################################################################################
-def lambda_handler(event, context):
-    #
-    # Define global variables so we don't have to pass them to all the functions.
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger, cloudWatchClient, clusterTimezone
-    #
-    # Set up logging.
+class OctetFramedSysLogHandler(SysLogHandler):
+    append_nul = False
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            if self.ident:
+                msg = self.ident + msg
+            prio = '<%d>' % self.encodePriority(self.facility, self.mapPriority(record.levelname))
+            msg = (prio + msg).encode('utf-8')
+            frame = str(len(msg)).encode('ascii') + b' ' + msg
+            try:
+                if self.socket is None:
+                    self.createSocket()
+                self.socket.sendall(frame)
+            except OSError:
+                self.closeSocket()
+                self.createSocket()
+                self.socket.sendall(frame)
+        except Exception:
+            self.handleError(record)
+
+    def closeSocket(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+################################################################################
+# This function sets up the logging pipeline. So the program doesn't have to
+# wait on the I/O of writing out log messages, the logger just puts them on a
+# queue, and a background thread (a QueueListener) passes them on to the
+# actual handlers (console and syslog). It can be called again to replace the
+# handlers, which is done once the syslog configuration has been read in.
+################################################################################
+def setupLogging(syslogServer=None):
+    global logger, logListener, lambdaFunction, config
+
+    stopLogging()
     logging.basicConfig()
     logger = logging.getLogger("MOS_Monitoring")
+    formatter = logging.Formatter(
+            fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
+    #
+    # Since the messages no longer propagate to the root logger, have the
+    # listener write to its handlers (e.g. the Lambda console handler).
+    handlers = list(logging.getLogger().handlers)
     if lambdaFunction:
         logger.setLevel(logging.INFO)       # Anything at this level and above this get logged.
     else: # Assume we are running in a test environment.
         logger.setLevel(logging.DEBUG)      # Anything at this level and above this get logged.
-        formatter = logging.Formatter(
-                fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S"
-            )
         loggerscreen = logging.StreamHandler()
         loggerscreen.setFormatter(formatter)
-        logger.addHandler(loggerscreen)
+        handlers.append(loggerscreen)
+
+    syslogError = None
+    if syslogServer is not None:
+        try:
+            if config["syslogProtocol"].lower() == "tcp":
+                handler = OctetFramedSysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(syslogServer, config["syslogPort"]), socktype=socket.SOCK_STREAM)
+            else:
+                handler = SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(syslogServer, config["syslogPort"]))
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+        except OSError as err:
+            syslogError = f'Failed to connect to syslog server {syslogServer}:{config["syslogPort"]}. Error: {err}'
+    #
+    # Remove any handlers left from a previous invocation of a warm Lambda function.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logQueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    logger.propagate = False
+    logListener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+    logListener.start()
+    if syslogError is not None:
+        logger.error(syslogError)
+
+################################################################################
+# This function stops the logging background thread, after it has written out
+# all the messages that are in its queue.
+################################################################################
+def stopLogging():
+    global logListener
+
+    if logListener is not None:
+        logListener.stop()
+        for handler in logListener.handlers:
+            if isinstance(handler, SysLogHandler):
+                handler.close()
+        logListener = None
+
+################################################################################
+# Main logic
+################################################################################
+def lambda_handler(event, context):
+    setupLogging()
+    try:
+        monitorOntapServices(event)
+    finally:
+        stopLogging()
+
+################################################################################
+# This function runs all the checks against the cluster.
+################################################################################
+def monitorOntapServices(event):
+    #
+    # Define global variables so we don't have to pass them to all the functions.
+    global config, s3Client, http, headers, clusterName, clusterVersion, logger, clusterTimezone, coldStart
+    global webhookSpool, webhookSpoolChanged, webhookDownEndpoints, webhookBatch, alertRateLimits, alertRateLimitsChanged, historySamples
+    global recordFingerprints, recordFingerprintsChanged, recordsSkipped
     #
     # Read in the configuraiton.
     readInConfig(event)   # This defines the s3Client variable.
     #
-    # Set up the logger to log to a file and to syslog.
+    # Now that the configuration has been read, add syslog to the logging pipeline.
     if config["syslogIP"] is not None:
-        #
-        # Due to a bug with the SysLogHandler() of not sending proper framing with a message
-        # when using TCP (it should end it with a LF and not a NUL like it does now) you must add
-        # an additional frame delimiter to the receiving syslog server. With rsyslog, you add
-        # a AddtlFrameDelimiter="0" directive to the "input()" line where they have it listen
-        # to a TCP port. For example:
-        #
-        #  # provides TCP syslog reception
-        #  module(load="imtcp")
-        #  input(type="imtcp" port="514" AddtlFrameDelimiter="0")
-        #
-        # Because of this bug, I am going to stick with UDP, the default protocol used by
-        # the syslog handler. If TCP is required, then the above changes will have to be made
-        # to the syslog server. Or, the program will have to handle closing and opening the
-        # connection for each message. The following will do that:
-        #    handler.flush()
-        #    handler.close()
-        #    logger.removeHandler(handler)
-        #    handler = logging.handlers.SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(syslogIP, 514), socktype=socket.SOCK_STREAM)
-        #    handler.setFormatter(formatter)
-        #    logger.addHandler(handler)
-        #
-        # You might get away with a simple handler.open() after the close(), without having to
-        # remove and add the handler. I didn't test that.
-        handler = logging.handlers.SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(config["syslogIP"], 514))
-        formatter = logging.Formatter(
-                fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S"
-            )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        setupLogging(config["syslogIP"])
     #
-    # Create a Secrets Manager client.
-    secretRegion = config["secretArn"].split(":")[3]
-    client = boto3.client(service_name='secretsmanager', region_name=secretRegion, verify=isIpHostname(config["secretsManagerEndPointHostname"]), endpoint_url=f'https://{config["secretsManagerEndPointHostname"]}')
+    # Report how long importing the modules took, if this is the first run in this container.
+    if coldStart:
+        logger.info(f'Cold start: importing the modules took {importSeconds * 1000:.0f} ms.')
+        coldStart = False
     #
-    # Get the username and password of the ONTAP/FSxN system.
-    secretsInfo = client.get_secret_value(SecretId=config["secretArn"])
-    secrets = json.loads(secretsInfo['SecretString'])
-    if secrets.get(config['secretUsernameKey']) is None:
-        logger.critical(f'Error, "{config["secretUsernameKey"]}" not found in secret "{config["secretArn"]}" for cluster {config["OntapAdminServer"]}.')
-        return
-
-    if secrets.get(config['secretPasswordKey']) is None:
-        logger.critical(f'Error, "{config["secretPasswordKey"]}" not found in secret "{config["secretArn"]}" for cluster {config["OntapAdminServer"]}.')
+    # Get the username and password of the ONTAP/FSxN system, and create the headers to make
+    # the API calls with. They are cached, so Secrets Manager isn't called on every run.
+    if not setOntapHeaders():
         return
-
-    username = secrets[config['secretUsernameKey']]
-    password = secrets[config['secretPasswordKey']]
     #
-    # Create clients to the other AWS services we will be using.
+    # The clients to the other AWS services we will be using are created when they are first needed.
     #s3Client = boto3.client('s3', config["s3BucketRegion"])  # Defined in readInConfig()
-    snsRegion = config["snsTopicArn"].split(":")[3]
-    snsClient = boto3.client('sns', region_name=snsRegion, verify=isIpHostname(config["snsEndPointHostname"]), endpoint_url=f'https://{config["snsEndPointHostname"]}')
-    cloudWatchClient = None
-    if config["cloudWatchLogGroupArn"] is not None:
-        cloudWatchRegion = config["cloudWatchLogGroupArn"].split(":")[3]
-        cloudWatchClient = boto3.client('logs', region_name=cloudWatchRegion, verify=isIpHostname(config["cloudWatchLogsEndPointHostname"]), endpoint_url=f'https://{config["cloudWatchLogsEndPointHostname"]}')
-    #
-    # Create a http handle to make ONTAP/FSxN API calls with.
-    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
-    headers = { **auth }
     #
     # Disable warning about connecting to servers with self-signed SSL certificates.
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
+    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries, maxsize=5)  # Allow for concurrent requests to the cluster.
     #
     # Get the conditions we know what to alert on.
+    # The conditions are compiled into a plan, which is only rebuilt when the file changes.
     try:
-        data = s3Client.get_object(Key=config["conditionsFilename"], Bucket=config["s3BucketName"])
-        matchingConditions = json.loads(data["Body"].read().decode('UTF-8'))
+        matchingConditions = getCachedS3Object(config["conditionsFilename"], lambda body: compileMatchingConditions(json.loads(body.decode('UTF-8')), config["conditionsFilename"]))
     except botocore.exceptions.ClientError as err:
         if err.response['Error']['Code'] != "NoSuchKey":
             logger.error(f'Error, could not retrieve configuration file {config["conditionsFilename"]} from: s3://{config["s3BucketName"]} for cluster {config["OntapAdminServer"]}.\nBelow is additional information:')
@@ -2229,30 +4252,72 @@ def lambda_handler(event, context):
         else:
             matchingConditions = buildDefaultMatchingConditions(event)
             s3Client.put_object(Key=config["conditionsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(matchingConditions, indent=4).encode('UTF-8'))
+            matchingConditions = compileMatchingConditions(matchingConditions, config["conditionsFilename"])
     except json.decoder.JSONDecodeError as err:
         logger.error(f'Error, could not decode JSON from configuration file "{config["conditionsFilename"]}" for cluster {config["OntapAdminServer"]}. The error message from the decoder:\n{err}\n')
         raise Exception(err)
 
-    if(checkSystem()):
+    logger.debug(f'S3 object cache hits={s3ObjectCacheHits} misses={s3ObjectCacheMisses} for cluster {clusterName}.')
+    #
+    # Before sending any new alerts, retry any webhooks that failed on previous runs.
+    webhookSpool = None
+    webhookSpoolChanged = False
+    webhookDownEndpoints = set()
+    webhookBatch = []
+    alertRateLimits = None
+    alertRateLimitsChanged = False
+    historySamples = {}
+    recordFingerprints = None
+    recordFingerprintsChanged = False
+    recordsSkipped = 0
+    try:
+        if config.get('webhookEndpoint') is not None or config.get('webhookEndpoint2') is not None:
+            processWebhookSpool()
+
+        if(checkSystem()):
+            #
+            # Loop on all the configured ONTAP services we want to check on.
+            for service in matchingConditions["services"]:
+                if service["name"].lower() == "systemhealth":
+                    checkSystemHealth(service)
+                elif service["name"].lower() == "ems":
+                    processEMSEvents(service)
+                elif (service["name"].lower() == "snapmirror"):
+                    processSnapMirrorRelationships(service)
+                elif service["name"].lower() == "storage":
+                    processStorageUtilization(service)
+                elif service["name"].lower() == "quota":
+                    processQuotaUtilization(service)
+                elif service["name"].lower() == "vserver":
+                    processVserver(service)
+                elif service["name"].lower() == "performance":
+                    processPerformance(service)
+                elif service["name"].lower() == "counters":
+                    processCounters(service)
+                else:
+                    logger.warning(f'Unknown service "{service["name"]}" found for cluster {clusterName}.')
+            #
+            # Save the samples collected by the services to the history store.
+            saveHistory()
+            #
+            # Save the fingerprints of the records evaluated, now that their events have been saved.
+            saveRecordFingerprints()
+            logger.info(f'Skipped evaluating {recordsSkipped} unchanged records on cluster {clusterName}.')
         #
-        # Loop on all the configured ONTAP services we want to check on.
-        for service in matchingConditions["services"]:
-            if service["name"].lower() == "systemhealth":
-                checkSystemHealth(service)
-            elif service["name"].lower() == "ems":
-                processEMSEvents(service)
-            elif (service["name"].lower() == "snapmirror"):
-                processSnapMirrorRelationships(service)
-            elif service["name"].lower() == "storage":
-                processStorageUtilization(service)
-            elif service["name"].lower() == "quota":
-                processQuotaUtilization(service)
-            elif service["name"].lower() == "vserver":
-                processVserver(service)
-            else:
-                logger.warning(f'Unknown service "{service["name"]}" found for cluster {clusterName}.')
+        # Summarize any alerts that were suppressed by the rate limiter.
+        sendSuppressedAlertSummaries()
+    finally:
+        #
+        # Always send any batched webhooks and save the webhook spool so alerts
+        # that failed to be sent aren't lost.
+        try:
+            flushWebHookBatch()
+        finally:
+            saveWebhookSpool()
+            saveAlertRateLimits()
     return
 
+logListener = None
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None:
     lambdaFunction = False
     lambda_handler(None, None)